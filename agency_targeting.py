@@ -1,5 +1,7 @@
 #!/usr/bin/python
 import csv
+import heapq
+import multiprocessing
 import re
 
 AGENCY_INPUT_FILE = "/Users/patrickmauro/Documents/Agency Targets.csv"
@@ -8,6 +10,18 @@ PUMA_MAP_FILE = "/Users/patrickmauro/code/ch/puma-mapping.csv"
 
 VERBOSE = True
 
+# "greedy" fills regions one at a time (Steps 2-4 below).  "flow" places the overage with a min-cost max-flow over
+# the whole city, preferring the agency's own region, then neighboring regions, then anywhere (and, between regions
+# at the same distance, the one with the most demand), and prints how its targets differ from the greedy ones.
+ALLOCATION_MODE = "greedy"
+
+# Scenario runs: set SCENARIO_FILE to a CSV of what-ifs (see read_scenarios) to allocate each of them, as well as the
+# inputs as they are ("base"), and write every agency's target in each to SCENARIO_OUTPUT_FILE.  SCENARIO_PROCESSES
+# scenarios run at a time.
+SCENARIO_FILE = None
+SCENARIO_OUTPUT_FILE = "scenario-targets.csv"
+SCENARIO_PROCESSES = 1
+
 # -------------------------------------------------------------
 
 
@@ -17,7 +31,9 @@ def str_to_int(input_str):
     return val
 
 
-class Region():
+class Region(object):
+    __slots__ = ('id', 'ef_demand', 'neighboring_regions', 'agencies', 'overage', 'available_agencies')
+
     def __init__(self, _id, _ef_demand, _neighbors):
         self.id = _id
         self.ef_demand = _ef_demand
@@ -26,21 +42,40 @@ class Region():
         self.agencies = []
         self.overage = 0
 
+        # heap of (-bandwidth, position in agencies, agency) for the agencies with capacity, built when first needed.
+        # Agencies only ever gain food, so one that's full never has to be put back.
+        self.available_agencies = None
+
     def add_agency(self, _agency):
         self.agencies.append(_agency)
+        self.available_agencies = None
+
+    def get_available_agencies(self):
+        if self.available_agencies is None:
+            self.available_agencies = [(-agency.bandwidth, i, agency) for i, agency in enumerate(self.agencies)
+                                       if agency.get_overage() < 0]
+            heapq.heapify(self.available_agencies)
+        return self.available_agencies
+
+    def has_capacity(self):
+        return len(self.get_available_agencies()) > 0
 
     # returns unallocated portion of distrib_amt
     # allocates by filling agencies to capacity, from agency with most bandwidth to agency with least bandwidth
-    def distrib_overage(self, distrib_amt):  # get a set of agencies that have capacity
-        # Get the agencies to which we can distribute food
-        available_agencies = filter(lambda x: x.get_overage() < 0, self.agencies)
+    # (agencies with the same bandwidth in the order they were added)
+    def distrib_overage(self, distrib_amt):
+        available_agencies = self.get_available_agencies()
 
         # Allocate food from agency with most bandwidth to agency with least bandwidth
-        for tgt_agency in sorted(available_agencies, key=lambda x: x.bandwidth, reverse=True):
+        while available_agencies:
+            tgt_agency = available_agencies[0][2]
             amt = min(distrib_amt, tgt_agency.get_capacity())
             tgt_agency.cur_tgt += amt
             distrib_amt -= amt
 
+            if tgt_agency.get_overage() >= 0:
+                heapq.heappop(available_agencies)
+
             # should never be < 0, but let's be a bit silly here to be super-safe
             if distrib_amt <= 0:
                 break
@@ -48,7 +83,9 @@ class Region():
         return distrib_amt
 
 
-class Agency():
+class Agency(object):
+    __slots__ = ('ch_id', 'init_tgt', 'cur_tgt', 'capacity', 'bandwidth')
+
     def __init__(self, _ch_id, _tgt_pounds, _capacity, _bandwidth):
         self.ch_id = _ch_id
         self.init_tgt = _tgt_pounds
@@ -63,13 +100,36 @@ class Agency():
         return -1.0 * self.get_overage()
 
 
-def distrib_btwn_regions(restrict_to_neighbors):
+def distrib_within_regions(regions):
+    """ Caps every agency at its capacity and gives the excess to other agencies in the same region. """
+    for region in regions.values():
+        #todo Move this to Region method?
+        overage = 0
+        for agency in region.agencies:
+            if agency.get_overage() > 0:
+                overage += agency.get_overage()
+                agency.cur_tgt = agency.capacity
+
+        if overage > 0:
+            region.overage = region.distrib_overage(overage)
+
+
+# returns the transfers made, as (source region id, target region id, lbs, neighbors?) tuples
+def distrib_btwn_regions(regions, restrict_to_neighbors, verbose=None):
+    if verbose is None:
+        verbose = VERBOSE
+    transfers = []
+
     # a) only distribute to regions w/o overage b/c such regions are already full
     # b) sort from most need to least need
-    # c) make this a list of region ids, not Region objects
+    # c) rank them, so a region's neighbors can be put in that order without going through all of them
     available_regions = filter(lambda x: x.overage == 0, regions.values())
     available_regions = sorted(available_regions, key=lambda x: x.ef_demand, reverse=True)
-    available_regions = map(lambda x: x.id, available_regions)
+    region_rank = dict((region.id, k) for k, region in enumerate(available_regions))
+
+    # Without the neighbor restriction every source region goes through the same regions in the same order, so keep
+    # them in one queue (by rank) and drop the ones that fill up.  Distributing to a full region never moves anything.
+    region_queue = [(k, region) for k, region in enumerate(available_regions) if region.has_capacity()]
 
     # now start distributing the overage
     regions_w_overage = filter(lambda x: x.overage > 0, regions.values())
@@ -78,137 +138,585 @@ def distrib_btwn_regions(restrict_to_neighbors):
     for source_region in sorted(regions_w_overage, key=lambda x: x.overage, reverse=True):
         if restrict_to_neighbors:
             # Get neighboring regions in the order in which we'll check them
-            target_region_set = filter(lambda x: x in source_region.neighboring_regions, available_regions)
+            target_regions = [available_regions[k] for k in
+                              sorted(region_rank[x] for x in source_region.neighboring_regions if x in region_rank)]
         else:
-            target_region_set = available_regions
+            target_regions = queued_regions(region_queue)
+
+        for target_region in target_regions:
+            if not target_region.has_capacity():
+                continue
 
-        for target_region_id in target_region_set:
-            target_region = regions[target_region_id]
             new_overage = target_region.distrib_overage(source_region.overage)
 
-            if VERBOSE and new_overage != source_region.overage:
-                print("Transferring %d lbs from region %d to %d -- neighbors? %s" %
-                      (source_region.overage - new_overage, source_region.id, target_region.id,
-                       str(restrict_to_neighbors)))
+            if new_overage != source_region.overage:
+                transfers.append((source_region.id, target_region.id, source_region.overage - new_overage,
+                                  restrict_to_neighbors))
+                if verbose:
+                    print("Transferring %d lbs from region %d to %d -- neighbors? %s" %
+                          (source_region.overage - new_overage, source_region.id, target_region.id,
+                           str(restrict_to_neighbors)))
 
             source_region.overage = new_overage
 
             if source_region.overage == 0:
                 break
 
-# -------------------------------------------------------------
-
-# Step 1 - Read input files
-neighbor_map = dict()
-#todo put error checking from check_puma_mapping.py in here
-with open(PUMA_MAP_FILE, 'rbU') as csvfile:
-    reader = csv.reader(csvfile)
-
-    # skip the header rows
-    next(reader, None)
-
-    for row in reader:
-        region_id = int(row[0])
-        neighbors = map(lambda x: int(x), row[1].split(","))
-
-        if region_id in neighbor_map:
-            print("Region id %d appears twice in region mapping file" % region_id)
-        else:
-            neighbor_map[region_id] = set(neighbors)
+    return transfers
+
+
+def queued_regions(region_queue):
+    """ Yields the regions in a queue of (rank, Region), best first, removing them as they run out of capacity. """
+    while region_queue:
+        region = region_queue[0][1]
+        yield region
+        if not region.has_capacity():
+            heapq.heappop(region_queue)
+        elif region_queue[0][1] is region:
+            # it still has room, so nothing was left to give it
+            return
+
+
+class MinCostFlow():
+    """
+    Min-cost max-flow by successive shortest paths, using Dijkstra with node potentials (so edge costs must start out
+    non-negative).  Edges are lists [to, residual capacity, cost, reverse edge]; flow() gives an edge's flow once
+    solve() has run.
+    """
+    def __init__(self, num_nodes):
+        self.graph = [[] for _ in xrange(num_nodes)]
+
+    def add_edge(self, u, v, cap, cost):
+        edge = [v, cap, cost, None]
+        rev = [u, 0, -cost, edge]
+        edge[3] = rev
+        self.graph[u].append(edge)
+        self.graph[v].append(rev)
+        return edge
+
+    @staticmethod
+    def flow(edge):
+        return edge[3][1]
+
+    def solve(self, source, sink):
+        """ Sends as much flow as possible from source to sink at the least cost; returns (flow, cost). """
+        num_nodes = len(self.graph)
+        potential = [0] * num_nodes
+        total_flow = 0
+        total_cost = 0
+        while True:
+            # shortest paths by reduced cost
+            dist = [None] * num_nodes
+            prev_edge = [None] * num_nodes
+            dist[source] = 0
+            queue = [(0, source)]
+            while queue:
+                d, u = heapq.heappop(queue)
+                if d > dist[u]:
+                    continue
+                for edge in self.graph[u]:
+                    if edge[1] <= 0:
+                        continue
+                    v = edge[0]
+                    nd = d + edge[2] + potential[u] - potential[v]
+                    if dist[v] is None or nd < dist[v]:
+                        dist[v] = nd
+                        prev_edge[v] = edge
+                        heapq.heappush(queue, (nd, v))
+
+            if dist[sink] is None:
+                break
 
-region_to_demand = dict()
-region_to_target = dict()
-with open(REGION_INPUT_FILE, 'rbU') as csvfile:
-    reader = csv.reader(csvfile)
+            # nodes past the sink (or not reached) move with it, which keeps the reduced costs non-negative
+            for v in xrange(num_nodes):
+                potential[v] += dist[sink] if dist[v] is None or dist[v] > dist[sink] else dist[v]
+
+            push = None
+            v = sink
+            while v != source:
+                edge = prev_edge[v]
+                push = edge[1] if push is None else min(push, edge[1])
+                v = edge[3][0]
+
+            v = sink
+            while v != source:
+                edge = prev_edge[v]
+                edge[1] -= push
+                edge[3][1] += push
+                v = edge[3][0]
+
+            total_flow += push
+            total_cost += push * (potential[sink] - potential[source])
+
+        return total_flow, total_cost
+
+
+def distrib_min_cost_flow(regions):
+    """
+    Places all the overage at once: caps every agency at its capacity (as in Step 2), then solves a min-cost max-flow
+    from each region's overage to the room left in every region.  Keeping food within a region is free, moving it to a
+    neighbor costs one step and anywhere else two (through a hub node, so the network stays small); between regions
+    the same distance away, the one with more demand is cheaper.  Each region then fills its agencies with what it
+    gets, from most bandwidth to least, as distrib_overage does, and keeps what couldn't be placed as its overage.
+
+    Returns the transfers between regions as (source region id, target region id, lbs, neighbors?) tuples.
+    """
+    # overfull agencies give their excess to their region
+    supply = dict()
+    for region in regions.values():
+        overage = region.overage
+        for agency in region.agencies:
+            if agency.get_overage() > 0:
+                overage += agency.get_overage()
+                agency.cur_tgt = agency.capacity
+        supply[region.id] = overage
+
+    # demand ranks break ties; they're all smaller than one distance step
+    step = len(regions)
+    ranked = sorted(regions.values(), key=lambda x: x.ef_demand, reverse=True)
+    total = sum(supply.values())
+
+    source, sink, hub = 0, 1, 2
+    room_node = dict((region.id, 4 + 2 * k) for k, region in enumerate(ranked))
+    network = MinCostFlow(3 + 2 * len(ranked))
+
+    supply_edges = dict()  # region id -> edge from the source
+    room_edges = dict()    # region id -> edge to the sink
+    neighbor_edges = []    # (source region id, target region id, edge)
+    to_hub = []            # (region id, edge)
+    from_hub = []          # (region id, edge)
+    for k, region in enumerate(ranked):
+        supply_node = 3 + 2 * k
+        if supply[region.id] > 0:
+            supply_edges[region.id] = network.add_edge(source, supply_node, supply[region.id], 0)
+            network.add_edge(supply_node, room_node[region.id], total, 0)
+            for neighbor_id in region.neighboring_regions:
+                if neighbor_id in room_node and neighbor_id != region.id:
+                    neighbor_edges.append((region.id, neighbor_id,
+                                           network.add_edge(supply_node, room_node[neighbor_id], total, step)))
+            to_hub.append((region.id, network.add_edge(supply_node, hub, total, step)))
+
+        room = sum(agency.get_capacity() for agency in region.agencies if agency.get_overage() < 0)
+        if room > 0:
+            from_hub.append((region.id, network.add_edge(hub, room_node[region.id], total, step)))
+            room_edges[region.id] = network.add_edge(room_node[region.id], sink, int(room), k)
+
+    network.solve(source, sink)
+
+    for region in ranked:
+        if region.id in room_edges:
+            region.distrib_overage(MinCostFlow.flow(room_edges[region.id]))
+        region.overage = 0
+        if region.id in supply_edges:
+            region.overage = supply[region.id] - MinCostFlow.flow(supply_edges[region.id])
+
+    transfers = [(source_id, target_id, MinCostFlow.flow(edge), True)
+                 for source_id, target_id, edge in neighbor_edges if MinCostFlow.flow(edge) > 0]
+
+    # what went through the hub can be paired up any way that adds up
+    sent = [[region_id, MinCostFlow.flow(edge)] for region_id, edge in to_hub if MinCostFlow.flow(edge) > 0]
+    received = [[region_id, MinCostFlow.flow(edge)] for region_id, edge in from_hub if MinCostFlow.flow(edge) > 0]
+    while sent and received:
+        amt = min(sent[0][1], received[0][1])
+        transfers.append((sent[0][0], received[0][0], amt, False))
+        sent[0][1] -= amt
+        received[0][1] -= amt
+        if sent[0][1] == 0:
+            sent.pop(0)
+        if received[0][1] == 0:
+            received.pop(0)
+
+    return transfers
+
+
+def print_allocation_diffs(greedy_regions, flow_regions, greedy_transfers, flow_transfers):
+    """
+    Prints the agencies whose targets differ between the greedy and min-cost flow allocations of the same regions,
+    then how much each left unallocated and moved to neighboring and to other regions.
+    """
+    def moved(regions, transfers):
+        to_neighbors = sum(lbs for source_id, target_id, lbs, neighbors in transfers
+                           if target_id in regions[source_id].neighboring_regions)
+        return to_neighbors, sum(lbs for source_id, target_id, lbs, neighbors in transfers) - to_neighbors
+
+    print("region,ch_id,greedy_tgt,flow_tgt")
+    for region_id in sorted(flow_regions):
+        for greedy_agency, flow_agency in zip(greedy_regions[region_id].agencies, flow_regions[region_id].agencies):
+            if greedy_agency.cur_tgt != flow_agency.cur_tgt:
+                print("%s,%s,%d,%d" % (region_id, flow_agency.ch_id, greedy_agency.cur_tgt, flow_agency.cur_tgt))
+
+    for name, regions, transfers in (("greedy", greedy_regions, greedy_transfers),
+                                     ("flow", flow_regions, flow_transfers)):
+        print("%s: %d lbs unallocated, %d lbs moved to neighboring regions, %d lbs to other regions" %
+              ((name, sum(region.overage for region in regions.values())) + moved(regions, transfers)))
+
+class TargetingInputs():
+    """
+    The input files, parsed and indexed once (see read_inputs).  Nothing changes them afterwards, so every scenario
+    can build its Regions from the same TargetingInputs.
+    """
+    def __init__(self):
+        self.neighbor_map = dict()      # region id -> set of neighboring region ids
+        self.region_to_demand = dict()  # region id -> residual EF demand
+        self.region_to_target = dict()  # region id -> regional target
+        self.agency_rows = []           # (region id, ch id, target lbs, capacity, meals served), in file order
+        self.region_order = []          # ids of the regions to build, in the order they're built
+
+
+def read_inputs(agency_path, region_path, puma_path):
+    """ Step 1: reads the PUMA map, the regional targets and the agency targets into a TargetingInputs. """
+    inputs = TargetingInputs()
+
+    #todo put error checking from check_puma_mapping.py in here
+    with open(puma_path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header rows
+        next(reader, None)
+
+        for row in reader:
+            region_id = int(row[0])
+            neighbors = map(lambda x: int(x), row[1].split(","))
+
+            if region_id in inputs.neighbor_map:
+                print("Region id %d appears twice in region mapping file" % region_id)
+            else:
+                inputs.neighbor_map[region_id] = set(neighbors)
+
+    with open(region_path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header rows
+        next(reader, None)
+
+        for row in reader:
+            if not row[0].isdigit():
+                continue
 
-    # skip the header rows
-    next(reader, None)
+            region_id = int(row[0])
+            name = row[1]
+            ppl_in_need = str_to_int(row[2])
+            ef_demand_total = str_to_int(row[3])
+            ef_demand_satisfied = str_to_int(row[4])
+            ef_demand_residual = str_to_int(row[5])
+            region_target = str_to_int(row[6])
 
-    for row in reader:
-        if not row[0].isdigit():
-            continue
+            inputs.region_to_demand[region_id] = ef_demand_residual
+            inputs.region_to_target[region_id] = region_target
 
-        region_id = int(row[0])
-        name = row[1]
-        ppl_in_need = str_to_int(row[2])
-        ef_demand_total = str_to_int(row[3])
-        ef_demand_satisfied = str_to_int(row[4])
-        ef_demand_residual = str_to_int(row[5])
-        region_target = str_to_int(row[6])
+    regions_w_agencies = set()
+    with open(agency_path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
 
-        region_to_demand[region_id] = ef_demand_residual
-        region_to_target[region_id] = region_target
+        # skip the header rows
+        next(reader, None)
 
-regions = dict()  # region_id -> Region
-with open(AGENCY_INPUT_FILE, 'rbU') as csvfile:
-    reader = csv.reader(csvfile)
+        for row in reader:
+            # get rid of the unicode nonsense (thanks MSFT!)
+            row = map(lambda x: str(x.decode("ascii", "ignore")), row)
 
-    # skip the header rows
-    next(reader, None)
-
-    for row in reader:
-        # get rid of the unicode nonsense (thanks MSFT!)
-        row = map(lambda x: str(x.decode("ascii", "ignore")), row)
+            if row[0] == "":
+                continue
 
-        if row[0] == "":
+            agency_name = row[0]
+            ch_id = row[1]
+            efro = int(row[2])
+            region_id = int(row[3])
+            meals_served = int(row[4])
+            agency_region_count = int(row[5])
+            pctg = row[6]  # todo fix output format from excel
+            tgt_pounds = str_to_int(row[7])
+            capacity = str_to_int(row[8])
+
+            if region_id not in regions_w_agencies:
+                if region_id not in inputs.neighbor_map:
+                    print("Could not find region->neighbor mapping for region %d" % region_id)
+                    continue
+
+                if region_id not in inputs.region_to_demand:
+                    print("Could not find region->demadn mapping for region %d" % region_id)
+                    continue
+
+                regions_w_agencies.add(region_id)
+                inputs.region_order.append(region_id)
+
+            inputs.agency_rows.append((region_id, ch_id, tgt_pounds, capacity, meals_served))
+
+    # Some regions don't have agencies.  Their whole target is overage.
+    regions_wo_agencies = set(inputs.region_to_target.keys()) - regions_w_agencies
+    for region_id in regions_wo_agencies:
+        if region_id not in inputs.neighbor_map:
+            print("Could not find region->neighbor mapping for region %d" % region_id)
             continue
 
-        agency_name = row[0]
-        ch_id = row[1]
-        efro = int(row[2])
-        region_id = int(row[3])
-        meals_served = int(row[4])
-        agency_region_count = int(row[5])
-        pctg = row[6]  # todo fix output format from excel
-        tgt_pounds = str_to_int(row[7])
-        capacity = str_to_int(row[8])
-
-        if region_id not in regions:
-            if region_id not in neighbor_map:
-                print("Could not find region->neighbor mapping for region %d" % region_id)
-                continue
+        inputs.region_order.append(region_id)
+
+    return inputs
+
+
+class Scenario():
+    """
+    A what-if: changes to the inputs, applied by build_regions() as it makes the scenario's own Regions and Agencies
+    (the shared TargetingInputs are never changed).  Agency changes are keyed by ch id, or by (region id, ch id) for
+    just one region's share of an agency.
+
+      capacities      agency -> capacity
+      targets         agency -> target lbs
+      closed          agencies that are closed (no capacity, so their whole target is redistributed)
+      region_targets  region id -> regional target; a region's agency targets are scaled to add up to it
+      region_demands  region id -> residual EF demand
+      mode            "greedy" or "flow" (ALLOCATION_MODE by default)
+    """
+    def __init__(self, name, capacities=None, targets=None, closed=None, region_targets=None, region_demands=None,
+                 mode=None):
+        self.name = name
+        self.capacities = capacities or dict()
+        self.targets = targets or dict()
+        self.closed = closed or set()
+        self.region_targets = region_targets or dict()
+        self.region_demands = region_demands or dict()
+        self.mode = mode
+
+    def agency_change(self, changes, region_id, ch_id, value):
+        if (region_id, ch_id) in changes:
+            return changes[(region_id, ch_id)]
+        return changes.get(ch_id, value)
+
+    def is_closed(self, region_id, ch_id):
+        return ch_id in self.closed or (region_id, ch_id) in self.closed
+
+
+def scale_targets(targets, new_total):
+    """ Scales targets (ints) to add up to new_total, handing out the rounding remainder largest fraction first. """
+    total = sum(targets)
+    if total <= 0:
+        return list(targets)
+    scaled = [tgt * new_total // total for tgt in targets]
+    fractions = sorted(range(len(targets)), key=lambda k: -(targets[k] * new_total % total))
+    for k in fractions[:new_total - sum(scaled)]:
+        scaled[k] += 1
+    return scaled
+
+
+def build_regions(inputs, scenario=None):
+    """ Makes region_id -> Region, with its Agencies, from the inputs, with the scenario's changes if there is one. """
+    scenario = scenario or Scenario("base")
+
+    regions = dict()  # region_id -> Region
+    for region_id in inputs.region_order:
+        regions[region_id] = Region(region_id, scenario.region_demands.get(region_id,
+                                                                           inputs.region_to_demand[region_id]),
+                                    inputs.neighbor_map[region_id])
+
+    for region_id, ch_id, tgt_pounds, capacity, meals_served in inputs.agency_rows:
+        tgt_pounds = scenario.agency_change(scenario.targets, region_id, ch_id, tgt_pounds)
+        capacity = scenario.agency_change(scenario.capacities, region_id, ch_id, capacity)
+        if scenario.is_closed(region_id, ch_id):
+            capacity = 0
+        regions[region_id].add_agency(Agency(ch_id, tgt_pounds, capacity, meals_served))
 
-            if region_id not in region_to_demand:
-                print("Could not find region->demadn mapping for region %d" % region_id)
+    for region_id, region in regions.items():
+        region_target = scenario.region_targets.get(region_id)
+        if not region.agencies:
+            # no agencies to take the region's food, so it's all overage
+            region.overage = region_target if region_target is not None else inputs.region_to_target[region_id]
+        elif region_target is not None:
+            for agency, tgt in zip(region.agencies, scale_targets([a.init_tgt for a in region.agencies],
+                                                                  region_target)):
+                agency.init_tgt = agency.cur_tgt = tgt
+
+    return regions
+
+
+def allocate(regions, mode="greedy", verbose=None):
+    """ Steps 2-4 (or the min-cost flow instead), in place; returns the transfers between regions. """
+    if mode == "flow":
+        return distrib_min_cost_flow(regions)
+
+    # Step 2 - Redistribute within a region, from agency with most bandwidth to least bandwidth
+    distrib_within_regions(regions)
+
+    # Step 3 - Redistribute among neighboring regions, from region with most need to region with least need
+    transfers = distrib_btwn_regions(regions, True, verbose)
+
+    # Step 4 - Deal with remainder: Redistribute among regions, from region with most need to region with least need
+    return transfers + distrib_btwn_regions(regions, False, verbose)
+
+
+def run_scenario(inputs, scenario, mode="greedy"):
+    """
+    Allocates one scenario, in its own mode or else mode.  Returns the agencies' cur_tgt, in inputs.agency_rows order,
+    and the total overage left unallocated.
+    """
+    regions = build_regions(inputs, scenario)
+    allocate(regions, scenario.mode or mode, verbose=False)
+
+    # agencies were added to their regions in agency_rows order
+    agencies = dict((region_id, iter(region.agencies)) for region_id, region in regions.items())
+    cur_tgts = [next(agencies[row[0]]).cur_tgt for row in inputs.agency_rows]
+    return cur_tgts, sum(region.overage for region in regions.values())
+
+
+def run_scenario_job(args):
+    """ Pool worker for run_scenarios. """
+    return run_scenario(*args)
+
+
+def run_scenarios(inputs, scenarios, processes=1, mode="greedy"):
+    """ Runs the scenarios, in a pool of processes if processes > 1; returns run_scenario's results, in order. """
+    jobs = [(inputs, scenario, mode) for scenario in scenarios]
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            return pool.map(run_scenario_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return map(run_scenario_job, jobs)
+
+
+def read_scenarios(path):
+    """
+    Reads scenarios from a CSV with a header row and rows of scenario name, change, id, value, where change is
+    capacity, target, close, region_target, region_demand or mode.  Agency ids are "ch_id" or "region_id:ch_id"; close
+    takes no value, and for mode the id is the mode.  Scenarios are returned in the order they first appear.
+    """
+    scenarios = []
+    by_name = dict()
+    with open(path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header row
+        next(reader, None)
+
+        for row in reader:
+            if not row or row[0] == "":
                 continue
+            name, change, key = row[0], row[1], row[2]
+            value = str_to_int(row[3]) if len(row) > 3 else None
+
+            if name not in by_name:
+                by_name[name] = Scenario(name)
+                scenarios.append(by_name[name])
+            scenario = by_name[name]
+
+            if change in ("region_target", "region_demand"):
+                key = int(key)
+            elif change != "mode" and ":" in key:
+                region_id, ch_id = key.split(":", 1)
+                key = (int(region_id), ch_id)
+
+            if change == "capacity":
+                scenario.capacities[key] = value
+            elif change == "target":
+                scenario.targets[key] = value
+            elif change == "close":
+                scenario.closed.add(key)
+            elif change == "region_target":
+                scenario.region_targets[key] = value
+            elif change == "region_demand":
+                scenario.region_demands[key] = value
+            elif change == "mode":
+                scenario.mode = key
+            else:
+                print("Unknown change %s in scenario %s" % (change, name))
+
+    return scenarios
+
+
+def write_scenario_table(path, inputs, scenarios, results):
+    """ Writes one row per agency: region, ch id, input target, then its cur_tgt in each scenario. """
+    with open(path, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["region", "ch_id", "init_tgt"] + [scenario.name for scenario in scenarios])
+        for k, (region_id, ch_id, tgt_pounds, capacity, meals_served) in enumerate(inputs.agency_rows):
+            writer.writerow([region_id, ch_id, tgt_pounds] + ["%d" % cur_tgts[k] for cur_tgts, unallocated in results])
+
+
+def write_targets(regions, verbose=False):
+    """ Step 5: prints region, ch id, input target, new target and capacity for every agency. """
+    for region in regions.values():
+        for agency in region.agencies:
+            print("%s,%s,%d,%d,%d" % (region.id, agency.ch_id, agency.init_tgt, agency.cur_tgt, agency.capacity))
+
+    for region in regions.values():
+        if verbose and region.overage > 0:
+            print("Region %d has unallocated overage of %d" % (region.id, region.overage))
+
+
+class TargetingConfig():
+    """
+    Settings for an AgencyTargeting session.  Each defaults to the module setting of the same name in upper case
+    (agency_input_file is AGENCY_INPUT_FILE, ...) as it is when the config is made.
+    """
+    SETTINGS = ["agency_input_file", "region_input_file", "puma_map_file", "verbose", "allocation_mode",
+                "scenario_file", "scenario_output_file", "scenario_processes"]
+
+    def __init__(self, **settings):
+        for name in self.SETTINGS:
+            setattr(self, name, globals()[name.upper()])
+        for name, value in settings.items():
+            if name not in self.SETTINGS:
+                raise TypeError("unknown targeting setting: %s" % name)
+            setattr(self, name, value)
+
+
+class AgencyTargeting():
+    """
+    Targeting as a library.  The input files are read the first time they're needed and kept, so a session can
+    allocate any number of scenarios (each on its own Regions) from one read.
+    """
+    def __init__(self, config=None):
+        self.config = config or TargetingConfig()
+        self.targeting_inputs = None
+
+    def inputs(self):
+        """ Step 1, once per session. """
+        if self.targeting_inputs is None:
+            self.targeting_inputs = read_inputs(self.config.agency_input_file, self.config.region_input_file,
+                                                self.config.puma_map_file)
+        return self.targeting_inputs
+
+    def allocate(self, scenario=None, mode=None, verbose=False):
+        """ Steps 2-4 for the scenario (or the inputs as they are); returns the allocated Regions and transfers. """
+        mode = (scenario and scenario.mode) or mode or self.config.allocation_mode
+        regions = build_regions(self.inputs(), scenario)
+        return regions, allocate(regions, mode, verbose)
+
+    def run_scenarios(self, scenarios):
+        """ run_scenarios over the config's processes and mode. """
+        return run_scenarios(self.inputs(), scenarios, self.config.scenario_processes, self.config.allocation_mode)
 
-            regions[region_id] = Region(region_id, region_to_demand[region_id], neighbor_map[region_id])
+# -------------------------------------------------------------
 
-        regions[region_id].add_agency(Agency(ch_id, tgt_pounds, capacity, meals_served))
+if __name__ == "__main__":
+    targeting = AgencyTargeting()
+    config = targeting.config
+
+    # Step 1 - Read input files
+    inputs = targeting.inputs()
+
+    if config.scenario_file:
+        # Steps 2-4 for every scenario, after the inputs as they are
+        scenarios = [Scenario("base")] + read_scenarios(config.scenario_file)
+        results = targeting.run_scenarios(scenarios)
+        write_scenario_table(config.scenario_output_file, inputs, scenarios, results)
+        for scenario, (cur_tgts, unallocated) in zip(scenarios, results):
+            print("Scenario %s has unallocated overage of %d" % (scenario.name, unallocated))
+    else:
+        if config.allocation_mode == "flow":
+            # Steps 2-4 all at once, with the greedy steps run on a copy to compare against
+            greedy_regions, greedy_transfers = targeting.allocate(mode="greedy")
+
+            regions, flow_transfers = targeting.allocate(mode="flow")
+            for source_id, target_id, lbs, neighbors in flow_transfers:
+                if config.verbose:
+                    print("Transferring %d lbs from region %d to %d -- neighbors? %s" %
+                          (lbs, source_id, target_id, str(neighbors)))
+
+            print_allocation_diffs(greedy_regions, regions, greedy_transfers, flow_transfers)
+        else:
+            regions, transfers = targeting.allocate(verbose=config.verbose)
 
-# Some regions don't have agencies.  Set the overage for those regions appropriately.
-regions_wo_agencies = set(region_to_target.keys()) - set(regions.keys())
-for region_id in regions_wo_agencies:
-    if region_id not in neighbor_map:
-        print("Could not find region->neighbor mapping for region %d" % region_id)
-        continue
-
-    regions[region_id] = Region(region_id, region_to_demand[region_id], neighbor_map[region_id])
-    regions[region_id].overage = region_to_target[region_id]
-
-# Step 2 - Redistribute within a region, from agency with most bandwidth to least bandwidth
-for region in regions.values():
-    #todo Move this to Region method?
-    overage = 0
-    for agency in region.agencies:
-        if agency.get_overage() > 0:
-            overage += agency.get_overage()
-            agency.cur_tgt = agency.capacity
-
-    if overage > 0:
-        region.overage = region.distrib_overage(overage)
-
-# Step 3 - Redistribute among neighboring regions, from region with most need to region with least need
-distrib_btwn_regions(True)
-
-# Step 4 - Deal with remainder: Redistribute among regions, from region with most need to region with least need
-distrib_btwn_regions(False)
-
-# Step 5 - Output
-for region in regions.values():
-    for agency in region.agencies:
-        print("%s,%s,%d,%d,%d" % (region.id, agency.ch_id, agency.init_tgt, agency.cur_tgt, agency.true_capacity))
-
-for region in regions.values():
-    if VERBOSE and region.overage > 0:
-        print("Region %d has unallocated overage of %d" % (region.id, region.overage))
+        # Step 5 - Output
+        write_targets(regions, config.verbose)
@@ -0,0 +1,514 @@
+#!/usr/bin/python
+import random
+import time
+import csv
+import os
+import sys
+import json
+import multiprocessing
+import cPickle as pickle
+import platform
+import resource
+import shutil
+import tempfile
+
+from collections import defaultdict
+
+import agency_targeting
+import feednyc
+
+# -----------------------------------------------------------------------------
+# Benchmarks for feednyc.py, run on synthetic data.
+#
+#   python benchmarks.py [results.json]
+#
+# Each STEP of feednyc.py (and each loader mode and filter) is timed on generated inputs of every size in
+# BENCH_SIZES, and agency_targeting.py's redistribution on every size in TARGETING_SIZES.  Results go to
+# BENCH_RESULTS_FILE as JSON so runs of different versions can be compared.
+# -----------------------------------------------------------------------------
+
+BENCH_SIZES = [(500, 2), (2000, 3)]  # (agencies, fiscal years of monthly data)
+BENCH_FIRST_FY = 2012
+BENCH_RESULTS_FILE = "bench-results.json"
+
+SIMILAR_AGENCIES = 20
+SIMILAR_MONTHS = 600
+SIMILAR_SETTINGS = [(3, 0, 0), (3, 5, 0), (3, 0, 0.05)]  # (sensitivity, absThresh, relThresh)
+
+# (regions, agencies): citywide (NYC's 55 community district PUMAs), then bigger to show how it scales
+TARGETING_SIZES = [(55, 1100), (550, 11000), (1100, 22000)]
+FLOW_SIZES = [(55, 1100), (550, 11000)]
+
+# -----------------------------------------------------------------------------
+
+
+class QuadraticSimilarFilter(feednyc.SimilarFilter):
+    """ The original SimilarFilter window search, which checks every total against every other total. """
+
+    def filter_efro(self, efro, efroSet, profile=None):
+        histo = defaultdict(int)
+        totServed2data = defaultdict(list)
+        for month, datum in efroSet.items():
+            totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
+            if totServed == 0:
+                continue
+            histo[totServed] += 1
+            totServed2data[totServed].append(datum)
+
+        totServedSet = set(histo.keys())
+        badTotServed = set()
+        prevErrors = defaultdict(int)
+        for totServed, count in histo.items():
+            thresh = max(self.ABS_THRESH, self.REL_THRESH * totServed)
+
+            curBadTotServed = set()
+            for n in filter(lambda x: abs(x - totServed) <= thresh, totServedSet):
+                curBadTotServed.add(n)
+
+            if count >= self.SENSITIVITY:
+                got_printable_entry = False
+                for tot in curBadTotServed:
+                    for datum in totServed2data[tot]:
+                        history = self.history_flag(efro, datum.sampleMonth)
+                        if history:
+                            prevErrors[datum.sampleMonth] += 1
+                        if history is not None and not self.filter_by_date(datum.sampleMonth):
+                            got_printable_entry = True
+
+                if got_printable_entry:
+                    badTotServed.update(curBadTotServed)
+
+        for n in badTotServed:
+            for d in totServed2data[n]:
+                self.flag_record(efro, d.sampleMonth, self.PREV_ERROR_FLAG * prevErrors[d.sampleMonth] +
+                                 (self.CONTEXT_FLAG if self.filter_by_date(d.sampleMonth) else self.REAL_DATA_FLAG))
+
+
+def months_from(first_month, count):
+    """ Returns count consecutive YYYYMM months starting at first_month. """
+    year, month = divmod(first_month, 100)
+    months = []
+    for i in xrange(count):
+        months.append(year * 100 + month)
+        month += 1
+        if month > 12:
+            year += 1
+            month = 1
+    return months
+
+
+def make_datum(efro, month):
+    datum = feednyc.FeedNYCDatum()
+    datum.efro = efro
+    datum.name = "Agency %d" % efro
+    datum.sampleMonth = month
+    datum.mealFactor = 9
+    datum.agencyType = "Food Pantry"
+    return datum
+
+
+def make_agency_data(num_agencies, num_months, first_month=199001, seed=0):
+    """ Builds an efro -> month -> FeedNYCDatum dict of random, fairly repetitive agency data. """
+    rand = random.Random(seed)
+    data = defaultdict(dict)
+    for efro in xrange(80000, 80000 + num_agencies):
+        base = rand.randint(50, 2000)
+        for month in months_from(first_month, num_months):
+            datum = make_datum(efro, month)
+            # agencies often report the same handful of numbers
+            if rand.random() < 0.3:
+                datum.elderlyServed = datum.adultsServed = datum.childrenServed = base / 3
+            else:
+                datum.elderlyServed = rand.randint(0, base)
+                datum.adultsServed = rand.randint(0, base)
+                datum.childrenServed = rand.randint(0, base)
+            data[efro][month] = datum
+    return data
+
+
+def write_synthetic_inputs(data_dir, num_agencies, num_years, first_fy=BENCH_FIRST_FY, seed=0):
+    """
+    Writes a synthetic FeedNYC-All-<FY>.pickle for each fiscal year plus an EFRO map, active-agency list, defunct
+    list and error history, laid out like the real inputs.  The pickles also hold as many agencies again that aren't
+    in the EFRO map, like the citywide dump.  Returns (first month, last month, number of pickled records).
+    """
+    rand = random.Random(seed)
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    efros = range(80000, 80000 + num_agencies)
+    # two programs (EFROs) per CH account
+    accounts = dict((efro, i / 2) for i, efro in enumerate(efros))
+    types = dict((efro, rand.choice(["Food Pantry", "Soup Kitchen"])) for efro in efros)
+    years = range(first_fy, first_fy + num_years)
+
+    with open(os.path.join(data_dir, "efro-map.csv"), 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Active EFROS"])
+        writer.writerow(["EFRO ID", "Account Number (Agency)", "Agency Alias (Agency)", "Agency", "Program Type"])
+        for efro in efros:
+            acct = accounts[efro]
+            writer.writerow([efro, "R%d" % acct, "BK%d" % acct, "Agency %d" % acct, types[efro]])
+
+    with open(os.path.join(data_dir, "active-agencies.csv"), 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Alias", "ID", "Name", "Year"])
+        for acct in sorted(set(accounts.values())):
+            for year in years:
+                if rand.random() < 0.95:
+                    writer.writerow(["BK%d" % acct, "(R%d)" % acct, "Agency %d" % acct, "FY%d" % (year % 100)])
+
+    with open(os.path.join(data_dir, "defunct-agencies.csv"), 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["EFRO"])
+        for efro in rand.sample(efros, num_agencies / 100):
+            writer.writerow([efro])
+
+    history = []
+    num_records = 0
+    for year in years:
+        # FYxx runs from July of xx-1 through June of xx
+        months = months_from((year - 1) * 100 + 7, 12)
+        records = []
+        for efro in efros + range(90000, 90000 + num_agencies):
+            base = rand.randint(30, 1500)
+            for month in months:
+                if rand.random() < 0.03:
+                    continue
+                if rand.random() < 0.2:
+                    served = (base / 3, base / 3, base / 3)
+                elif rand.random() < 0.02:
+                    served = (0, 0, 0)
+                else:
+                    served = (rand.randint(0, base), rand.randint(0, base), rand.randint(0, base))
+                mealFactor = 9 if rand.random() < 0.98 else 3
+                records.append((efro, "Agency %d" % efro, "EFP", "%d Main St" % efro, "01", "BK", str(month))
+                               + served + (mealFactor, "2014-01-01", "user"))
+                if efro < 90000 and rand.random() < 0.05:
+                    history.append(("%d-%d" % (efro, month), rand.choice(["zeros", "outlier", "too-similar"]),
+                                    rand.choice("yn")))
+        rand.shuffle(records)
+        num_records += len(records)
+        with open(os.path.join(data_dir, "FeedNYC-All-%d.pickle" % year), 'wb') as pickleFile:
+            pickle.dump(records, pickleFile)
+
+    with open(os.path.join(data_dir, "error-history.csv"), 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["ID", "Flag", "Print"])
+        writer.writerows(history)
+
+    return (first_fy - 1) * 100 + 7, (first_fy + num_years - 1) * 100 + 6, num_records
+
+
+def greedy_distrib_overage(region, distrib_amt):
+    """ The original Region.distrib_overage, which filters and sorts the region's agencies on every call. """
+    available_agencies = filter(lambda x: x.get_overage() < 0, region.agencies)
+    for tgt_agency in sorted(available_agencies, key=lambda x: x.bandwidth, reverse=True):
+        amt = min(distrib_amt, tgt_agency.get_capacity())
+        tgt_agency.cur_tgt += amt
+        distrib_amt -= amt
+        if distrib_amt <= 0:
+            break
+    return distrib_amt
+
+
+def greedy_distrib_btwn_regions(regions, restrict_to_neighbors):
+    """ The original distrib_btwn_regions, which filters all the available regions for every source region. """
+    available_regions = filter(lambda x: x.overage == 0, regions.values())
+    available_regions = sorted(available_regions, key=lambda x: x.ef_demand, reverse=True)
+    available_regions = map(lambda x: x.id, available_regions)
+
+    regions_w_overage = filter(lambda x: x.overage > 0, regions.values())
+    for source_region in sorted(regions_w_overage, key=lambda x: x.overage, reverse=True):
+        if restrict_to_neighbors:
+            target_region_set = filter(lambda x: x in source_region.neighboring_regions, available_regions)
+        else:
+            target_region_set = available_regions
+
+        for target_region_id in target_region_set:
+            source_region.overage = greedy_distrib_overage(regions[target_region_id], source_region.overage)
+            if source_region.overage == 0:
+                break
+
+
+def greedy_distribute(regions):
+    for region in regions.values():
+        overage = 0
+        for agency in region.agencies:
+            if agency.get_overage() > 0:
+                overage += agency.get_overage()
+                agency.cur_tgt = agency.capacity
+        if overage > 0:
+            region.overage = greedy_distrib_overage(region, overage)
+    greedy_distrib_btwn_regions(regions, True)
+    greedy_distrib_btwn_regions(regions, False)
+
+
+def heap_distribute(regions):
+    agency_targeting.distrib_within_regions(regions)
+    agency_targeting.distrib_btwn_regions(regions, True)
+    agency_targeting.distrib_btwn_regions(regions, False)
+
+
+def make_regions(num_regions, num_agencies, seed=0):
+    """
+    Builds region_id -> Region for a synthetic city: each region borders a few regions with nearby ids, and the
+    agencies' targets are spread around their capacities so some regions have food to give and some have room.  A few
+    regions have no agencies, so their whole target is overage.
+    """
+    rng = random.Random(seed)
+    ids = range(1001, 1001 + num_regions)
+
+    neighbors = dict((region_id, set()) for region_id in ids)
+    for k, region_id in enumerate(ids):
+        for other in rng.sample(ids[max(0, k - 6):k + 7], min(4, num_regions)):
+            if other != region_id:
+                neighbors[region_id].add(other)
+                neighbors[other].add(region_id)
+
+    regions = dict()
+    for region_id in ids:
+        regions[region_id] = agency_targeting.Region(region_id, rng.randint(0, 50) * 1000, neighbors[region_id])
+
+    empty = set(rng.sample(ids, max(1, num_regions / 20)))
+    for region_id in empty:
+        regions[region_id].overage = rng.randint(1, 40) * 500
+
+    with_agencies = [region_id for region_id in ids if region_id not in empty]
+    for k in xrange(num_agencies):
+        capacity = rng.randint(10, 400) * 100
+        tgt = int(capacity * rng.uniform(0.5, 1.6))
+        bandwidth = rng.randint(1, 60) * 50  # plenty of ties
+        regions[rng.choice(with_agencies)].add_agency(agency_targeting.Agency("CH%05d" % k, tgt, capacity, bandwidth))
+    return regions
+
+
+def allocations(regions):
+    return [(region_id, regions[region_id].overage, [agency.cur_tgt for agency in regions[region_id].agencies])
+            for region_id in sorted(regions)]
+
+
+def bench_agency_targeting(results):
+    """ Compares the heap-based redistribution with the original greedy passes, for speed and identical targets. """
+    agency_targeting.VERBOSE = False
+    print "agency targeting redistribution"
+    print "%-20s%12s%12s%10s%10s" % ("regions x agencies", "greedy", "heap", "speedup", "same")
+    for num_regions, num_agencies in TARGETING_SIZES:
+        timings = []
+        outputs = []
+        for distribute in (greedy_distribute, heap_distribute):
+            regions = make_regions(num_regions, num_agencies)
+            start = time.time()
+            distribute(regions)
+            timings.append(time.time() - start)
+            outputs.append(allocations(regions))
+
+        same = outputs[0] == outputs[1]
+        print "%-20s%11.3fs%11.3fs%9.1fx%10s" % ("%d x %d" % (num_regions, num_agencies), timings[0], timings[1],
+                                                 timings[0] / max(timings[1], 1e-9), same)
+        results.append({'stage': "targeting-greedy-vs-heap",
+                        'regions': num_regions,
+                        'agencies': num_agencies,
+                        'greedy_s': round(timings[0], 4),
+                        'heap_s': round(timings[1], 4),
+                        'same_output': same})
+
+
+def moved_to_neighbors(regions, transfers):
+    return sum(lbs for source_id, target_id, lbs, neighbors in transfers
+               if target_id in regions[source_id].neighboring_regions)
+
+
+def bench_min_cost_flow(results):
+    """ Times the min-cost flow allocation against the greedy one, and how much each places and keeps nearby. """
+    agency_targeting.VERBOSE = False
+    print "min-cost flow allocation"
+    print "%-20s%12s%12s%14s%14s%14s%14s" % ("regions x agencies", "greedy", "flow", "unplaced", "unplaced flow",
+                                             "to neighbors", "nbrs flow")
+    for num_regions, num_agencies in FLOW_SIZES:
+        regions = make_regions(num_regions, num_agencies)
+        start = time.time()
+        agency_targeting.distrib_within_regions(regions)
+        greedy_transfers = agency_targeting.distrib_btwn_regions(regions, True) + \
+            agency_targeting.distrib_btwn_regions(regions, False)
+        greedy_time = time.time() - start
+        greedy = (sum(region.overage for region in regions.values()), moved_to_neighbors(regions, greedy_transfers))
+
+        regions = make_regions(num_regions, num_agencies)
+        start = time.time()
+        flow_transfers = agency_targeting.distrib_min_cost_flow(regions)
+        flow_time = time.time() - start
+        flow = (sum(region.overage for region in regions.values()), moved_to_neighbors(regions, flow_transfers))
+
+        print "%-20s%11.3fs%11.3fs%14d%14d%14d%14d" % ("%d x %d" % (num_regions, num_agencies), greedy_time,
+                                                       flow_time, greedy[0], flow[0], greedy[1], flow[1])
+        results.append({'stage': "targeting-greedy-vs-flow",
+                        'regions': num_regions,
+                        'agencies': num_agencies,
+                        'greedy_s': round(greedy_time, 4),
+                        'flow_s': round(flow_time, 4),
+                        'greedy_unplaced': greedy[0],
+                        'flow_unplaced': flow[0],
+                        'greedy_to_neighbors': greedy[1],
+                        'flow_to_neighbors': flow[1]})
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(results, stage, size, fn, records=None):
+    """
+    Runs fn() with its output thrown away, appends a result row for it to results and returns fn's value.  records
+    is the number of records the stage works through (or a function of fn's value that returns it).
+    """
+    stdout = sys.stdout
+    rss_before = peak_rss_kb()
+    cpu_before = sum(os.times()[:2])
+    start = time.time()
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        value = fn()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    wall = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu_before
+
+    if callable(records):
+        records = records(value)
+    result = {'stage': stage,
+              'agencies': size[0],
+              'years': size[1],
+              'wall_s': round(wall, 4),
+              'cpu_s': round(cpu, 4),
+              'peak_rss_kb': peak_rss_kb(),
+              'peak_rss_growth_kb': peak_rss_kb() - rss_before,
+              'records': records,
+              'records_per_s': int(records / wall) if records and wall > 0 else None}
+    results.append(result)
+    print "%-28s%6d x %d%10.3fs%10.3fs%12d%14s" % (stage, size[0], size[1], wall, cpu, result['peak_rss_kb'],
+                                                   result['records_per_s'] or "")
+    return value
+
+
+def bench_steps(results, size):
+    """ Times STEPs 1-6 of feednyc.py, each loader mode and each filter on synthetic data of the given size. """
+    data_dir = tempfile.mkdtemp(prefix="feednyc-bench-")
+    try:
+        first_month, last_month, num_records = write_synthetic_inputs(data_dir, *size)
+        path = lambda name: os.path.join(data_dir, name)
+
+        feednyc.FEEDNYC_PICKLE_DIR = data_dir + "/"
+        feednyc.FEEDNYC_EXPORT_FORMAT = "pickle"
+        feednyc.ANALYSIS_MIN, feednyc.ANALYSIS_MAX = first_month, last_month
+        # output the last fiscal year
+        feednyc.OUTPUT_MIN, feednyc.OUTPUT_MAX = (last_month / 100 - 1) * 100 + 7, last_month
+        analysis_range_cy, analysis_range_fy = feednyc.get_years_in_range(feednyc.ANALYSIS_MIN, feednyc.ANALYSIS_MAX)
+        output_range_cy, output_range_fy = feednyc.get_years_in_range(feednyc.OUTPUT_MIN, feednyc.OUTPUT_MAX)
+
+        chAcct2efro, efro2data = measure(results, "step1-efro-map", size,
+                                         lambda: feednyc.read_efro_map(path("efro-map.csv")), size[0])
+        goodEFROs = measure(results, "step2-active-agencies", size,
+                            lambda: feednyc.read_active_agencies(path("active-agencies.csv"), output_range_fy,
+                                                                 chAcct2efro, efro2data), size[0] * size[1] / 2)
+        goodEFROs -= measure(results, "step3-defunct-agencies", size,
+                             lambda: feednyc.read_defunct_agencies(path("defunct-agencies.csv")), size[0] / 100)
+
+        # the same again through the reference data cache: once to fill it, then warm
+        refcache_dir = path("refcache")
+        for stage in ("cache-cold", "cache-warm"):
+            measure(results, "step1-3-reference-" + stage, size,
+                    lambda: (feednyc.read_efro_map(path("efro-map.csv"), refcache_dir),
+                             feednyc.read_active_agencies(path("active-agencies.csv"), output_range_fy,
+                                                          chAcct2efro, efro2data, refcache_dir),
+                             feednyc.read_defunct_agencies(path("defunct-agencies.csv"), refcache_dir)),
+                    size[0] + size[0] * size[1] / 2)
+
+        load = lambda processes, cache_dir: feednyc.load_feednyc_data(analysis_range_fy, goodEFROs, efro2data,
+                                                                       processes, cache_dir)
+        cache_dir = path("cache")
+        fnData = measure(results, "step4-load-serial", size, lambda: load(1, None), num_records)
+        measure(results, "step4-load-parallel", size, lambda: load(len(analysis_range_fy), None), num_records)
+        measure(results, "step4-load-cache-cold", size, lambda: load(1, cache_dir), num_records)
+        measure(results, "step4-load-cache-warm", size, lambda: load(1, cache_dir), num_records)
+        measure(results, "step4-store-convert", size,
+                lambda: [feednyc.convert_feednyc_store(path("FeedNYC-All-%d.pickle" % year))
+                         for year in analysis_range_fy], num_records)
+        measure(results, "step4-load-store", size,
+                lambda: feednyc.load_feednyc_data(analysis_range_fy, goodEFROs, efro2data, export_format="store"),
+                num_records)
+
+        history = feednyc.ErrorHistory()
+        measure(results, "step5-error-history", size, lambda: history.load(path("error-history.csv")),
+                sum(1 for line in open(path("error-history.csv"))) - 1)
+
+        # each filter on its own, then all of them in one pass, then the output
+        records = fnData.record_count()
+        for f in feednyc.make_filters(history=history):
+            measure(results, "step6-filter-" + f.filter_flag, size, lambda: f.filter(fnData), records)
+        pipeline = feednyc.FilterPipeline(feednyc.make_filters(history=history))
+        measure(results, "step6-pipeline", size, lambda: pipeline.run(fnData), records)
+        measure(results, "step6-print", size, pipeline.print_bad_data,
+                sum(len(bd) for f in pipeline.filters for bd in f.badData.values()))
+        sharded = feednyc.FilterPipeline(feednyc.make_filters(history=history))
+        measure(results, "step6-pipeline-sharded", size,
+                lambda: sharded.run_sharded(fnData, multiprocessing.cpu_count()), records)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def run_filter(filter_class, data, settings):
+    f = filter_class(*settings)
+    start = time.time()
+    f.filter(data)
+    elapsed = time.time() - start
+    output = [(efro, month, f.records.flag_letters(f.filter_flag, efro, month))
+              for efro in sorted(f.badData) for month in f.badData[efro]]
+    return elapsed, output
+
+
+def bench_similar_filter(results):
+    """ Compares SimilarFilter with the original quadratic window search, for speed and identical output. """
+    # the filters only look at the output window to decide whether to flag, so make it cover everything
+    months = months_from(199001, SIMILAR_MONTHS)
+    feednyc.OUTPUT_MIN, feednyc.OUTPUT_MAX = months[0], months[-1]
+
+    data = make_agency_data(SIMILAR_AGENCIES, SIMILAR_MONTHS)
+    print "SimilarFilter: %d agencies x %d months" % (SIMILAR_AGENCIES, SIMILAR_MONTHS)
+    print "%-20s%12s%12s%10s%10s" % ("settings", "quadratic", "windowed", "speedup", "same")
+    for settings in SIMILAR_SETTINGS:
+        old_time, old_output = run_filter(QuadraticSimilarFilter, data, settings)
+        new_time, new_output = run_filter(feednyc.SimilarFilter, data, settings)
+        print "%-20s%11.3fs%11.3fs%9.1fx%10s" % (settings, old_time, new_time, old_time / max(new_time, 1e-9),
+                                                 old_output == new_output)
+        results.append({'stage': "similar-quadratic-vs-windowed",
+                        'agencies': SIMILAR_AGENCIES,
+                        'months': SIMILAR_MONTHS,
+                        'settings': settings,
+                        'quadratic_s': round(old_time, 4),
+                        'windowed_s': round(new_time, 4),
+                        'same_output': old_output == new_output})
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    results_file = sys.argv[1] if len(sys.argv) > 1 else BENCH_RESULTS_FILE
+    results = []
+
+    print "%-28s%10s%11s%10s%12s%14s" % ("stage", "size", "wall", "cpu", "peak rss kb", "records/s")
+    for size in BENCH_SIZES:
+        bench_steps(results, size)
+    print ""
+    bench_similar_filter(results)
+    print ""
+    bench_agency_targeting(results)
+    print ""
+    bench_min_cost_flow(results)
+
+    with open(results_file, 'w') as resultsFile:
+        json.dump({'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'results': results}, resultsFile, indent=1, sort_keys=True)
+    print "\nwrote %s" % results_file
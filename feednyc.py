@@ -1,15 +1,28 @@
 #!/usr/bin/python
-import pickle
+import cPickle as pickle
 import csv
 import math
-import copy
-
-from collections import defaultdict
+import bisect
+import multiprocessing
+import os
+import glob
+import struct
+import hashlib
+import json
+import mmap
+import sys
+import time
+
+from array import array
+from collections import OrderedDict, defaultdict
+from itertools import compress, izip
+
+import instrument
+import refdata
+import taskgraph
 
 # -----------------------------------------------------------------------------
 
-#todo Make prev error file accept flags for dates
-
 #todo Make sure we have all EFROs for a given account
 #todo Figure out where FeedNYC's notion of CH agencies differs from CH's POV.
 
@@ -55,61 +68,804 @@ SIMILAR_THRESH_REL = 0
 
 OUTLIER_MAX_STDDEV = 2.0
 
+# Incremental mode: set to a path to keep per-EFRO running totals between runs.  The first run (no state file yet)
+# is a normal run that also creates the file; after that, set the analysis/output window to just the new month(s)
+# and only their records are processed and flagged.  Months already in the state are skipped.
+INCREMENTAL_STATE_FILE = None
+
+# number of processes used to read the fiscal-year pickles (1 reads them one at a time in this process)
+LOADER_PROCESSES = 1
+# number of threads STEPs 1-5 run on at startup: with more than 1, each step starts as soon as the ones it needs are
+# done, so the error history and defunct list are read while the pickles load (1 runs them one at a time, in the usual
+# order).  With FEEDNYC_INSTRUMENT set, when each ran and the critical path are reported on stderr.
+STARTUP_THREADS = 1
+# number of processes the STEP 6 filters run in, each filtering a share of the EFROs (1 filters in this process)
+FILTER_PROCESSES = 1
+
 # -------
 
 FEEDNYC_PICKLE_DIR = '/Users/patrickmauro/code/ch/pickles/'
+# FeedNYC-All-<FY>.<format> files in FEEDNYC_PICKLE_DIR: "pickle" (a single pickled list, or a chunked stream
+# written by write_feednyc_stream), "csv" (one record per row, in pickle tuple order, with a header row) or "store"
+# (partitioned by EFRO, so only the active agencies' records are read; convert_feednyc_store writes one from either)
+FEEDNYC_EXPORT_FORMAT = "pickle"
+FEEDNYC_STREAM_CHUNK = 10000
+# parsed, EFRO-filtered copies of the pickles and parsed reference CSVs; set to None to always read the originals
+FEEDNYC_CACHE_DIR = FEEDNYC_PICKLE_DIR + 'cache/'
 ACTIVE_AGENCY_CSV = "/Users/patrickmauro/code/ch/active-agencies.csv"
 EFRO_MAP_CSV = "/Users/patrickmauro/code/ch/efro-map.csv"
 
 DEFUNCT_AGENCIES_CSV = "/Users/patrickmauro/code/ch/defunct-agencies.csv"
 ERROR_HISTORY_CSV = "/Users/patrickmauro/code/ch/error-history.csv"
 
+# Where the filter output goes, and what REPORT_PATH is for each REPORT_FORMAT:
+#   "stdout"        CSV on stdout, as always; REPORT_PATH isn't used
+#   "csv"           the same CSV, in the file REPORT_PATH
+#   "csv-per-flag"  REPORT_PATH is a directory that gets one <flag>.csv per filter, each with the header
+#   "jsonl"         REPORT_PATH is a file with one JSON object per row
+REPORT_FORMAT = "stdout"
+REPORT_PATH = None
+# "per-flag" (a row for each filter that flagged a record) or "per-record" (one row per record, listing every filter
+# that flagged it, e.g. error_type "zeros+outlier")
+REPORT_ROWS = "per-flag"
+# rows buffered before each write
+REPORT_BATCH = 1000
+
+# Per-stage timing: set FEEDNYC_INSTRUMENT=1 to get a table of each stage's wall/CPU time, records in/out and peak
+# memory growth on stderr after the run.  FEEDNYC_PROFILE_STAGE names a stage from the table to run under cProfile;
+# its stats go to FEEDNYC_PROFILE_PATH (a pstats file), or after the table if that isn't set.
+INSTRUMENT_STAGES = bool(os.environ.get("FEEDNYC_INSTRUMENT"))
+PROFILE_STAGE = os.environ.get("FEEDNYC_PROFILE_STAGE")
+PROFILE_PATH = os.environ.get("FEEDNYC_PROFILE_PATH")
+
+# Batch mode: set to a list of (analysis min, analysis max, output min, output max) windows, e.g. each month of a
+# fiscal year, to load the data once (for the union of the analysis ranges) and report on every window.  Each
+# window's report goes to its own file in BATCH_REPORT_DIR, in REPORT_FORMAT ("stdout" and "csv" write CSV files).
+# ANALYSIS_*, OUTPUT_* and INCREMENTAL_STATE_FILE aren't used in batch mode.
+BATCH_WINDOWS = None
+BATCH_REPORT_DIR = None
+
+# -----------------------------------------------------------------------------
+# Months
+
+
+def month_index(month):
+    """ YYYYMM -> months since January of year 0, so the months between two months is a subtraction. """
+    return (month // 100) * 12 + month % 100 - 1
+
+
+def index_month(index):
+    """ The YYYYMM month of a month_index. """
+    return (index // 12) * 100 + index % 12 + 1
+
+
+def months_between(begin, end):
+    """ The YYYYMM months in [begin, end], in order. """
+    return [index_month(i) for i in xrange(month_index(begin), month_index(end) + 1)]
+
 # -----------------------------------------------------------------------------
 # Classes
 
 # meal factor should be 9 or 1
 
-class FeedNYCDatum:
+class FeedNYCDatum(object):
+    COLUMNS = ("efro-month_id", "name", "efro", "month", "elderly_served", "adults_served", "children_served",
+               "meal_factor", "total_meals_served", "agency_type", "flag")
+    # the fields of a FeedNYC record tuple, in order
+    FIELDS = ('efro', 'name', 'type', 'address', 'district', 'boro', 'sampleMonth', 'elderlyServed', 'adultsServed',
+              'childrenServed', 'mealFactor', 'updateDate', 'updateUser')
+    __slots__ = FIELDS + ('agencyType', 'flag')
+
     def __init__(self, pickle_tuple=None):
-        if pickle_tuple != None:
-            self.efro = pickle_tuple[0]
-            self.name = pickle_tuple[1]
-            self.type = pickle_tuple[2]
-            self.address = pickle_tuple[3]
-            self.district = pickle_tuple[4]
-            self.boro = pickle_tuple[5]
-            self.sampleMonth = int(pickle_tuple[6])
-            self.elderlyServed = pickle_tuple[7]
-            self.adultsServed = pickle_tuple[8]
-            self.childrenServed = pickle_tuple[9]
-            self.mealFactor = pickle_tuple[10]
-            self.updateDate = pickle_tuple[11]
-            self.updateUser = pickle_tuple[12]
+        if pickle_tuple is not None:
+            (self.efro, self.name, self.type, self.address, self.district, self.boro, sampleMonth, self.elderlyServed,
+             self.adultsServed, self.childrenServed, self.mealFactor, self.updateDate, self.updateUser) = \
+                pickle_tuple[:13]
+            self.sampleMonth = int(sampleMonth)
 
         self.agencyType = ""
         self.flag = ""
 
+    def flagged(self, flag):
+        """ A copy of this datum with the given flag letters (this one is left as it is). """
+        datum = FeedNYCDatum.__new__(FeedNYCDatum)
+        for name in self.__slots__:
+            # datums made by hand may not set every field
+            if hasattr(self, name):
+                setattr(datum, name, getattr(self, name))
+        datum.flag = flag
+        return datum
+
     def print_header(self):
-        return "efro-month_id,name,efro,month,elderly_served,adults_served,children_served,meal_factor," \
-               "total_meals_served,agency_type,flag,"
+        return ",".join(self.COLUMNS) + ","
+
+    def report_values(self):
+        """ The values of COLUMNS for this datum. """
+        total = (self.elderlyServed + self.adultsServed + self.childrenServed) * self.mealFactor
+
+        return ("%s-%s" % (self.efro, self.sampleMonth), self.name, self.efro,
+                "%02d-%d" % (self.sampleMonth % 100, int(self.sampleMonth / 100)), self.elderlyServed,
+                self.adultsServed, self.childrenServed, self.mealFactor, total, self.agencyType, self.flag)
 
     def __str__(self):
         total = (self.elderlyServed + self.adultsServed + self.childrenServed) * self.mealFactor
 
-        return "%(id)s,\"%(name)s\",%(efro)d,%(month)02d-%(year)d,%(elderly)d," \
-               "%(adult)d,%(children)d,%(factor)d,%(total)d,%(agencyType)s,%(flag)s," % \
-               {'id': str(self.efro) + "-" + str(self.sampleMonth),
-                'name': self.name,
-                'efro': self.efro,
-                'year': int(self.sampleMonth / 100),
-                'month': self.sampleMonth % 100,
-                'elderly': self.elderlyServed,
-                'adult': self.adultsServed,
-                'children': self.childrenServed,
-                'factor': self.mealFactor,
-                'total': total,
-                'agencyType': self.agencyType,
-                'flag': self.flag}
+        return "%s-%s,\"%s\",%d,%02d-%d,%d,%d,%d,%d,%d,%s,%s," % \
+               (self.efro, self.sampleMonth, self.name, self.efro, self.sampleMonth % 100, int(self.sampleMonth / 100),
+                self.elderlyServed, self.adultsServed, self.childrenServed, self.mealFactor, total, self.agencyType,
+                self.flag)
+
+
+class FeedNYCSeries:
+    """
+    Read-only month -> FeedNYCDatum view of one EFRO's records in a FeedNYCDataset.  Behaves like the per-EFRO
+    dicts in fnData, but datums are only built when they're asked for.
+    """
+    def __init__(self, dataset, start, end):
+        self.dataset = dataset
+        self.start = start
+        self.end = end
+        self._rowIndex = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, month):
+        return self._find(month) is not None
+
+    def __getitem__(self, month):
+        i = self._find(month)
+        if i is None:
+            raise KeyError(month)
+        return self.dataset.datum(i)
+
+    def _find(self, month):
+        i = bisect.bisect_left(self.dataset.sampleMonth, month, self.start, self.end)
+        if i < self.end and self.dataset.sampleMonth[i] == month:
+            return i
+        return None
+
+    def rows(self):
+        return xrange(self.start, self.end)
+
+    def between(self, min_month, max_month):
+        """ The narrower view of just this series' months in [min_month, max_month]. """
+        start = bisect.bisect_left(self.dataset.sampleMonth, min_month, self.start, self.end)
+        end = bisect.bisect_right(self.dataset.sampleMonth, max_month, start, self.end)
+        return FeedNYCSeries(self.dataset, start, end)
+
+    def keys(self):
+        return self.dataset.sampleMonth[self.start:self.end].tolist()
+
+    def row_index(self):
+        """
+        month -> record index, as a dict, so it iterates in the same order a month -> datum dict of the series would
+        (the order the filters have always seen the months in).
+        """
+        if self._rowIndex is None:
+            self._rowIndex = dict(izip(self.keys(), self.rows()))
+        return self._rowIndex
+
+    def column_items(self, column):
+        """ (month, value) pairs of one of the dataset's per-record columns, in row_index order; no datums built. """
+        return [(month, column[i]) for month, i in self.row_index().iteritems()]
+
+    def values(self):
+        return [self.dataset.datum(i) for i in self.rows()]
+
+    def items(self):
+        return [(self.dataset.sampleMonth[i], self.dataset.datum(i)) for i in self.rows()]
+
+
+class FeedNYCDataset:
+    """
+    Columnar efro -> month -> record store for FeedNYC data.
+
+    The numeric fields live in parallel arrays, one entry per record.  The descriptive strings (name, address, ...)
+    are the same month after month, so each distinct combination is stored once in infoTable and records just keep
+    an index into it.  Call finalize() once all records have been appended; after that the records are sorted by
+    (efro, month) and the dataset can be read like fnData (efro -> month -> FeedNYCDatum), with datums materialized
+    on demand.
+    """
+    INFO_FIELDS = ('name', 'type', 'address', 'district', 'boro', 'agencyType')
+    ARRAY_COLUMNS = ('efro', 'sampleMonth', 'elderlyServed', 'adultsServed', 'childrenServed', 'mealFactor', 'info')
+
+    def __init__(self):
+        self.efro = array('l')
+        self.sampleMonth = array('l')
+        self.elderlyServed = array('l')
+        self.adultsServed = array('l')
+        self.childrenServed = array('l')
+        self.mealFactor = array('l')
+        self.info = array('l')  # index into infoTable
+        self.updateDate = []
+        self.updateUser = []
+
+        self.infoTable = []  # list of INFO_FIELDS tuples
+        self._infoIndex = dict()  # INFO_FIELDS tuple -> index in infoTable
+
+        # filled in by finalize()
+        self.efros = array('l')  # sorted efros
+        self.starts = array('l', [0])  # records for efros[k] are in [starts[k], starts[k + 1])
+        self._groupIndex = dict()  # efro -> k
+        self._totals = None
+
+    def _intern_info(self, info):
+        idx = self._infoIndex.get(info)
+        if idx is None:
+            idx = len(self.infoTable)
+            self.infoTable.append(info)
+            self._infoIndex[info] = idx
+        return idx
+
+    def append_rows(self, rows, agencyType=""):
+        """ Appends a list of record tuples (e.g. from select_rows) a column at a time. """
+        self.efro.extend([row[0] for row in rows])
+        self.sampleMonth.extend([int(row[6]) for row in rows])
+        self.elderlyServed.extend([row[7] for row in rows])
+        self.adultsServed.extend([row[8] for row in rows])
+        self.childrenServed.extend([row[9] for row in rows])
+        self.mealFactor.extend([row[10] for row in rows])
+        self.updateDate.extend([row[11] for row in rows])
+        self.updateUser.extend([row[12] for row in rows])
+        intern = self._intern_info
+        self.info.extend([intern(tuple(row[1:6]) + (agencyType,)) for row in rows])
+
+    def extend(self, block, agencyTypes, min_month=None, max_month=None):
+        """
+        Appends the records of another, unfinalized dataset (e.g. one fiscal year from read_feednyc_pickle), setting
+        agencyType from the efro -> agencyType dict and optionally keeping only months in [min_month, max_month].
+        """
+        infoMap = dict()  # (block info index, agencyType) -> our info index
+        for i in xrange(len(block.efro)):
+            sampleMonth = block.sampleMonth[i]
+            if min_month is not None and (sampleMonth < min_month or sampleMonth > max_month):
+                continue
+
+            efro = block.efro[i]
+            agencyType = agencyTypes.get(efro, "")
+            key = (block.info[i], agencyType)
+            idx = infoMap.get(key)
+            if idx is None:
+                idx = infoMap[key] = self._intern_info(block.infoTable[block.info[i]][:-1] + (agencyType,))
+
+            self.efro.append(efro)
+            self.sampleMonth.append(sampleMonth)
+            self.elderlyServed.append(block.elderlyServed[i])
+            self.adultsServed.append(block.adultsServed[i])
+            self.childrenServed.append(block.childrenServed[i])
+            self.mealFactor.append(block.mealFactor[i])
+            self.updateDate.append(block.updateDate[i])
+            self.updateUser.append(block.updateUser[i])
+            self.info.append(idx)
+
+    def finalize(self):
+        """
+        Sorts the records by (efro, month) and builds the per-EFRO index.  If there's more than one record for an
+        efro/month, the last one appended wins (same as assigning into fnData).
+        """
+        order = sorted(xrange(len(self.efro)), key=lambda i: (self.efro[i], self.sampleMonth[i], i))
+
+        # keep the last record of each run of equal (efro, month) keys
+        keep = [i for pos, i in enumerate(order)
+                if pos + 1 == len(order) or
+                (self.efro[order[pos + 1]], self.sampleMonth[order[pos + 1]]) != (self.efro[i], self.sampleMonth[i])]
+
+        for name in self.ARRAY_COLUMNS:
+            col = getattr(self, name)
+            setattr(self, name, array(col.typecode, [col[i] for i in keep]))
+        self.updateDate = [self.updateDate[i] for i in keep]
+        self.updateUser = [self.updateUser[i] for i in keep]
+
+        self.efros = array('l')
+        self.starts = array('l')
+        for i, efro in enumerate(self.efro):
+            if not self.efros or self.efros[-1] != efro:
+                self.efros.append(efro)
+                self.starts.append(i)
+        self.starts.append(len(self.efro))
+        self._groupIndex = dict((efro, k) for k, efro in enumerate(self.efros))
+        self._totals = None
+
+    def slice(self, k0, k1):
+        """ A read-only dataset of its own with just the records of efros[k0:k1], e.g. to send to another process. """
+        start = self.starts[k0]
+        end = self.starts[k1]
+
+        part = FeedNYCDataset()
+        for name in self.ARRAY_COLUMNS:
+            setattr(part, name, getattr(self, name)[start:end])
+        part.updateDate = self.updateDate[start:end]
+        part.updateUser = self.updateUser[start:end]
+        part.infoTable = self.infoTable
+
+        part.efros = self.efros[k0:k1]
+        part.starts = array('l', [i - start for i in self.starts[k0:k1 + 1]])
+        part._groupIndex = dict((efro, k) for k, efro in enumerate(part.efros))
+        return part
+
+    def record_count(self):
+        return len(self.efro)
+
+    def totals(self):
+        """ Total served (children + adults + elderly) for every record, computed once. """
+        if self._totals is None:
+            self._totals = array('l', map(lambda c, a, e: c + a + e,
+                                          self.childrenServed, self.adultsServed, self.elderlyServed))
+        return self._totals
+
+    def groups(self):
+        """ Yields (efro, start, end) for each EFRO's block of records. """
+        for k, efro in enumerate(self.efros):
+            yield efro, self.starts[k], self.starts[k + 1]
+
+    def segment_sums(self, values):
+        """ Per-EFRO sums of a per-record column, in efros order. """
+        return [sum(values[self.starts[k]:self.starts[k + 1]]) for k in xrange(len(self.efros))]
+
+    def datum(self, i):
+        """ Builds a FeedNYCDatum for record i. """
+        datum = FeedNYCDatum()
+        datum.efro = self.efro[i]
+        datum.name, datum.type, datum.address, datum.district, datum.boro, datum.agencyType = \
+            self.infoTable[self.info[i]]
+        datum.sampleMonth = self.sampleMonth[i]
+        datum.elderlyServed = self.elderlyServed[i]
+        datum.adultsServed = self.adultsServed[i]
+        datum.childrenServed = self.childrenServed[i]
+        datum.mealFactor = self.mealFactor[i]
+        datum.updateDate = self.updateDate[i]
+        datum.updateUser = self.updateUser[i]
+        return datum
+
+    # dict-like access (efro -> FeedNYCSeries), so the filters can use a dataset in place of fnData
+    def __len__(self):
+        return len(self.efros)
+
+    def __iter__(self):
+        return iter(self.efros)
+
+    def __contains__(self, efro):
+        return efro in self._groupIndex
+
+    def __getitem__(self, efro):
+        k = self._groupIndex[efro]
+        return FeedNYCSeries(self, self.starts[k], self.starts[k + 1])
+
+    def keys(self):
+        return self.efros.tolist()
+
+    def values(self):
+        return [self[efro] for efro in self.efros]
+
+    def items(self):
+        return [(efro, self[efro]) for efro in self.efros]
+
+    def window(self, efros, min_month, max_month):
+        """
+        items() for just the given efros' records in [min_month, max_month].  EFROs with no records in the range are
+        left out.
+        """
+        items = []
+        for efro, series in self.items():
+            if efro in efros:
+                series = series.between(min_month, max_month)
+                if len(series):
+                    items.append((efro, series))
+        return items
+
+
+class ErrorHistory:
+    """
+    Decisions on previously reviewed errors: flag -> efro -> month -> doPrint, where doPrint says whether to keep
+    printing the error.  The "efro-month" ids in the history file are parsed once, when it's loaded.
+    """
+    def __init__(self):
+        self.entries = dict() # flag -> efro -> month -> doPrint
+        self.messages = []    # problems found while loading
+
+    def __contains__(self, flag):
+        return flag in self.entries
+
+    def add(self, flag, efro, month, do_print):
+        self.entries.setdefault(flag, dict()).setdefault(efro, dict())[month] = do_print
+
+    def lookup(self, flag, efro, month):
+        """ Returns doPrint for the entry, or None if there isn't one. """
+        if flag not in self.entries or efro not in self.entries[flag]:
+            return None
+        return self.entries[flag][efro].get(month)
+
+    def for_efro(self, flag, efro):
+        """ Returns month -> doPrint for all of an EFRO's entries for flag. """
+        if flag not in self.entries or efro not in self.entries[flag]:
+            return {}
+        return self.entries[flag][efro]
+
+    def load(self, path, offset=0):
+        """
+        Adds the entries in the history file, or just the ones after offset (a value returned by an earlier load, to
+        pick up rows appended since).  Returns the offset of the end of the last complete row read.
+        """
+        with open(path, 'rbU') as csvfile:
+            csvfile.seek(offset)
+            ended = []
+
+            def lines():
+                while True:
+                    line = csvfile.readline()
+                    if not line:
+                        return
+                    # a last line with no line break may still be being written, so it's read again next time
+                    if not line.endswith("\n"):
+                        ended.append(True)
+                        yield line + "\n"
+                        return
+                    yield line
+
+            reader = csv.reader(lines())
+            end = offset
+            # skip the header row
+            if offset == 0 and next(reader, None) is not None and not ended:
+                end = csvfile.tell()
+
+            try:
+                for row in reader:
+                    if not ended:
+                        end = csvfile.tell()
+                    elif len(row) < 3:
+                        # cut off partway through
+                        continue
+                    if not row:
+                        continue
+
+                    # get rid of the unicode nonsense (thanks MSFT!)
+                    row = map(lambda x: str(x.decode("ascii", "ignore")), row)
+
+                    id = row[0]
+                    flag = row[1]
+                    do_print = (row[2] == "y" or row[2] == "Y")
+
+                    try:
+                        efro, month = map(int, id.split("-"))
+                    except ValueError:
+                        self.messages.append("error-history bad-id\t%s\t%s" % (id, flag))
+                        continue
+
+                    self.add(flag, efro, month, do_print)
+            except csv.Error:
+                # a quoted field that runs into the end of the file may still be being written
+                if not ended:
+                    raise
+
+        return end
+
+    @staticmethod
+    def line_terminator(path):
+        """ The line break the file uses ("\r\n" for a new or one-line file), and whether its last line has one. """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return "\r\n", True
+        with open(path, 'rb') as csvfile:
+            head = csvfile.read(4096)
+            csvfile.seek(-1, os.SEEK_END)
+            terminated = csvfile.read(1) in "\r\n"
+
+        breaks = [i for i in (head.find("\r"), head.find("\n")) if i >= 0]
+        if not breaks:
+            return "\r\n", terminated
+        i = min(breaks)
+        if head[i] == "\n":
+            return "\n", terminated
+        return ("\r\n" if head[i + 1:i + 2] == "\n" else "\r"), terminated
+
+    def print_messages(self):
+        """ Prints the problems found by the loads so far, and forgets them. """
+        for message in self.messages:
+            print message
+        self.messages = []
+
+    def append(self, path, decisions):
+        """ Adds newly reviewed (flag, efro, month, doPrint) decisions, both here and to the end of the history file. """
+        terminator, terminated = self.line_terminator(path)
+        with open(path, 'ab') as csvfile:
+            # Excel often leaves the last row without a line break
+            if not terminated:
+                csvfile.write(terminator)
+            writer = csv.writer(csvfile, lineterminator=terminator)
+            for flag, efro, month, do_print in decisions:
+                writer.writerow(["%d-%d" % (efro, month), flag, "y" if do_print else "n"])
+                self.add(flag, efro, month, do_print)
+
+
+stages = instrument.Instrumentation(INSTRUMENT_STAGES, PROFILE_STAGE, PROFILE_PATH)
+
+
+class StdoutSink:
+    """
+    Report sink that writes the CSV report rows to a stream (stdout by default), REPORT_BATCH rows at a time.
+    Sinks take the header line once, then (flag, datum) rows; close() writes out whatever's still buffered.
+    """
+    def __init__(self, stream=None, batch=REPORT_BATCH):
+        self.stream = stream
+        self.batch = batch
+        self.lines = []
+
+    def write_header(self, header):
+        self.lines.append(header + "\n")
+
+    def write_row(self, flag, datum):
+        self.lines.append("%s,%s\n" % (flag, datum))
+        if len(self.lines) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        # look up stdout when writing, so redirecting sys.stdout works as it does for print
+        stream = self.stream or sys.stdout
+        stream.write("".join(self.lines))
+        self.lines = []
+
+    def close(self):
+        self.flush()
+
+
+class CSVFileSink(StdoutSink):
+    """ StdoutSink writing to a file of its own, which close() closes. """
+    def __init__(self, path, batch=REPORT_BATCH):
+        StdoutSink.__init__(self, open(path, 'w'), batch)
+
+    def close(self):
+        StdoutSink.close(self)
+        self.stream.close()
+
+
+class PerFlagCSVSink:
+    """ Report sink that writes each filter's rows to <flag>.csv in a directory, each with the report header. """
+    def __init__(self, directory, batch=REPORT_BATCH):
+        self.directory = directory
+        self.batch = batch
+        self.header = None
+        self.sinks = dict() # flag -> StdoutSink on that flag's file
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write_header(self, header):
+        self.header = header
+
+    def write_row(self, flag, datum):
+        sink = self.sinks.get(flag)
+        if sink is None:
+            sink = self.sinks[flag] = StdoutSink(open(os.path.join(self.directory, flag + ".csv"), 'w'), self.batch)
+            if self.header is not None:
+                sink.write_header(self.header)
+        sink.write_row(flag, datum)
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+            sink.stream.close()
+
+
+class JSONLSink:
+    """ Report sink that writes one JSON object per row, keyed by the report's column names. """
+    def __init__(self, path, batch=REPORT_BATCH):
+        self.stream = open(path, 'w')
+        self.batch = batch
+        self.lines = []
+
+    def write_header(self, header):
+        pass
+
+    def write_row(self, flag, datum):
+        row = dict(zip(FeedNYCDatum.COLUMNS, datum.report_values()))
+        row['error_type'] = flag
+        self.lines.append(json.dumps(row, sort_keys=True) + "\n")
+        if len(self.lines) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        self.stream.write("".join(self.lines))
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+
+def make_report_sink(report_format, path):
+    if report_format == "stdout":
+        return StdoutSink()
+    if report_format == "csv":
+        return CSVFileSink(path)
+    if report_format == "csv-per-flag":
+        return PerFlagCSVSink(path)
+    if report_format == "jsonl":
+        return JSONLSink(path)
+    raise ValueError("unknown report format %s" % report_format)
+
+
+class MonthMatrix:
+    """
+    Dense EFRO x month table of totals served: cell (row, j) is the row's total for the month whose month_index is
+    base + j.  present marks the cells that have a record and zeros the ones whose total is 0, a byte per cell, so
+    which months of a row are missing or zero comes from slicing the masks rather than looking months up one by one.
+    Rows are added by EFROProfile.  With no months, the matrix has no columns.
+    """
+    ABSENT = "".join(chr(b == 0) for b in xrange(256))  # translate table: 1 where the mask is 0
+
+    def __init__(self, min_month=None, max_month=None):
+        if min_month is None:
+            self.base = 0
+            self.width = 0
+        else:
+            self.base = month_index(min_month)
+            self.width = max(month_index(max_month) - self.base + 1, 0)
+        self.rows = 0
+        self.totals = array('l')
+        self.present = bytearray()
+        self.zeros = bytearray()
+
+    @staticmethod
+    def spanning(efroSets):
+        """ An empty matrix wide enough for all the months of the given month series (no columns if they have none). """
+        first = []
+        last = []
+        for efroSet in efroSets:
+            months = efroSet.keys()
+            if months:
+                first.append(min(months))
+                last.append(max(months))
+        if not first:
+            return MonthMatrix()
+        return MonthMatrix(min(first), max(last))
+
+    def add_row(self):
+        """ Adds an all-absent row; returns its number. """
+        self.totals.extend(array('l', [0]) * self.width)
+        self.present.extend(bytearray(self.width))
+        self.zeros.extend(bytearray(self.width))
+        self.rows += 1
+        return self.rows - 1
+
+    def cell(self, row, month):
+        return row * self.width + month_index(month) - self.base
+
+    def row_months(self, row, mask):
+        """ The months set in one row of a mask, in order. """
+        start = row * self.width
+        return [index_month(self.base + j) for j in compress(xrange(self.width), mask[start:start + self.width])]
+
+    def missing(self, row, min_month, max_month):
+        """ The months in [min_month, max_month] that the row has no record for, in order. """
+        lo = month_index(min_month) - self.base
+        hi = month_index(max_month) - self.base + 1
+        j0 = min(max(lo, 0), self.width)
+        j1 = max(min(hi, self.width), j0)
+
+        start = row * self.width
+        absent = self.present[start + j0:start + j1].translate(self.ABSENT)
+        columns = range(lo, min(j0, hi)) + list(compress(xrange(j0, j1), absent)) + range(max(j1, lo), hi)
+        return [index_month(self.base + j) for j in columns]
+
+
+class EFROProfile:
+    """
+    The window-independent facts the filters need about one EFRO's month series: its row of a MonthMatrix (each
+    month's total served), the count, sum and sum of squares of the totals, and the histogram of the nonzero totals.
+    They depend only on the series, not on the output window or the error history, so a profile is shared by all the
+    filters and by every batch window with the same analysis range.  Without a matrix, the profile makes one of its
+    own that just spans the series.
+    """
+    def __init__(self, efroSet, matrix=None):
+        self.matrix = matrix or MonthMatrix.spanning([efroSet])
+        self.row = self.matrix.add_row()
+        self.n = len(efroSet)
+        self.sum = 0
+        self.sum2 = 0
+        self.histo = defaultdict(int)             # nonzero total -> number of months
+        self.totServed2months = defaultdict(list) # nonzero total -> months, in efroSet order
+        self.similarWindows = dict()              # SimilarFilter thresholds -> its windows over histo
+
+        if isinstance(efroSet, FeedNYCSeries):
+            monthTotals = efroSet.column_items(efroSet.dataset.totals())
+        else:
+            monthTotals = [(month, datum.childrenServed + datum.adultsServed + datum.elderlyServed)
+                           for month, datum in efroSet.items()]
+
+        totals, present, zeros = self.matrix.totals, self.matrix.present, self.matrix.zeros
+        for month, totServed in monthTotals:
+            cell = self.matrix.cell(self.row, month)
+            totals[cell] = totServed
+            present[cell] = 1
+            self.sum += totServed
+            self.sum2 += (totServed * totServed)
+            # we print out zeros elsewhere (ZeroFilter)
+            if totServed != 0:
+                self.histo[totServed] += 1
+                self.totServed2months[totServed].append(month)
+            else:
+                zeros[cell] = 1
+
+    def months(self):
+        """ The months with a record, in order. """
+        return self.matrix.row_months(self.row, self.matrix.present)
+
+    def zero_months(self):
+        return self.matrix.row_months(self.row, self.matrix.zeros)
+
+    def missing_months(self, min_month, max_month):
+        return self.matrix.missing(self.row, min_month, max_month)
+
+    def total(self, month):
+        return self.matrix.totals[self.matrix.cell(self.row, month)]
+
+
+class RecordFlags:
+    """
+    The flags the filters put on records, kept apart from the records: a bitset per record ((efro, month) -> a bit for
+    each filter that flagged it) and the flag letters (P, c, r) a filter gave a record, if any.  Filters sharing one
+    (see FilterPipeline) can see each other's flags.
+
+    Datums are only built when a flagged record is printed, from the month series the record came from.  A month with
+    no record (SkippedDataFilter) is a virtual row: nothing served, built from a template datum, which is the EFRO's
+    first record unless one's been set.
+    """
+    def __init__(self):
+        self.flagBits = dict()   # filter flag -> its bit
+        self.bits = dict()       # (efro, month) -> bits of the filters that flagged the record
+        self.letters = dict()    # (filter flag, efro, month) -> flag letters
+        self.series = dict()     # efro -> month -> datum series the records are read from
+        self.templates = dict()  # efro -> datum that virtual rows are built from
+
+    def bit(self, flag):
+        if flag not in self.flagBits:
+            self.flagBits[flag] = 1 << len(self.flagBits)
+        return self.flagBits[flag]
+
+    def add(self, flag, efro, month, letters=""):
+        key = (efro, month)
+        self.bits[key] = self.bits.get(key, 0) | self.bit(flag)
+        if letters:
+            self.letters[(flag, efro, month)] = letters
+
+    def has(self, flag, efro, month):
+        return bool(self.bits.get((efro, month), 0) & self.bit(flag))
+
+    def flag_letters(self, flag, efro, month):
+        return self.letters.get((flag, efro, month), "")
+
+    def add_series(self, efro, efroSet):
+        if efro not in self.series:
+            self.series[efro] = efroSet
+
+    def datum(self, efro, month, flag=""):
+        """
+        A datum for the record to print, with the given flag letters.  It's always a new one: the datums in the
+        series belong to the caller's data and aren't written to.
+        """
+        efroSet = self.series.get(efro)
+        if efroSet is not None and month in efroSet:
+            return efroSet[month].flagged(flag)
+
+        template = self.templates.get(efro)
+        if template is None:
+            template = efroSet[min(efroSet.keys())]
+        datum = FeedNYCDatum()
+        datum.efro = efro
+        datum.name, datum.type, datum.address, datum.district, datum.boro, datum.agencyType, datum.mealFactor = \
+            template.name, template.type, template.address, template.district, template.boro, template.agencyType, \
+            template.mealFactor
+        datum.sampleMonth = month
+        datum.elderlyServed = 0
+        datum.adultsServed = 0
+        datum.childrenServed = 0
+        datum.updateDate = ""
+        datum.updateUser = ""
+        datum.flag = flag
+        return datum
 
 
 class BaseFilter():
@@ -117,47 +873,123 @@ class BaseFilter():
 
     def __init__(self):
         # stores all bad data for this filter
-        self.badData = defaultdict(list) # efro -> datum
+        self.badData = defaultdict(list) # efro -> months flagged, in the order they were found
         self.filter_flag = None
+        self.set_output_window(OUTPUT_MIN, OUTPUT_MAX)
+        self.set_error_history(ErrorHistory())
+        self.set_record_flags(RecordFlags())
 
-    def print_header(self):
+    def set_output_window(self, output_min, output_max):
+        """ Sets the months this filter reports on (OUTPUT_MIN to OUTPUT_MAX unless this is called). """
+        self.output_min = output_min
+        self.output_max = output_max
+
+    def set_error_history(self, history):
+        """ Sets the ErrorHistory of previously reviewed errors (an empty one unless this is called). """
+        self.error_history = history
+
+    def set_record_flags(self, records):
+        """ Sets the RecordFlags this filter flags records in (one of its own unless this is called). """
+        self.records = records
+
+    def flag_record(self, efro, month, letters=""):
+        """ Flags a record (or a month with no record) as bad data for this filter. """
+        self.badData[efro].append(month)
+        self.records.add(self.filter_flag, efro, month, letters)
+
+    def print_header(self, sink=None):
         datum = FeedNYCDatum()
-        print "error_type,%s" % datum.print_header()
+        if sink is None:
+            print "error_type,%s" % datum.print_header()
+        else:
+            sink.write_header("error_type,%s" % datum.print_header())
 
-    def filter_by_date(self, datum):
-        return datum.sampleMonth < OUTPUT_MIN or datum.sampleMonth > OUTPUT_MAX
+    def filter(self, data):
+        for efro, efroSet in data.items():
+            self.records.add_series(efro, efroSet)
+            self.filter_efro(efro, efroSet)
 
-    def filter_by_history(self, datum):
-        # see if we have an entry for this datum and type of flag in the prev_error_map
-        if self.filter_flag not in prev_error_map:
-            return False
-        id = "%d-%d" % (datum.efro, datum.sampleMonth)
-        if id not in prev_error_map[self.filter_flag]:
-            return False
+    def filter_efro(self, efro, efroSet, profile=None):
+        """
+        Checks one EFRO's month -> datum series.  Subclasses implement this; filter() and FilterPipeline call it.
+        profile is the series' EFROProfile, if the caller has one (filters that need it build it otherwise).
+        """
+        raise NotImplementedError
 
-        # if we've gotten here, we have an entry for this filter & datum
-        if prev_error_map[self.filter_flag][id]:  # if true, we print
-            datum.flag += self.PREV_ERROR_FLAG
-            return False
+    def filter_new_datum(self, datum, summary):
+        """
+        Incremental mode: checks one newly arrived datum against its EFRO's EFROSummary, which already includes it.
+        Filters that can't work incrementally just don't override this.
+        """
+        pass
 
-        return True
+    def filter_missing(self, summary):
+        """ Incremental mode: called once per EFRO after the new data has been added. """
+        pass
 
-    def standard_filter(self, datum):
-        if self.filter_by_date(datum):
-            return True
-        return self.filter_by_history(datum)
+    def add_bad_rows(self, dataset, rows):
+        """ Records rows (indices into a FeedNYCDataset) as bad data. """
+        for i in rows:
+            efro = dataset.efro[i]
+            if efro not in self.records.series:
+                self.records.add_series(efro, dataset[efro])
+            self.flag_record(efro, dataset.sampleMonth[i])
 
-    # flag should be a string that can uniquely identify the filter
-    def print_bad_data(self, filterFn = None):
-        if filterFn == None:
-            filterFn = self.standard_filter
+    def filter_by_date(self, month):
+        return month < self.output_min or month > self.output_max
+
+    def history_entry(self, efro, month):
+        """ Returns the error history doPrint value for this record and filter, or None if there's no entry. """
+        return self.error_history.lookup(self.filter_flag, efro, month)
 
-        for efroBD in self.badData.values():
-            for badDatum in efroBD:
-                if filterFn(badDatum):
+    def history_flag(self, efro, month):
+        """
+        The flag letters the error history gives a record: PREV_ERROR_FLAG if it's been reviewed and we print it
+        anyway, "" if it hasn't been reviewed, or None if it has and we don't print it.
+        """
+        do_print = self.history_entry(efro, month)
+        if do_print is None:
+            return ""
+        return self.PREV_ERROR_FLAG if do_print else None
+
+    def standard_filter(self, efro, month):
+        if self.filter_by_date(month):
+            return None
+        return self.history_flag(efro, month)
+
+    def print_filter(self, efro, month):
+        """ The flag letters to add when a record is printed, or None to leave it out.  standard_filter by default. """
+        return self.standard_filter(efro, month)
+
+    def print_flags(self, efro, month, filterFn=None):
+        """ All of a record's flag letters for this filter, or None if it isn't printed. """
+        extra = (filterFn or self.print_filter)(efro, month)
+        if extra is None:
+            return None
+        return self.records.flag_letters(self.filter_flag, efro, month) + extra
+
+    # flag should be a string that can uniquely identify the filter
+    def print_bad_data(self, filterFn = None, sink=None):
+        own_sink = sink is None
+        if own_sink:
+            sink = StdoutSink()
+
+        rows = 0
+        for efro, months in self.badData.items():
+            for month in months:
+                flags = self.print_flags(efro, month, filterFn)
+                if flags is None:
                     continue
 
-                print "%s,%s" % (self.filter_flag, badDatum)
+                sink.write_row(self.filter_flag, self.records.datum(efro, month, flags))
+                rows += 1
+
+        if own_sink:
+            sink.close()
+        return rows
+
+    def bad_data_count(self):
+        return sum(len(efroBD) for efroBD in self.badData.values())
 
 
 class MealFactorFilter(BaseFilter):
@@ -168,10 +1000,26 @@ class MealFactorFilter(BaseFilter):
         self.filter_flag = "meal-factor"
 
     def filter(self, data):
-        for efro, efroSet in data.items():
-            for month, datum in efroSet.items():
-                if datum.mealFactor not in self.NORMAL_MFS:
-                    self.badData[efro].append(datum)
+        if isinstance(data, FeedNYCDataset):
+            return self.filter_dataset(data)
+        BaseFilter.filter(self, data)
+
+    def filter_efro(self, efro, efroSet, profile=None):
+        if isinstance(efroSet, FeedNYCSeries):
+            mealFactors = efroSet.column_items(efroSet.dataset.mealFactor)
+        else:
+            mealFactors = [(month, datum.mealFactor) for month, datum in efroSet.items()]
+
+        for month, mealFactor in mealFactors:
+            if mealFactor not in self.NORMAL_MFS:
+                self.flag_record(efro, month)
+
+    def filter_dataset(self, dataset):
+        self.add_bad_rows(dataset, [i for i, mf in enumerate(dataset.mealFactor) if mf not in self.NORMAL_MFS])
+
+    def filter_new_datum(self, datum, summary):
+        if datum.mealFactor not in self.NORMAL_MFS:
+            self.flag_record(datum.efro, datum.sampleMonth)
 
 
 class SimilarFilter(BaseFilter):
@@ -187,55 +1035,106 @@ class SimilarFilter(BaseFilter):
         self.ABS_THRESH = absThresh
         self.REL_THRESH = relThresh
 
-    def filter(self, data):
-        for efro, efroSet in data.items():
-            histo = defaultdict(int)
-            totServed2data = defaultdict(list)
-            for month, datum in efroSet.items():
-                totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
-                # we print out zeros elsewhere (ZeroFilter)
-                if totServed == 0:
-                    continue
-                histo[totServed] += 1
-                totServed2data[totServed].append(datum)
-
-            totServedSet = set(histo.keys())
-            badTotServed = set()
-            for totServed, count in histo.items():
-                thresh = max(self.ABS_THRESH, self.REL_THRESH * totServed)
-
-                totCount = 0
-                curBadTotServed = set()
-                # figure out which counts are within the threshold
-                for n in filter(lambda x: abs(x - totServed) <= thresh, totServedSet):
-                    totCount += histo[n]
-                    curBadTotServed.add(n)
-
-                # if we've gotten too many data points within our window, they're all suspect
-                if count >= self.SENSITIVITY:
-                    # we only add this to the output if at least one of the currently bad entries is
-                    # in the output window
-                    got_printable_entry = False
-                    for tot in curBadTotServed:
-                        for datum in totServed2data[tot]:
-                            if not self.filter_by_history(datum) and not self.filter_by_date(datum):
-                                got_printable_entry = True
-
-                    if got_printable_entry:
-                        badTotServed.update(curBadTotServed)
-
-            for n in badTotServed:
-                for d in totServed2data[n]:
-                    d = copy.copy(d)
-                    d.flag += self.CONTEXT_FLAG if self.filter_by_date(d) else self.REAL_DATA_FLAG
-                    self.badData[efro].append(d)
+    def window_radius(self, totServed):
+        # totals are integers, so |x - totServed| <= thresh is the same as |x - totServed| <= floor(thresh)
+        return int(math.floor(max(self.ABS_THRESH, self.REL_THRESH * totServed)))
+
+    def windows(self, profile):
+        """
+        Returns (totals, index, lo, hi) for the profile's histogram: its distinct totals in sorted order, total ->
+        position in totals, and the window around each total (the totals within the threshold) as the contiguous slice
+        totals[lo[j]:hi[j]], found by bisection.  Kept in the profile, as it only depends on the thresholds.
+        """
+        key = (self.ABS_THRESH, self.REL_THRESH)
+        if key not in profile.similarWindows:
+            totals = sorted(profile.histo)
+            index = dict((tot, j) for j, tot in enumerate(totals))
+            lo = []
+            hi = []
+            for tot in totals:
+                radius = self.window_radius(tot)
+                lo.append(bisect.bisect_left(totals, tot - radius))
+                hi.append(bisect.bisect_right(totals, tot + radius))
+            profile.similarWindows[key] = (totals, index, lo, hi)
+        return profile.similarWindows[key]
+
+    def filter_efro(self, efro, efroSet, profile=None):
+        if profile is None:
+            profile = EFROProfile(efroSet)
+        histo = profile.histo
+        totServed2months = profile.totServed2months
+
+        totals, index, lo, hi = self.windows(profile)
+
+        # if we've gotten too many data points within our window, they're all suspect
+        suspect = [j for j, tot in enumerate(totals) if histo[tot] >= self.SENSITIVITY]
+
+        # Every month in a suspect window gets its history checked, and a "print" entry earns the record a
+        # PREV_ERROR_FLAG for every such window it's in.  Count the windows covering each total once (difference
+        # array over the sorted totals) instead of re-checking the history per window.
+        coverDelta = [0] * (len(totals) + 1)
+        for j in suspect:
+            coverDelta[lo[j]] += 1
+            coverDelta[hi[j]] -= 1
+
+        # printablePrefix[j] = number of totals[:j] with at least one record we'd print
+        history = self.error_history.for_efro(self.filter_flag, efro)
+        prevErrors = dict() # month -> number of PREV_ERROR_FLAGs
+        printablePrefix = [0]
+        cover = 0
+        for j, tot in enumerate(totals):
+            cover += coverDelta[j]
+            printable = False
+            if cover > 0:
+                for month in totServed2months[tot]:
+                    do_print = history.get(month)
+                    if do_print:
+                        prevErrors[month] = cover
+                    if do_print is not False and not self.filter_by_date(month):
+                        printable = True
+            printablePrefix.append(printablePrefix[-1] + printable)
+
+        # We only add a window to the output if at least one of its entries is in the output window.  The windows
+        # are merged into badTotServed in histo order, each built in totServedSet order, just as scanning all the
+        # totals per window did; the order of the set (and so of the output) depends on it.
+        totServedSet = set(histo.keys())
+        setOrder = dict((tot, pos) for pos, tot in enumerate(totServedSet))
+        badTotServed = set()
+        for totServed in histo:
+            j = index[totServed]
+            if histo[totServed] >= self.SENSITIVITY and printablePrefix[hi[j]] > printablePrefix[lo[j]]:
+                badTotServed.update(set(sorted(totals[lo[j]:hi[j]], key=setOrder.get)))
+
+        for n in badTotServed:
+            for month in totServed2months[n]:
+                self.flag_record(efro, month, self.PREV_ERROR_FLAG * prevErrors.get(month, 0) +
+                                 (self.CONTEXT_FLAG if self.filter_by_date(month) else self.REAL_DATA_FLAG))
+
+    def filter_new_datum(self, datum, summary):
+        # Only the new datum is reported (we don't keep the older data to print as context).  It's bad if it falls in
+        # the window of a total that's been seen too often, and we'd print it.
+        totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
+        if totServed == 0:
+            return
+
+        for tot, count in summary.histo.items():
+            if count >= self.SENSITIVITY and abs(tot - totServed) <= self.window_radius(tot):
+                break
+        else:
+            return
+
+        history = self.history_flag(datum.efro, datum.sampleMonth)
+        if history is None or self.filter_by_date(datum.sampleMonth):
+            return
+
+        self.flag_record(datum.efro, datum.sampleMonth, history + self.REAL_DATA_FLAG)
 
     # We don't filter by date for this because entries that aren't in the output date range give context
-    def filter_none(self, datum):
-        return False
+    def filter_none(self, efro, month):
+        return ""
 
-    def print_bad_data(self):
-        BaseFilter.print_bad_data(self, filterFn=self.filter_none)
+    def print_filter(self, efro, month):
+        return self.filter_none(efro, month)
 
 
 class SkippedDataFilter(BaseFilter):
@@ -243,65 +1142,20 @@ class SkippedDataFilter(BaseFilter):
         BaseFilter.__init__(self)
         self.filter_flag = "skipped-entries"
 
-    def adjust_month(self, month, amount):
-        if amount == 0:
-            return month
-
-        year = math.floor(month / 100)
-        month %= 100
-        sign = 1 if amount > 0 else -1
-        amount = abs(amount)
-
-        yDiff = int(amount / 12)
-        mDiff = amount % 12
-
-        year += (yDiff * sign)
-        month += (mDiff * sign)
-        if month > 12:
-            year += 1
-            month -= 12
-        elif month < 1:
-            year -= 1
-            month += 12
+    def filter_efro(self, efro, efroSet, profile=None):
+        if profile is None:
+            profile = EFROProfile(efroSet)
 
-        return int(year * 100 + month)
+        # the missing months are virtual rows (see RecordFlags)
+        for month in profile.missing_months(self.output_min, self.output_max):
+            self.flag_record(efro, month)
 
-    def months_between(self, begin, end):
-        """
-        Returns a list of months in [begin, end]
-
-        N.B. This breaks if begin or end aren't a valid YYYYMM month.
-        """
-        if end < begin:
-            return []
-
-        month_list = []
-        cur_month = begin
-        while cur_month != end:
-            month_list.append(cur_month)
-            cur_month = self.adjust_month(cur_month, 1)
-        month_list.append(end)
-
-        return month_list
-
-    def filter(self, data):
-        req_months = set(self.months_between(OUTPUT_MIN, OUTPUT_MAX))
-
-        for efro, efroSet in data.items():
-            missing_months = req_months - set(efroSet.keys())
-
-            for month in missing_months:
-                sample_datum = copy.copy(efroSet.values()[0])
-                sample_datum.elderlyServed = 0
-                sample_datum.adultsServed = 0
-                sample_datum.childrenServed = 0
-                sample_datum.updateDate = ""
-                sample_datum.updateUser = ""
-                sample_datum.sampleMonth = month
-                self.badData[efro].append(sample_datum)
-
-    def print_bad_data(self):
-        BaseFilter.print_bad_data(self)
+    def filter_missing(self, summary):
+        for month in months_between(self.output_min, self.output_max):
+            if month in summary.months:
+                continue
+            self.records.templates[summary.efro] = summary.template_datum()
+            self.flag_record(summary.efro, month)
 
 
 class ZeroFilter(BaseFilter):
@@ -311,11 +1165,22 @@ class ZeroFilter(BaseFilter):
         self.filter_flag = "zeros"
 
     def filter(self, data):
-        for efro, efroSet in data.items():
-            for month, datum in efroSet.items():
-                totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
-                if totServed == 0:
-                    self.badData[efro].append(datum)
+        if isinstance(data, FeedNYCDataset):
+            return self.filter_dataset(data)
+        BaseFilter.filter(self, data)
+
+    def filter_efro(self, efro, efroSet, profile=None):
+        if profile is None:
+            profile = EFROProfile(efroSet)
+        for month in profile.zero_months():
+            self.flag_record(efro, month)
+
+    def filter_dataset(self, dataset):
+        self.add_bad_rows(dataset, [i for i, tot in enumerate(dataset.totals()) if tot == 0])
+
+    def filter_new_datum(self, datum, summary):
+        if datum.childrenServed + datum.adultsServed + datum.elderlyServed == 0:
+            self.flag_record(datum.efro, datum.sampleMonth)
 
 
 class OutlierFilter(BaseFilter):
@@ -326,147 +1191,787 @@ class OutlierFilter(BaseFilter):
 
         self.sdThresh = stdDev
 
-    def filter(self, data):
-        for efro, efroSet in data.items():
-            sum = 0
-            sum2 = 0
-            n = len(efroSet)
-            for month, datum in efroSet.items():
-                totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
-                sum += totServed
-                sum2 += (totServed * totServed)
-
-            # don't divide by 0
-            if n <= 2:
-                continue
-
-            #todo Is it proper to subtract out the element we're testing?
-            for month, datum in efroSet.items():
-                totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
-                if totServed == 0:
-                    continue
-
-                nSum = sum - totServed
-                nSum2 = sum2 - (totServed * totServed)
-
-                mean = nSum / (n - 1)
-                stdDev = math.sqrt((nSum2 / (n - 2)) - (mean * mean))
-
-                if abs(totServed - mean) > stdDev * self.sdThresh:
-                    self.badData[efro].append(datum)
-
+    def is_outlier(self, totServed, sum, sum2, n):
+        """
+        Tests totServed against the mean/std dev of the other n - 1 values, given the sum and sum of squares of
+        all n values.
+        """
+        #todo Is it proper to subtract out the element we're testing?
+        nSum = sum - totServed
+        nSum2 = sum2 - (totServed * totServed)
 
-def get_years_in_range(min_month, max_month):
-    # inputs are YYYYMM
-    # Figure out our date range
-    minY = int(math.floor(min_month / 100))
-    minM = int(min_month % 100)
-    maxY = int(math.floor(max_month / 100))
-    maxM = int(max_month  % 100)
-    cal_year = range(minY, maxY + 1)
-    # we need to do this to split on fiscal years correctly
-    # FYxx is from July 1, 20xx-1 to June 30, 20xx, i.e., FYxx ends in 20xx
-    if minM > 6:
-        minY += 1
-    if maxM > 6:
-        maxY += 1
-    fiscal_year = range(minY, maxY + 1)
+        mean = nSum / (n - 1)
+        stdDev = math.sqrt((nSum2 / (n - 2)) - (mean * mean))
 
-    return cal_year, fiscal_year
+        return abs(totServed - mean) > stdDev * self.sdThresh
 
-#-----------------------------------------------------------------------------
+    def filter(self, data):
+        if isinstance(data, FeedNYCDataset):
+            return self.filter_dataset(data)
+        BaseFilter.filter(self, data)
 
-if __name__ == "__main__":
-    # Figure out our date range
-    analysis_range_cy, analysis_range_fy = get_years_in_range(ANALYSIS_MIN, ANALYSIS_MAX)
-    output_range_cy, output_range_fy = get_years_in_range(OUTPUT_MIN, OUTPUT_MAX)
-
-    # STEP 1
-    # Read in the EFRO Map
-    chAcct2efro = defaultdict(set)  # acct -> set(efros)
-    efro2data = dict()              # efro -> data (should be unique)
-    class EFROData():
-        pass
+    def filter_efro(self, efro, efroSet, profile=None):
+        if profile is None:
+            profile = EFROProfile(efroSet)
 
-    with open(EFRO_MAP_CSV, 'rbU') as csvfile:
-        reader = csv.reader(csvfile)
+        # don't divide by 0
+        if profile.n <= 2:
+            return
 
-        # skip the header rows
-        next(reader, None)
-        next(reader, None)
+        for month in profile.months():
+            totServed = profile.total(month)
+            if totServed == 0:
+                continue
 
-        for row in reader:
-            # get rid of the unicode nonsense (thanks MSFT!)
-            row = map(lambda x: str(x.decode("ascii", "ignore")), row)
+            if self.is_outlier(totServed, profile.sum, profile.sum2, profile.n):
+                self.flag_record(efro, month)
 
-            efro_data = EFROData()
-            efro_data.efro = int(row[0])
-            efro_data.chAcct = row[1]
-            efro_data.idAlias = row[2]
-            efro_data.name = row[3]
-            efro_data.agencyType = row[4]
+    def filter_dataset(self, dataset):
+        totals = dataset.totals()
+        sums = dataset.segment_sums(totals)
+        sums2 = dataset.segment_sums([tot * tot for tot in totals])
 
-            # Make sure there aren't duplicate efros
-            if efro_data.efro in efro2data:
-                print "efro-map duplicate-efros\t%s\t%s" % (efro_data.efro, efro_data.name)
+        rows = []
+        for k, (efro, start, end) in enumerate(dataset.groups()):
+            n = end - start
+            # don't divide by 0
+            if n <= 2:
                 continue
 
-            # Also, make sure that if the account and alias are the same, then the agency types differ.
-            is_dup = False
-            if efro_data.chAcct in chAcct2efro:
-                for old_efro in chAcct2efro[efro_data.chAcct]:
-                    old_data = efro2data[old_efro]
-                    if efro_data.idAlias == old_data.idAlias and efro_data.agencyType == old_data.agencyType:
-                        print "efro-map duplicate-entries\t%s\t%-40s%s\t%s\tefros %d %d" % \
-                              (efro_data.chAcct, efro_data.name, efro_data.idAlias, efro_data.agencyType,
-                               efro_data.efro, old_efro)
-                        is_dup = True
-
-            if is_dup:
+            rows.extend(i for i in xrange(start, end)
+                if totals[i] != 0 and self.is_outlier(totals[i], sums[k], sums2[k], n))
+        self.add_bad_rows(dataset, rows)
+
+    def filter_new_datum(self, datum, summary):
+        totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
+        # don't divide by 0
+        if totServed != 0 and summary.n > 2 and self.is_outlier(totServed, summary.sum, summary.sum2, summary.n):
+            self.flag_record(datum.efro, datum.sampleMonth)
+
+
+class FilterPipeline:
+    """
+    Runs a set of filters over the data in a single pass.  Each EFRO's month series is visited once and handed to
+    every registered filter's filter_efro(); the filters keep their own badData and flag records in one shared
+    RecordFlags.  Output is printed filter by filter in registration order, or one row per record (print_records).
+    """
+    def __init__(self, filters=None):
+        self.filters = []
+        self.records = RecordFlags()
+        for f in filters or []:
+            self.register(f)
+
+    def register(self, f):
+        f.set_record_flags(self.records)
+        self.filters.append(f)
+        return f
+
+    def run(self, data):
+        self.run_items(data.items())
+
+    def run_items(self, items, profiles=None, add_stats=True):
+        """
+        Runs the filters over (efro, month series) items.  profiles (efro -> EFROProfile) lets runs over the same
+        series share their profiles: the ones in it are used, and the ones built are added to it.
+
+        With instrumentation on, returns each filter's (wall, cpu) time and the number of records, which go in the
+        stage table unless add_stats is False (filter_shard sends them back from its worker instead).
+        """
+        # with instrumentation on, each filter's time is summed over the EFROs and added as one call
+        timed = stages.enabled
+        wall = [0.0] * len(self.filters)
+        cpu = [0.0] * len(self.filters)
+        profilers = [stages.profiler_for("filter-" + f.filter_flag) if timed else None for f in self.filters]
+        records = 0
+        matrix = None  # the profiles built here share one, spanning the items
+
+        for efro, efroSet in items:
+            # FeedNYCSeries are read column by column; datums are only built for the flagged records, when printed
+            self.records.add_series(efro, efroSet)
+
+            profile = profiles.get(efro) if profiles is not None else None
+            if profile is None:
+                if matrix is None:
+                    matrix = MonthMatrix.spanning(series for e, series in items)
+                profile = EFROProfile(efroSet, matrix)
+                if profiles is not None:
+                    profiles[efro] = profile
+
+            if not timed:
+                for f in self.filters:
+                    f.filter_efro(efro, efroSet, profile)
                 continue
 
-            chAcct2efro[efro_data.chAcct].add(efro_data.efro)
-            efro2data[efro_data.efro] = efro_data
+            records += len(efroSet)
+            for k, f in enumerate(self.filters):
+                if profilers[k]:
+                    profilers[k].enable()
+                startWall, startCPU = time.time(), time.clock()
+                f.filter_efro(efro, efroSet, profile)
+                wall[k] += time.time() - startWall
+                cpu[k] += time.clock() - startCPU
+                if profilers[k]:
+                    profilers[k].disable()
+
+        if not timed:
+            return None
+        times = zip(wall, cpu)
+        if add_stats:
+            self.add_filter_stats(times, records)
+        return times, records
+
+    def add_filter_stats(self, times, records):
+        """ Adds run_items' times to each filter's "filter-<flag>" stage, as one call. """
+        for f, (wall, cpu) in zip(self.filters, times):
+            stages.add("filter-" + f.filter_flag, wall, cpu, records, f.bad_data_count())
+
+    def run_sharded(self, data, processes, shards_per_process=4):
+        """
+        run(), with the EFROs split into shards that a pool of processes filters in parallel.  Each worker runs
+        copies of the filters over its shard (see filter_shard) and sends back their badData and flag letters, which
+        are merged in data's EFRO order, so the output is the same as run()'s.  With instrumentation on, the workers'
+        filter times (and profiles) are added up here; the wall times are summed over the workers, like the CPU times.
+        """
+        efros = data.keys()
+        if processes <= 1 or len(efros) < 2:
+            return self.run(data)
+
+        # contiguous runs of EFROs; a few per process, so one slow shard doesn't hold up the rest
+        numShards = min(len(efros), processes * shards_per_process)
+        bounds = [len(efros) * k // numShards for k in xrange(numShards + 1)]
+        if isinstance(data, FeedNYCDataset):
+            shards = [data.slice(bounds[k], bounds[k + 1]) for k in xrange(numShards)]
+        else:
+            # an unpickled dict can iterate in another order than the one it was pickled from, and the filters flag
+            # months in the order they see them, so the workers get each series in our order
+            items = [(efro, OrderedDict(efroSet.items())) for efro, efroSet in data.items()]
+            shards = [items[bounds[k]:bounds[k + 1]] for k in xrange(numShards)]
+
+        pool = multiprocessing.Pool(min(processes, numShards))
+        try:
+            results = pool.map(filter_shard, [(self.filters, shard) for shard in shards])
+        finally:
+            pool.close()
+            pool.join()
+
+        times = [(0.0, 0.0)] * len(self.filters)
+        records = 0
+        for k, (badDatas, letters, stats) in enumerate(results):
+            for efro in efros[bounds[k]:bounds[k + 1]]:
+                self.records.add_series(efro, data[efro])
+                for f, badData in zip(self.filters, badDatas):
+                    for month in badData.get(efro, ()):
+                        f.flag_record(efro, month, letters.get((f.filter_flag, efro, month), ""))
+            if stats is not None:
+                (shardTimes, shardRecords), profile = stats
+                times = [(wall + shardWall, cpu + shardCPU)
+                         for (wall, cpu), (shardWall, shardCPU) in zip(times, shardTimes)]
+                records += shardRecords
+                stages.add_profile(profile)
+
+        if stages.enabled:
+            self.add_filter_stats(times, records)
+
+    def run_incremental(self, data, state, goodEFROs):
+        """ Runs the filters over just the records in data that aren't in state yet (see IncrementalState). """
+        state.update(data, self.filters, goodEFROs)
+
+    def print_header(self, sink=None):
+        if self.filters:
+            self.filters[0].print_header(sink)
+
+    def print_bad_data(self, sink=None):
+        """ Prints each filter's bad data; returns the number of rows written. """
+        rows = 0
+        for f in self.filters:
+            with stages.stage("print-" + f.filter_flag) as stage:
+                stage.records_in = f.bad_data_count() if stages.enabled else None
+                stage.records_out = f.print_bad_data(sink=sink)
+            rows += stage.records_out
+        return rows
+
+    def print_records(self, sink=None):
+        """
+        Prints one row per flagged record instead of one per filter and record: error_type is the flags of all the
+        filters that would print it, joined by "+" in filter order, and flag is their flag letters, joined the same
+        way.  Records come in the order print_bad_data would first print them.  Returns the number of rows written.
+        """
+        own_sink = sink is None
+        if own_sink:
+            sink = StdoutSink()
+
+        seen = set()
+        rows = 0
+        for f in self.filters:
+            for efro, months in f.badData.items():
+                for month in months:
+                    if (efro, month) in seen:
+                        continue
+                    seen.add((efro, month))
+
+                    flagged = [(g.filter_flag, g.print_flags(efro, month)) for g in self.filters
+                               if self.records.has(g.filter_flag, efro, month)]
+                    flagged = [(flag, letters) for flag, letters in flagged if letters is not None]
+                    if not flagged:
+                        continue
+
+                    sink.write_row("+".join(flag for flag, letters in flagged),
+                                   self.records.datum(efro, month, "+".join(letters for flag, letters in flagged)))
+                    rows += 1
+
+        if own_sink:
+            sink.close()
+        return rows
+
+    def print_report(self, sink=None, report_rows="per-flag"):
+        """ Prints the header, then the rows: print_bad_data's, or print_records' for report_rows "per-record". """
+        self.print_header(sink)
+        if report_rows == "per-record":
+            return self.print_records(sink)
+        return self.print_bad_data(sink)
+
+
+def filter_shard(args):
+    """
+    Pool worker for FilterPipeline.run_sharded: args is (filters, shard), where the shard is a FeedNYCDataset slice
+    or a list of (efro, efroSet) items.  Returns each filter's badData for the shard, the flag letters, and with
+    instrumentation on, run_items' times and the profile of the filter being profiled (None otherwise).
+    """
+    filters, shard = args
+    for f in filters:
+        f.badData = defaultdict(list)
+
+    pipeline = FilterPipeline(filters)
+    times = pipeline.run_items(shard.items() if isinstance(shard, FeedNYCDataset) else shard, add_stats=False)
+    stats = (times, stages.take_profile()) if times is not None else None
+    return [dict(f.badData) for f in filters], pipeline.records.letters, stats
+
+
+class EFROSummary:
+    """
+    Running aggregates of one EFRO's data for incremental runs: the count, sum and sum of squares of the totals
+    (OutlierFilter), the histogram of nonzero totals (SimilarFilter) and the months we have (SkippedDataFilter).
+    """
+    def __init__(self, efro):
+        self.efro = efro
+        self.n = 0
+        self.sum = 0
+        self.sum2 = 0
+        self.histo = defaultdict(int)
+        self.months = set()
+        # name, type, address, district, boro, agencyType, mealFactor of the latest datum, for skipped-month rows
+        self.template = None
+
+    def add(self, datum):
+        totServed = datum.childrenServed + datum.adultsServed + datum.elderlyServed
+        self.n += 1
+        self.sum += totServed
+        self.sum2 += totServed * totServed
+        if totServed != 0:
+            self.histo[totServed] += 1
+        self.months.add(datum.sampleMonth)
+        self.template = (datum.name, datum.type, datum.address, datum.district, datum.boro, datum.agencyType,
+                         datum.mealFactor)
+
+    def template_datum(self):
+        datum = FeedNYCDatum()
+        datum.efro = self.efro
+        datum.name, datum.type, datum.address, datum.district, datum.boro, datum.agencyType, datum.mealFactor = \
+            self.template
+        datum.elderlyServed = 0
+        datum.adultsServed = 0
+        datum.childrenServed = 0
+        datum.updateDate = ""
+        datum.updateUser = ""
+        return datum
+
+    # the state file holds plain tuples, so it doesn't depend on how this module was loaded
+    def to_tuple(self):
+        return self.efro, self.n, self.sum, self.sum2, dict(self.histo), sorted(self.months), self.template
+
+    def from_tuple(self, values):
+        self.efro, self.n, self.sum, self.sum2, histo, months, self.template = values
+        self.histo = defaultdict(int, histo)
+        self.months = set(months)
+        return self
+
+
+class IncrementalState:
+    """ The per-EFRO summaries carried from one incremental run to the next. """
+    VERSION = 1
 
-    # STEP 2
-    # Process the active agencies list (from CH)
+    def __init__(self):
+        self.summaries = dict() # efro -> EFROSummary
 
+    def update(self, data, filters, goodEFROs):
+        """
+        Adds the records in data (efro -> month -> datum) for months we haven't seen, in month order, handing each one
+        to every filter's filter_new_datum() after it's been added.  Then lets the filters check every good EFRO
+        we know about for missing months.
+        """
+        for efro, efroSet in data.items():
+            summary = self.summaries.get(efro)
+            if summary is None:
+                summary = self.summaries[efro] = EFROSummary(efro)
+            for f in filters:
+                f.records.add_series(efro, efroSet)
+
+            for month, datum in sorted(efroSet.items()):
+                if month in summary.months:
+                    continue
+                summary.add(datum)
+                for f in filters:
+                    f.filter_new_datum(datum, summary)
+
+        for efro in sorted(goodEFROs):
+            if efro in self.summaries:
+                for f in filters:
+                    f.filter_missing(self.summaries[efro])
+
+    def save(self, path):
+        with open(path + ".tmp", 'wb') as stateFile:
+            pickle.dump({'version': self.VERSION,
+                         'summaries': [summary.to_tuple() for summary in self.summaries.values()]},
+                        stateFile, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+
+
+def load_incremental_state(path):
+    state = IncrementalState()
+    with open(path, 'rb') as stateFile:
+        saved = pickle.load(stateFile)
+    if saved['version'] != IncrementalState.VERSION:
+        raise ValueError("%s: unsupported incremental state version %s" % (path, saved['version']))
+    for values in saved['summaries']:
+        summary = EFROSummary(None).from_tuple(values)
+        state.summaries[summary.efro] = summary
+    return state
+
+
+class FeedNYCCache:
+    """
+    On-disk cache of the FeedNYC pickles, already filtered down to a set of EFROs.  Each fiscal year is stored as a
+    small pickled header (the string tables) followed by the raw bytes of the numeric columns, so loading it is a
+    few array.fromfile calls instead of unpickling the whole citywide dump.  An entry is only used if the pickle's
+    mtime and size and the EFRO set match the ones it was built from.
+    """
+    MAGIC = "FEEDNYC-CACHE"
+    VERSION = 1
+    COLUMNS = ('efro', 'sampleMonth', 'elderlyServed', 'adultsServed', 'childrenServed', 'mealFactor', 'info')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def efro_key(self, goodEFROs):
+        return hashlib.md5(",".join(map(str, sorted(goodEFROs)))).hexdigest()[:16]
+
+    def source_key(self, source):
+        stat = os.stat(source)
+        return stat.st_mtime, stat.st_size
+
+    def path(self, source, goodEFROs):
+        return os.path.join(self.cache_dir, "%s.%s.cache" % (os.path.basename(source), self.efro_key(goodEFROs)))
+
+    def load(self, source, goodEFROs):
+        """ Returns the cached FeedNYCDataset block for source, or None if there isn't a valid one. """
+        path = self.path(source, goodEFROs)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as cacheFile:
+            if cacheFile.readline().rstrip("\n") != self.MAGIC:
+                return None
+            header_size, = struct.unpack("<Q", cacheFile.read(8))
+            header = pickle.loads(cacheFile.read(header_size))
+            if header['version'] != self.VERSION or header['source'] != self.source_key(source) or \
+                    header['efros'] != self.efro_key(goodEFROs):
+                return None
+
+            block = FeedNYCDataset()
+            for name in self.COLUMNS:
+                col = array(header['typecodes'][name])
+                col.fromfile(cacheFile, header['count'])
+                setattr(block, name, col)
+
+        block.infoTable = header['infoTable']
+        update = array('l')
+        update.fromstring(header['update'])
+        updateTable = header['updateTable']
+        block.updateDate = [updateTable[k][0] for k in update]
+        block.updateUser = [updateTable[k][1] for k in update]
+        return block
+
+    def store(self, source, goodEFROs, block):
+        """ Writes block (the records of source for goodEFROs) to the cache. """
+        refdata.make_dirs(self.cache_dir)
+
+        # the update date/user pairs repeat a lot, so store them as indices into a table too
+        updateTable = []
+        updateIndex = dict()
+        update = array('l')
+        for pair in zip(block.updateDate, block.updateUser):
+            k = updateIndex.get(pair)
+            if k is None:
+                k = updateIndex[pair] = len(updateTable)
+                updateTable.append(pair)
+            update.append(k)
+
+        header = pickle.dumps({'version': self.VERSION,
+                               'source': self.source_key(source),
+                               'efros': self.efro_key(goodEFROs),
+                               'count': len(block.efro),
+                               'typecodes': dict((name, getattr(block, name).typecode) for name in self.COLUMNS),
+                               'infoTable': block.infoTable,
+                               'updateTable': updateTable,
+                               'update': update.tostring()},
+                              pickle.HIGHEST_PROTOCOL)
+
+        # old entries for this source (other EFRO sets) are dead weight
+        for old in glob.glob(os.path.join(self.cache_dir, os.path.basename(source) + ".*.cache")):
+            os.remove(old)
+
+        path = self.path(source, goodEFROs)
+        with open(path + ".tmp", 'wb') as cacheFile:
+            cacheFile.write(self.MAGIC + "\n")
+            cacheFile.write(struct.pack("<Q", len(header)))
+            cacheFile.write(header)
+            for name in self.COLUMNS:
+                getattr(block, name).tofile(cacheFile)
+        os.rename(path + ".tmp", path)
+
+
+class FeedNYCStore:
+    """
+    One fiscal year's FeedNYC export, partitioned by EFRO.  Each efro's records (in export order) are a partition of
+    their own: the numeric columns as raw bytes, plus the efro's name/address and update date/user strings, pickled
+    together.  An index at the end of the file has the sorted efros and where each one's partition starts, so reading
+    a set of EFROs maps the file and unpickles just their partitions; the rest of the export is never touched.
+
+    Written from a pickle or CSV export by convert_feednyc_store.
+    """
+    MAGIC = "FEEDNYC-STORE"
+    VERSION = 1
+    COLUMNS = ('sampleMonth', 'elderlyServed', 'adultsServed', 'childrenServed', 'mealFactor', 'info')
+
+    def __init__(self, path):
+        self.path = path
+
+    def partition(self, records):
+        """ The pickled partition for one efro's record tuples. """
+        infoTable = []
+        infoIndex = dict()
+        info = array('l')
+        for curTup in records:
+            key = tuple(curTup[1:6])
+            k = infoIndex.get(key)
+            if k is None:
+                k = infoIndex[key] = len(infoTable)
+                infoTable.append(key)
+            info.append(k)
+
+        columns = [array('l', [int(curTup[6]) for curTup in records])] + \
+                  [array('l', [curTup[i] for curTup in records]) for i in (7, 8, 9, 10)] + [info]
+        return pickle.dumps(tuple(col.tostring() for col in columns) +
+                            (infoTable, [curTup[11] for curTup in records], [curTup[12] for curTup in records]),
+                            pickle.HIGHEST_PROTOCOL)
+
+    def write(self, records):
+        """ Writes the record tuples (e.g. iter_feednyc_records of an export) as the store. """
+        byEFRO = defaultdict(list)
+        for curTup in records:
+            byEFRO[curTup[0]].append(curTup)
+
+        efros = array('l', sorted(byEFRO))
+        offsets = array('l')
+        with open(self.path + ".tmp", 'wb') as storeFile:
+            storeFile.write(self.MAGIC + "\n")
+            # where the index starts, filled in once it's known
+            storeFile.write(struct.pack("<Q", 0))
+            for efro in efros:
+                offsets.append(storeFile.tell())
+                storeFile.write(self.partition(byEFRO[efro]))
+            offsets.append(storeFile.tell())
+
+            pickle.dump({'version': self.VERSION,
+                         'itemsize': efros.itemsize,
+                         'efros': efros.tostring(),
+                         'offsets': offsets.tostring()},
+                        storeFile, pickle.HIGHEST_PROTOCOL)
+            storeFile.seek(len(self.MAGIC) + 1)
+            storeFile.write(struct.pack("<Q", offsets[-1]))
+        os.rename(self.path + ".tmp", self.path)
+
+    def read_index(self, storeFile):
+        """ The sorted efros and their partitions' offsets (with the end of the last one appended). """
+        if storeFile.readline() != self.MAGIC + "\n":
+            raise ValueError("%s isn't a FeedNYC store" % self.path)
+        index_offset, = struct.unpack("<Q", storeFile.read(8))
+        storeFile.seek(index_offset)
+        header = pickle.load(storeFile)
+        if header['version'] != self.VERSION or header['itemsize'] != array('l').itemsize:
+            raise ValueError("%s is a FeedNYC store from another version or platform; convert the export again" %
+                             self.path)
+
+        efros = array('l')
+        efros.fromstring(header['efros'])
+        offsets = array('l')
+        offsets.fromstring(header['offsets'])
+        return efros, offsets
+
+    def read(self, goodEFROs=None, min_month=None, max_month=None):
+        """
+        The records for goodEFROs (all of them if None) as an unfinalized FeedNYCDataset, in efro order.  If
+        min_month/max_month aren't None, only months in [min_month, max_month] are kept.
+        """
+        block = FeedNYCDataset()
+        with open(self.path, 'rb') as storeFile:
+            efros, offsets = self.read_index(storeFile)
+            mapped = mmap.mmap(storeFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for efro in (efros if goodEFROs is None else sorted(goodEFROs)):
+                    k = bisect.bisect_left(efros, efro)
+                    if k < len(efros) and efros[k] == efro:
+                        self.add_partition(block, efro, pickle.loads(mapped[offsets[k]:offsets[k + 1]]),
+                                           min_month, max_month)
+            finally:
+                mapped.close()
+        return block
+
+    def add_partition(self, block, efro, partition, min_month, max_month):
+        columns = []
+        for data in partition[:len(self.COLUMNS)]:
+            col = array('l')
+            col.fromstring(data)
+            columns.append(col)
+        infoTable, updateDate, updateUser = partition[len(self.COLUMNS):]
+
+        if min_month is not None:
+            keep = [j for j, month in enumerate(columns[0]) if min_month <= month <= max_month]
+            if len(keep) < len(columns[0]):
+                columns = [array('l', [col[j] for j in keep]) for col in columns]
+                updateDate = [updateDate[j] for j in keep]
+                updateUser = [updateUser[j] for j in keep]
+
+        infoMap = [block._intern_info(info + ("",)) for info in infoTable]
+        block.efro.extend(array('l', [efro]) * len(updateDate))
+        for name, col in zip(self.COLUMNS[:-1], columns):
+            getattr(block, name).extend(col)
+        block.info.extend(array('l', [infoMap[k] for k in columns[-1]]))
+        block.updateDate.extend(updateDate)
+        block.updateUser.extend(updateUser)
+
+
+def convert_feednyc_store(source, path=None):
+    """
+    Writes a FeedNYCStore of a FeedNYC pickle or CSV export, by default next to it with a .store extension, and
+    returns its path.
+    """
+    if path is None:
+        path = os.path.splitext(source)[0] + ".store"
+    FeedNYCStore(path).write(iter_feednyc_records(source))
+    return path
+
+
+def iter_feednyc_chunks(path, goodEFROs=None):
+    """
+    Yields the record tuples in a FeedNYC export a list at a time: each pickled chunk of a pickle file (a plain
+    pickled list is just a stream with one big chunk), or FEEDNYC_STREAM_CHUNK rows of a CSV export.  A chunked stream
+    never has more than FEEDNYC_STREAM_CHUNK records in memory.  CSV rows for efros not in goodEFROs (if given) are
+    dropped before they're converted.
+    """
+    if path.endswith(".csv"):
+        with open(path, 'rbU') as csvfile:
+            reader = csv.reader(csvfile)
+
+            # skip the header row
+            next(reader, None)
+
+            chunk = []
+            for row in reader:
+                efro = int(row[0])
+                if goodEFROs is not None and efro not in goodEFROs:
+                    continue
+                chunk.append((efro, row[1], row[2], row[3], row[4], row[5], int(row[6]),
+                              int(row[7]), int(row[8]), int(row[9]), int(row[10]), row[11], row[12]))
+                if len(chunk) >= FEEDNYC_STREAM_CHUNK:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        return
+
+    with open(path, 'rb') as pickleFile:
+        while True:
+            try:
+                chunk = pickle.load(pickleFile)
+            except EOFError:
+                break
+            yield chunk
+
+
+def iter_feednyc_records(path):
+    """ Yields the record tuples in a FeedNYC export one at a time (see iter_feednyc_chunks). """
+    for chunk in iter_feednyc_chunks(path):
+        for curTup in chunk:
+            yield curTup
+
+
+def select_rows(rows, goodEFROs=None, min_month=None, max_month=None):
+    """
+    The record tuples in rows for efros in goodEFROs and months in [min_month, max_month] (either test is skipped if
+    its arguments are None), in order.
+    """
+    # We dump all agency data from FeedNYC, so we need to filter by the EFROs that are for active agencies
+    # for the target years.
+    if goodEFROs is not None:
+        rows = [row for row in rows if row[0] in goodEFROs]
+    if min_month is not None:
+        rows = [row for row in rows if min_month <= int(row[6]) <= max_month]
+    return rows
+
+
+def write_feednyc_stream(records, path, chunk_size=FEEDNYC_STREAM_CHUNK):
+    """
+    Writes record tuples as a chunked pickle stream that iter_feednyc_records can read with bounded memory.
+    To convert an existing dump: write_feednyc_stream(iter_feednyc_records(old_path), new_path)
+    """
+    with open(path + ".tmp", 'wb') as streamFile:
+        chunk = []
+        for curTup in records:
+            chunk.append(curTup)
+            if len(chunk) >= chunk_size:
+                pickle.dump(chunk, streamFile, pickle.HIGHEST_PROTOCOL)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, streamFile, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + ".tmp", path)
+
+
+def read_feednyc_pickle(args):
+    """
+    Reads one fiscal year's FeedNYC export and returns the records for the given EFROs as an unfinalized
+    FeedNYCDataset, in file order.  Records are filtered a chunk at a time, on the raw tuples, so only the retained
+    ones are ever added to the dataset.  If min_month/max_month aren't None, only months in [min_month, max_month] are
+    kept.  Takes a single args tuple so it can be handed to Pool.map.
+    """
+    path, goodEFROs, min_month, max_month = args
+    if path.endswith(".store"):
+        return FeedNYCStore(path).read(goodEFROs, min_month, max_month)
+
+    block = FeedNYCDataset()
+    for chunk in iter_feednyc_chunks(path, goodEFROs):
+        block.append_rows(select_rows(chunk, goodEFROs, min_month, max_month))
+    return block
+
+
+def load_feednyc_data(years, goodEFROs, efro2data, processes=1, cache_dir=None, min_month=None, max_month=None,
+                      pickle_dir=None, export_format=None):
+    """
+    Loads the FeedNYC pickles for the given fiscal years into a FeedNYCDataset, keeping only goodEFROs and months in
+    [min_month, max_month] (by default [ANALYSIS_MIN, ANALYSIS_MAX]).  With processes > 1 the years are read in
+    parallel; the results are still merged in year order, so later years win over earlier ones exactly as with a
+    serial load.
+
+    If cache_dir is given, years with a valid FeedNYCCache entry are read from it, and the others are cached (with
+    all their months, so the entry stays good when the analysis window moves) after they're read.
+
+    The files are FeedNYC-All-<FY>.<export_format> in pickle_dir (by default FEEDNYC_PICKLE_DIR and
+    FEEDNYC_EXPORT_FORMAT).
+    """
+    if pickle_dir is None:
+        pickle_dir = FEEDNYC_PICKLE_DIR
+    if export_format is None:
+        export_format = FEEDNYC_EXPORT_FORMAT
+    if min_month is None:
+        min_month = ANALYSIS_MIN
+    if max_month is None:
+        max_month = ANALYSIS_MAX
+
+    cache = FeedNYCCache(cache_dir) if cache_dir else None
+
+    blocks = dict() # year -> FeedNYCDataset
+    to_read = []
+    for year in years:
+        source = pickle_dir + "FeedNYC-All-%d.%s" % (year, export_format)
+        block = cache.load(source, goodEFROs) if cache else None
+        if block is None:
+            to_read.append((year, source))
+        else:
+            blocks[year] = block
+
+    month_range = (None, None) if cache else (min_month, max_month)
+    jobs = [(source, goodEFROs) + month_range for year, source in to_read]
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            results = pool.map(read_feednyc_pickle, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(read_feednyc_pickle, jobs)
+
+    for (year, source), block in zip(to_read, results):
+        if cache:
+            cache.store(source, goodEFROs, block)
+        blocks[year] = block
+
+    agencyTypes = dict((efro, efro2data[efro].agencyType) for efro in goodEFROs)
+    fnData = FeedNYCDataset() # efro->month->datum
+    for year in years:
+        fnData.extend(blocks[year], agencyTypes, min_month, max_month)
+    fnData.finalize()
+    return fnData
+
+
+def read_efro_map(path, cache_dir=None):
+    """
+    STEP 1: Reads the EFRO map, reporting duplicate entries.  Returns chAcct2efro (acct -> set(efros)) and
+    efro2data (efro -> EFROData).
+    """
+    efro_map = refdata.load(refdata.parse_efro_map, path, cache_dir)
+    for message in efro_map.messages:
+        print message
+
+    return efro_map.chAcct2efro, efro_map.efro2data
+
+
+def find_active_efros(active, fiscal_years, chAcct2efro):
+    """
+    Returns the efros in the active agencies list (a refdata.ActiveAgencies) for the given fiscal years that have an
+    efro mapping, and the (name, account) entries for those years that don't.
+    """
     # names for which we don't have an EFRO mapping
     entries_wo_efromap = set()
     # efros that are active in our ranges AND have a efro mapping
     goodEFROs = set()
-    # all the ch accts
-    all_ch_accts = set()
-    with open(ACTIVE_AGENCY_CSV, 'rbU') as csvfile:
-        reader = csv.reader(csvfile)
-
-        # skip the header row
-        next(reader, None)
-
-        fyFilterSet = set(map(lambda x: "FY%s" % (x % 100), output_range_fy))
-
-        for row in reader:
-            # get rid of the unicode nonsense (thanks MSFT!)
-            row = map(lambda x: str(x.decode("ascii", "ignore")), row)
-
-            alias = row[0]
-            chAcct = row[1].replace("(", "").replace(")", "")
-            name = row[2]
-            year = row[3]
-
-            all_ch_accts.add(chAcct)
-
-            # filter by fiscal year if so specified
-            if year not in fyFilterSet:
-                continue
 
+    fyFilterSet = set(map(lambda x: "FY%s" % (x % 100), fiscal_years))
+    for year in fyFilterSet:
+        for name, chAcct in active.fy2entries.get(year, ()):
             if chAcct not in chAcct2efro:
                 entries_wo_efromap.add((name, chAcct))
             else:
                 goodEFROs.update(chAcct2efro[chAcct])
 
+    return goodEFROs, entries_wo_efromap
+
+
+def read_active_agencies(path, fiscal_years, chAcct2efro, efro2data, cache_dir=None):
+    """
+    STEP 2: Processes the active agencies list (from CH), reporting agencies missing from it or from the EFRO map.
+    Returns the efros that are active in the given fiscal years AND have an efro mapping.
+    """
+    active = refdata.load(refdata.parse_active_agencies, path, cache_dir)
+    goodEFROs, entries_wo_efromap = find_active_efros(active, fiscal_years, chAcct2efro)
+    print_active_agency_problems(active, entries_wo_efromap, chAcct2efro, efro2data)
+    return goodEFROs
+
+
+def print_active_agency_problems(active, entries_wo_efromap, chAcct2efro, efro2data):
     # Print out agencies for which we have an entry in the EFRO map but no entry in the active agencies list
-    for account in set(chAcct2efro.keys()) - all_ch_accts:
+    for account in set(chAcct2efro.keys()) - active.all_ch_accts:
         name = efro2data[list(chAcct2efro[account])[0]].name
         print("active-agency never-active\t%s\t%s" % (account, name))
 
@@ -474,63 +1979,292 @@ if __name__ == "__main__":
     for name, account in entries_wo_efromap:
         print("active-agency no-efro-entry\t%s\t%s" % (account, name))
 
-    # STEP 3
-    # Don't analyze data for defunct agencies
-    defunct_efros = set()
-    with open(DEFUNCT_AGENCIES_CSV, 'rbU') as csvfile:
-        reader = csv.reader(csvfile)
-
-        # skip the header row
-        next(reader, None)
-
-        for row in reader:
-            # get rid of the unicode nonsense (thanks MSFT!)
-            row = map(lambda x: str(x.decode("ascii", "ignore")), row)
-
-            defunct_efros.add(int(row[0]))
-
-    # Don't print out data for any defunct agencies
-    goodEFROs -= defunct_efros
-
-    # STEP 4
-    # Read in the pickles
-    # The data is stored by fiscal year.
-    fnData = defaultdict(dict) # efro->month->datum
-    for year in analysis_range_fy:
-        with open(FEEDNYC_PICKLE_DIR + "FeedNYC-All-%d.pickle" % year, 'r') as pickleFile:
-            for curTup in pickle.load(pickleFile):
-                datum = FeedNYCDatum(curTup)
-                if datum.sampleMonth < ANALYSIS_MIN or datum.sampleMonth > ANALYSIS_MAX:
-                    continue
 
-                # We dump all agency data from FeedNYC, so we need to filter by the EFROs that are for active agencies
-                # for the target years.
-                if datum.efro in goodEFROs:
-                    datum.agencyType = efro2data[datum.efro].agencyType
-                    fnData[datum.efro][datum.sampleMonth] = datum
+def read_defunct_agencies(path, cache_dir=None):
+    """ STEP 3: Returns the efros of defunct agencies, whose data we don't analyze. """
+    return refdata.load(refdata.parse_defunct_agencies, path, cache_dir)
+
+
+def make_filters(output_min=None, output_max=None, history=None, config=None):
+    """
+    The STEP 6 filters, in output order, reporting on [output_min, output_max] (by default OUTPUT_MIN..MAX) and
+    checking errors against history (by default, none have been reviewed).  The thresholds come from config (a
+    FeedNYCConfig), or the module settings.
+    """
+    config = config or FeedNYCConfig()
+    filters = [MealFactorFilter(),
+               SimilarFilter(config.similar_sensitivity, config.similar_thresh_abs, config.similar_thresh_rel),
+               SkippedDataFilter(),
+               ZeroFilter(),
+               OutlierFilter(config.outlier_max_stddev)]
+    for f in filters:
+        if output_min is not None:
+            f.set_output_window(output_min, output_max)
+        if history is not None:
+            f.set_error_history(history)
+    return filters
+
+
+def window_report_sink(report_format, report_dir, window):
+    """
+    The report sink for one batch window: <analysis min>-<analysis max>.<output min>-<output max> in report_dir, as a
+    .csv (report_format "stdout" or "csv") or .jsonl file, or a csv-per-flag directory.
+    """
+    path = os.path.join(report_dir, "%d-%d.%d-%d" % window)
+    if report_format in ("stdout", "csv"):
+        return make_report_sink("csv", path + ".csv")
+    if report_format == "jsonl":
+        return make_report_sink("jsonl", path + ".jsonl")
+    return make_report_sink(report_format, path)
+
+
+def run_windows(fnData, windows, window_efros, report_dir, report_format="stdout", history=None, config=None):
+    """
+    Batch mode STEP 6: runs the filters over fnData for each (analysis min, analysis max, output min, output max)
+    window and writes the window's report to report_dir (see window_report_sink).  window_efros maps each window to
+    the efros to report on; history and config are as for make_filters.  The EFROProfiles are built once per EFRO
+    and analysis range, and shared by all the windows with that analysis range.
+    """
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+
+    profiles = defaultdict(dict) # (analysis min, analysis max) -> efro -> EFROProfile
+    for window in windows:
+        analysis_min, analysis_max, output_min, output_max = window
+
+        pipeline = FilterPipeline(make_filters(output_min, output_max, history, config))
+        pipeline.run_items(fnData.window(window_efros[window], analysis_min, analysis_max),
+                           profiles[(analysis_min, analysis_max)])
+
+        sink = window_report_sink(report_format, report_dir, window)
+        pipeline.print_report(sink, (config or FeedNYCConfig()).report_rows)
+        sink.close()
 
-    # print out an error if we didn't see all the efros we expected
-    for efro in goodEFROs - set(fnData.keys()):
-        print("feednyc-data no-data\t\t%d\t%s" % (efro, efro2data[efro].name))
 
-    # STEP 5
-    # Figure out which issues have already been analyzed
-    prev_error_map = defaultdict(dict) # flag->id->doPrint
-    with open(ERROR_HISTORY_CSV, 'rbU') as csvfile:
-        reader = csv.reader(csvfile)
+def get_years_in_range(min_month, max_month):
+    # inputs are YYYYMM
+    # Figure out our date range
+    minY = int(math.floor(min_month / 100))
+    minM = int(min_month % 100)
+    maxY = int(math.floor(max_month / 100))
+    maxM = int(max_month  % 100)
+    cal_year = range(minY, maxY + 1)
+    # we need to do this to split on fiscal years correctly
+    # FYxx is from July 1, 20xx-1 to June 30, 20xx, i.e., FYxx ends in 20xx
+    if minM > 6:
+        minY += 1
+    if maxM > 6:
+        maxY += 1
+    fiscal_year = range(minY, maxY + 1)
+
+    return cal_year, fiscal_year
+
+# -----------------------------------------------------------------------------
+# Library interface
+
+
+class FeedNYCConfig:
+    """
+    Settings for a FeedNYC session.  Each defaults to the module setting of the same name in upper case
+    (analysis_min is ANALYSIS_MIN, efro_map_csv is EFRO_MAP_CSV, ...) as it is when the config is made.
+    """
+    SETTINGS = ["analysis_min", "analysis_max", "output_min", "output_max",
+                "similar_sensitivity", "similar_thresh_abs", "similar_thresh_rel", "outlier_max_stddev",
+                "incremental_state_file", "loader_processes", "filter_processes", "startup_threads",
+                "feednyc_pickle_dir", "feednyc_export_format", "feednyc_cache_dir",
+                "active_agency_csv", "efro_map_csv", "defunct_agencies_csv", "error_history_csv",
+                "report_format", "report_path", "report_rows", "batch_windows", "batch_report_dir"]
+
+    def __init__(self, **settings):
+        for name in self.SETTINGS:
+            setattr(self, name, globals()[name.upper()])
+        for name, value in settings.items():
+            if name not in self.SETTINGS:
+                raise TypeError("unknown FeedNYC setting: %s" % name)
+            setattr(self, name, value)
+
+
+class FeedNYC:
+    """
+    The analysis as a library.  Nothing is read when the session is made: each input (the reference CSVs, the error
+    history, the FeedNYC data for an analysis range) is loaded the first time it's asked for and kept for the life of
+    the session.  Reference data problems are printed when the file is loaded, as in a normal run.
+    """
+    def __init__(self, config=None):
+        self.config = config or FeedNYCConfig()
+        self.efroMap = None
+        self.active = None
+        self.defunct = None
+        self.history = None
+        self.datasets = dict() # (efros, analysis min, analysis max) -> FeedNYCDataset
+
+    def efro_map(self):
+        """ Returns (chAcct2efro, efro2data), as read_efro_map does. """
+        if self.efroMap is None:
+            self.efroMap = read_efro_map(self.config.efro_map_csv, self.config.feednyc_cache_dir)
+        return self.efroMap
+
+    def active_agencies(self):
+        """ The active agencies list, as a refdata.ActiveAgencies. """
+        if self.active is None:
+            self.active = refdata.load(refdata.parse_active_agencies, self.config.active_agency_csv,
+                                       self.config.feednyc_cache_dir)
+        return self.active
+
+    def active_efros(self, fiscal_years, report=False):
+        """
+        The efros that are active in fiscal_years and have an efro mapping (defunct ones included).  With report set,
+        prints the agencies missing from the active agencies list or the EFRO map (STEP 2).
+        """
+        chAcct2efro, efro2data = self.efro_map()
+        goodEFROs, entries_wo_efromap = find_active_efros(self.active_agencies(), fiscal_years, chAcct2efro)
+        if report:
+            print_active_agency_problems(self.active_agencies(), entries_wo_efromap, chAcct2efro, efro2data)
+        return goodEFROs
+
+    def defunct_efros(self):
+        if self.defunct is None:
+            self.defunct = read_defunct_agencies(self.config.defunct_agencies_csv, self.config.feednyc_cache_dir)
+        return self.defunct
+
+    def report_efros(self, output_min=None, output_max=None, report=False):
+        """ The efros to report on for an output window (by default the config's): active, mapped and not defunct. """
+        if output_min is None:
+            output_min, output_max = self.config.output_min, self.config.output_max
+        output_range_fy = get_years_in_range(output_min, output_max)[1]
+        return self.active_efros(output_range_fy, report) - self.defunct_efros()
+
+    def error_history(self, report=True):
+        """ The ErrorHistory.  With report set, problems in the file are printed when it's loaded (STEP 5). """
+        if self.history is None:
+            history = ErrorHistory()
+            history.load(self.config.error_history_csv)
+            if report:
+                history.print_messages()
+            self.history = history
+        return self.history
+
+    def data(self, efros, analysis_min=None, analysis_max=None):
+        """ The FeedNYCDataset of efros' records in [analysis_min, analysis_max] (by default the config's). """
+        if analysis_min is None:
+            analysis_min, analysis_max = self.config.analysis_min, self.config.analysis_max
+        key = (frozenset(efros), analysis_min, analysis_max)
+        if key not in self.datasets:
+            efro2data = self.efro_map()[1]
+            self.datasets[key] = load_feednyc_data(get_years_in_range(analysis_min, analysis_max)[1], set(efros),
+                                                   efro2data, self.config.loader_processes,
+                                                   self.config.feednyc_cache_dir, analysis_min, analysis_max,
+                                                   self.config.feednyc_pickle_dir, self.config.feednyc_export_format)
+        return self.datasets[key]
+
+    def startup(self, output_range_fy, analysis_min=None, analysis_max=None):
+        """
+        STEPs 1-5 as a taskgraph.TaskGraph on config.startup_threads threads, not yet run.  The reference CSVs and the
+        error history are read side by side; the pickles start loading once the efros to report on (the "step3-..."
+        task's value) are known.  Reference data problems are printed by the efro map and report efros tasks, which
+        run one after the other, so the output comes out in the usual order; the error history's problems are left
+        for the caller to print (error_history().print_messages()) once the graph has run.
 
-        # skip the header row
-        next(reader, None)
+        Each task runs as the stage of the same name, so with instrumentation on every step gets its row in the table.
+        """
+        graph = taskgraph.TaskGraph(self.config.startup_threads)
+
+        def add(name, fn, deps=(), count=None):
+            # count(value) is the stage's records out
+            def run(*args):
+                with stages.stage(name) as stage:
+                    value = fn(*args)
+                    if count is not None:
+                        stage.records_out = count(value)
+                return value
+            graph.add(name, run, deps)
+
+        add("step1-efro-map", self.efro_map, count=lambda efroMap: len(efroMap[1]))
+        add("step2-active-agencies", self.active_agencies, count=lambda active: len(active.all_ch_accts))
+        add("step3-defunct-agencies", self.defunct_efros, count=len)
+        add("step3-report-efros",
+            lambda efroMap, active, defunct: self.active_efros(output_range_fy, report=True) - defunct,
+            ["step1-efro-map", "step2-active-agencies", "step3-defunct-agencies"], count=len)
+        add("step4-load", lambda efros: self.data(efros, analysis_min, analysis_max), ["step3-report-efros"],
+            count=lambda fnData: fnData.record_count())
+        add("step5-error-history", lambda: self.error_history(report=False))
+        return graph
+
+    def filters(self, output_min=None, output_max=None):
+        """ New STEP 6 filters for an output window (by default the config's), checked against the error history. """
+        if output_min is None:
+            output_min, output_max = self.config.output_min, self.config.output_max
+        return make_filters(output_min, output_max, self.error_history(), self.config)
+
+    def analyze(self, fnData, efros):
+        """
+        STEP 6: runs the filters over fnData (incrementally, if the config has an incremental_state_file that exists)
+        and returns the FilterPipeline, ready for report().
+        """
+        state_file = self.config.incremental_state_file
+        pipeline = FilterPipeline(self.filters())
+        if state_file and os.path.exists(state_file):
+            state = load_incremental_state(state_file)
+            pipeline.run_incremental(fnData, state, efros)
+        else:
+            pipeline.run_sharded(fnData, self.config.filter_processes)
+            if state_file:
+                # first incremental run: just record where we are
+                state = IncrementalState()
+                state.update(fnData, [], efros)
+        if state_file:
+            state.save(state_file)
+        return pipeline
+
+    def analyze_windows(self, fnData, windows, report_dir=None):
+        """ Batch mode STEP 6: run_windows over windows, each reporting on the efros report_efros gives it. """
+        window_efros = dict((window, self.report_efros(window[2], window[3])) for window in windows)
+        run_windows(fnData, windows, window_efros, report_dir or self.config.batch_report_dir,
+                    self.config.report_format, self.error_history(), self.config)
+
+    def report(self, pipeline, sink=None):
+        """ Writes pipeline's bad data to sink (by default the config's report); returns the number of rows. """
+        close = sink is None
+        if close:
+            sink = make_report_sink(self.config.report_format, self.config.report_path)
+        rows = pipeline.print_report(sink, self.config.report_rows)
+        if close:
+            sink.close()
+        return rows
 
-        for row in reader:
-            # get rid of the unicode nonsense (thanks MSFT!)
-            row = map(lambda x: str(x.decode("ascii", "ignore")), row)
+#-----------------------------------------------------------------------------
 
-            id = row[0]
-            flag = row[1]
-            do_print = (row[2] == "y" or row[2] == "Y")
+if __name__ == "__main__":
+    feednyc = FeedNYC()
+    config = feednyc.config
 
-            prev_error_map[flag][id] = do_print
+    # Figure out our date range
+    if config.batch_windows:
+        # load once for all the windows
+        analysis_min = min(window[0] for window in config.batch_windows)
+        analysis_max = max(window[1] for window in config.batch_windows)
+        output_range_fy = sorted(set(fy for window in config.batch_windows
+                                     for fy in get_years_in_range(window[2], window[3])[1]))
+    else:
+        analysis_min, analysis_max = config.analysis_min, config.analysis_max
+        output_range_cy, output_range_fy = get_years_in_range(config.output_min, config.output_max)
+
+    # STEPs 1-5
+    # Read in the EFRO Map, process the active agencies list (from CH), don't print out data for any defunct
+    # agencies, read in the pickles (the data is stored by fiscal year) and figure out which issues have already been
+    # analyzed, each as soon as what it needs is read
+    startup = feednyc.startup(output_range_fy, analysis_min, analysis_max)
+    startup.run()
+    chAcct2efro, efro2data = startup.value("step1-efro-map")
+    goodEFROs = startup.value("step3-report-efros")
+    fnData = startup.value("step4-load") # efro->month->datum
+
+    # print out an error if we didn't see all the efros we expected
+    for efro in goodEFROs - set(fnData.keys()):
+        print("feednyc-data no-data\t\t%d\t%s" % (efro, efro2data[efro].name))
+
+    # and any problems with the error history
+    feednyc.error_history().print_messages()
 
     # STEP 6
     # Now do some filtering
@@ -538,23 +2272,17 @@ if __name__ == "__main__":
     # print a separator
     print ""
 
-    f = MealFactorFilter()
-    f.filter(fnData)
-    f.print_header()
-    f.print_bad_data()
-
-    f = SimilarFilter(SIMILAR_SENSITIVITY, SIMILAR_THRESH_ABS, SIMILAR_THRESH_REL)
-    f.filter(fnData)
-    f.print_bad_data()
-
-    f = SkippedDataFilter()
-    f.filter(fnData)
-    f.print_bad_data()
+    if config.batch_windows:
+        with stages.stage("step6-batch", fnData.record_count()):
+            feednyc.analyze_windows(fnData, config.batch_windows)
+    else:
+        with stages.stage("step6-filter", fnData.record_count()) as stage:
+            pipeline = feednyc.analyze(fnData, goodEFROs)
+            stage.records_out = sum(f.bad_data_count() for f in pipeline.filters)
 
-    f = ZeroFilter()
-    f.filter(fnData)
-    f.print_bad_data()
+        with stages.stage("step6-print", stage.records_out) as stage:
+            stage.records_out = feednyc.report(pipeline)
 
-    f = OutlierFilter(OUTLIER_MAX_STDDEV)
-    f.filter(fnData)
-    f.print_bad_data()
+    if stages.enabled:
+        startup.report()
+    stages.report()
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+import BaseHTTPServer
+import copy
+import hashlib
+import json
+import os
+import urlparse
+
+from collections import OrderedDict, defaultdict
+from StringIO import StringIO
+
+import feednyc
+
+# -----------------------------------------------------------------------------
+# Long-running feednyc.py: keeps the EFRO map, agency lists, error history and FeedNYC data in memory and runs the
+# STEP 6 filters for one window per request, over HTTP on a local port.
+#
+#   curl 'http://127.0.0.1:8765/run?analysis_min=201307&analysis_max=201404&output_min=201401&output_max=201404'
+#
+# returns the CSV report for that window (any of the four left out default to feednyc's settings), and
+# similar_sensitivity, similar_thresh_abs, similar_thresh_rel, outlier_max_stddev and report_rows can be set the same
+# way.
+# /status returns what's loaded, as JSON.
+#
+# The input files are checked before each request and every SERVICE_POLL_SECONDS while idle.  Only the ones that
+# changed are reloaded: one fiscal year's pickle, one of the reference CSVs, or, when rows were only appended to the
+# error history, just the new rows.  Reports are cached per window, filter settings and version of the inputs the
+# window reads, so a reload only recomputes the windows it affects.
+# -----------------------------------------------------------------------------
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_POLL_SECONDS = 2
+# reports kept in the result cache (least recently used ones go first)
+SERVICE_CACHE_SIZE = 256
+
+WINDOW_SETTINGS = ("analysis_min", "analysis_max", "output_min", "output_max")
+# filter and report settings a request can override, and their types
+FILTER_SETTINGS = (("similar_sensitivity", int), ("similar_thresh_abs", float), ("similar_thresh_rel", float),
+                   ("outlier_max_stddev", float), ("report_rows", str))
+
+
+def file_version(path):
+    """ (mtime, size) of path, or None if it doesn't exist. """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def prefix_digest(path, length):
+    with open(path, 'rb') as inFile:
+        return hashlib.md5(inFile.read(length)).hexdigest()
+
+
+class ResidentFeedNYC(feednyc.FeedNYC):
+    """
+    A FeedNYC session that keeps its inputs between requests.  refresh() drops the ones whose files have changed, so
+    they're reloaded the next time they're asked for.  The fiscal-year pickles are held as separate blocks (with all
+    their months, for every mapped efro) and merged into one dataset, so any window can be run from them.
+
+    Each input has a version, bumped whenever it's (re)loaded; data_version(window) is the versions of the inputs a
+    window's report depends on.
+    """
+    REFDATA = (("efro-map", "efro_map_csv", "efroMap"), ("active-agencies", "active_agency_csv", "active"),
+               ("defunct-agencies", "defunct_agencies_csv", "defunct"))
+
+    def __init__(self, config=None):
+        feednyc.FeedNYC.__init__(self, config)
+        self.generation = 0
+        self.versions = dict()   # input name -> version
+        self.readFrom = dict()   # input name -> (path, file_version of it when it was read)
+        self.blocks = dict()     # fiscal year -> unfinalized FeedNYCDataset
+        self.dataset = None      # the blocks, merged
+        self.profiles = defaultdict(dict)  # (analysis min, analysis max) -> efro -> EFROProfile, for dataset
+        self.historyOffset = 0
+        self.historyDigest = None
+
+    def note_read(self, name, path):
+        self.generation += 1
+        self.versions[name] = self.generation
+        self.readFrom[name] = (path, file_version(path))
+
+    def changed(self, name):
+        if name not in self.readFrom:
+            return False
+        path, version = self.readFrom[name]
+        return file_version(path) != version
+
+    def refresh(self):
+        """ Drops (or, for appended error history rows, reads) what changed on disk; returns the changed inputs. """
+        changed = [name for name in self.readFrom if self.changed(name)]
+        for name in changed:
+            self.readFrom.pop(name, None)
+            if name == "error-history":
+                self.refresh_history()
+            elif name.startswith("FY"):
+                self.drop_year(int(name[2:]))
+            else:
+                setattr(self, dict((n, attr) for n, setting, attr in self.REFDATA)[name], None)
+                if name == "efro-map":
+                    # the blocks only have the efros that were mapped
+                    for year in self.blocks.keys():
+                        self.drop_year(year)
+        return changed
+
+    def drop_year(self, year):
+        self.blocks.pop(year, None)
+        self.readFrom.pop("FY%d" % year, None)
+        self.dataset = None
+
+    def refresh_history(self):
+        path = self.config.error_history_csv
+        version = file_version(path)
+        if self.history is not None and version is not None and version[1] >= self.historyOffset and \
+                prefix_digest(path, self.historyOffset) == self.historyDigest:
+            # rows were only appended
+            self.read_history(self.history)
+        else:
+            self.history = None
+
+    def read_history(self, history, report=True):
+        path = self.config.error_history_csv
+        self.note_read("error-history", path)
+        self.historyOffset = history.load(path, self.historyOffset)
+        if report:
+            history.print_messages()
+        self.historyDigest = prefix_digest(path, self.historyOffset)
+
+    def efro_map(self):
+        if self.efroMap is None:
+            self.note_read("efro-map", self.config.efro_map_csv)
+        return feednyc.FeedNYC.efro_map(self)
+
+    def active_agencies(self):
+        if self.active is None:
+            self.note_read("active-agencies", self.config.active_agency_csv)
+        return feednyc.FeedNYC.active_agencies(self)
+
+    def defunct_efros(self):
+        if self.defunct is None:
+            self.note_read("defunct-agencies", self.config.defunct_agencies_csv)
+        return feednyc.FeedNYC.defunct_efros(self)
+
+    def error_history(self, report=True):
+        if self.history is None:
+            self.historyOffset = 0
+            history = feednyc.ErrorHistory()
+            self.read_history(history, report)
+            self.history = history
+        return self.history
+
+    def year_block(self, year):
+        """ One fiscal year's records for every mapped efro, read (or taken from the cache) if it isn't resident. """
+        if year not in self.blocks:
+            config = self.config
+            source = config.feednyc_pickle_dir + "FeedNYC-All-%d.%s" % (year, config.feednyc_export_format)
+            efros = set(self.efro_map()[1])
+            self.note_read("FY%d" % year, source)
+
+            # not feednyc_cache_dir itself: its entries are for the efro set of a normal run
+            cache = feednyc.FeedNYCCache(os.path.join(config.feednyc_cache_dir, "service")) \
+                if config.feednyc_cache_dir else None
+            try:
+                block = cache.load(source, efros) if cache else None
+                if block is None:
+                    block = feednyc.read_feednyc_pickle((source, efros, None, None))
+                    if cache:
+                        cache.store(source, efros, block)
+            except (IOError, OSError):
+                # not loaded, so there's nothing to version
+                self.readFrom.pop("FY%d" % year, None)
+                self.versions.pop("FY%d" % year, None)
+                raise
+            self.blocks[year] = block
+            self.dataset = None
+        return self.blocks[year]
+
+    def resident_data(self, years):
+        """ The merged dataset of all the resident fiscal years, after loading any of years that aren't. """
+        for year in years:
+            self.year_block(year)
+        if self.dataset is None:
+            efro2data = self.efro_map()[1]
+            agencyTypes = dict((efro, data.agencyType) for efro, data in efro2data.items())
+            self.dataset = feednyc.FeedNYCDataset()
+            for year in sorted(self.blocks):
+                self.dataset.extend(self.blocks[year], agencyTypes)
+            self.dataset.finalize()
+            self.profiles = defaultdict(dict)
+        return self.dataset
+
+    def data_version(self, window):
+        years = feednyc.get_years_in_range(window[0], window[1])[1]
+        names = [name for name, setting, attr in self.REFDATA] + ["error-history"] + ["FY%d" % y for y in years]
+        return tuple(self.versions.get(name) for name in names)
+
+    def prepare(self, window):
+        """ Loads everything the window's report reads. """
+        self.report_efros(window[2], window[3])
+        self.error_history()
+        self.resident_data(feednyc.get_years_in_range(window[0], window[1])[1])
+
+    def run_window(self, window, config):
+        """ The CSV report (header and rows) for one window, with config's filter settings. """
+        analysis_min, analysis_max, output_min, output_max = window
+        fnData = self.resident_data(feednyc.get_years_in_range(analysis_min, analysis_max)[1])
+
+        pipeline = feednyc.FilterPipeline(feednyc.make_filters(output_min, output_max, self.error_history(), config))
+        pipeline.run_items(fnData.window(self.report_efros(output_min, output_max), analysis_min, analysis_max),
+                           self.profiles[(analysis_min, analysis_max)])
+
+        sink = feednyc.StdoutSink(StringIO())
+        pipeline.print_report(sink, config.report_rows)
+        sink.close()
+        return sink.stream.getvalue()
+
+
+class ResultCache:
+    """ The most recent size reports, by (window, filter settings, data version). """
+    def __init__(self, size=SERVICE_CACHE_SIZE):
+        self.size = size
+        self.reports = OrderedDict()
+
+    def get(self, key):
+        report = self.reports.pop(key, None)
+        if report is not None:
+            self.reports[key] = report
+        return report
+
+    def put(self, key, report):
+        self.reports[key] = report
+        while len(self.reports) > self.size:
+            self.reports.popitem(last=False)
+
+
+class FeedNYCService:
+    def __init__(self, session=None, cache_size=SERVICE_CACHE_SIZE):
+        self.session = session or ResidentFeedNYC()
+        self.cache = ResultCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        changed = self.session.refresh()
+        if changed:
+            print("service reload\t%s" % " ".join(sorted(changed)))
+        return changed
+
+    def request_settings(self, query):
+        """
+        The window and the config for a request's query (name -> string value); anything it doesn't set comes from
+        the session's config.  Raises ValueError for unknown names or bad values.
+        """
+        config = copy.copy(self.session.config)
+        types = dict(FILTER_SETTINGS)
+        types.update((name, int) for name in WINDOW_SETTINGS)
+        for name, value in query.items():
+            if name not in types:
+                raise ValueError("unknown setting %s" % name)
+            setattr(config, name, types[name](value))
+
+        window = tuple(getattr(config, name) for name in WINDOW_SETTINGS)
+        for name, month in zip(WINDOW_SETTINGS, window):
+            if month <= 0 or feednyc.index_month(feednyc.month_index(month)) != month:
+                raise ValueError("%s %d isn't a YYYYMM month" % (name, month))
+        if window[0] > window[2] or window[3] > window[1]:
+            raise ValueError("output window %d-%d isn't inside analysis window %d-%d" %
+                             (window[2], window[3], window[0], window[1]))
+        return window, config
+
+    def run(self, query):
+        """
+        Returns the report for a request's query, and whether it came from the cache.  Raises ValueError for a bad
+        query, and IOError/OSError if an input the window needs can't be read.
+        """
+        window, config = self.request_settings(query)
+        self.refresh()
+        self.session.prepare(window)
+
+        key = (window, tuple(getattr(config, name) for name, type in FILTER_SETTINGS),
+               self.session.data_version(window))
+        report = self.cache.get(key)
+        if report is not None:
+            self.hits += 1
+            return report, True
+
+        self.misses += 1
+        report = self.session.run_window(window, config)
+        self.cache.put(key, report)
+        return report, False
+
+    def status(self):
+        session = self.session
+        return {'versions': session.versions,
+                'fiscal_years': sorted(session.blocks),
+                'records': session.dataset.record_count() if session.dataset is not None else 0,
+                'cached_reports': len(self.cache.reports),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses}
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        service = self.server.service
+
+        if url.path == "/run":
+            try:
+                report, cached = service.run(dict(urlparse.parse_qsl(url.query)))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            except (IOError, OSError) as e:
+                # e.g. no pickle for one of the window's fiscal years
+                self.send_error(404, "missing input %s (%s)" % (e.filename, e.strerror))
+                return
+            self.reply(report, "text/csv", {'X-FeedNYC-Cached': "yes" if cached else "no"})
+        elif url.path == "/status":
+            self.reply(json.dumps(service.status(), sort_keys=True) + "\n", "application/json")
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(service, host=SERVICE_HOST, port=SERVICE_PORT, poll_seconds=SERVICE_POLL_SECONDS):
+    """ Answers requests one at a time, refreshing the service's inputs whenever it's idle for poll_seconds. """
+    server = BaseHTTPServer.HTTPServer((host, port), ServiceHandler)
+    server.service = service
+    server.timeout = poll_seconds
+    server.handle_timeout = service.refresh
+    print("service listening\t%s:%d" % (host, port))
+    while True:
+        server.handle_request()
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    service = FeedNYCService()
+
+    # load the default window's inputs up front, so the first request doesn't wait for them
+    service.session.prepare(tuple(getattr(service.session.config, name) for name in WINDOW_SETTINGS))
+    serve(service)
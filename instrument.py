@@ -0,0 +1,185 @@
+#!/usr/bin/python
+import cProfile
+import pstats
+import resource
+import sys
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# Per-stage instrumentation for feednyc.py.
+#
+# Each stage (a STEP, a filter, the output for a filter) keeps its wall time, CPU time, records in/out and how much
+# the peak memory of the process grew while it ran, summed over however many times it ran.  One stage can also be run
+# under cProfile.  When instrumentation is off, stage() hands back a do-nothing object, so the instrumented code
+# costs about a function call per stage.
+#
+# Stages can run on several threads at once (feednyc.py's startup tasks): the stats are updated under a lock, and a
+# profiled stage profiles the thread it runs on.  CPU time and peak memory are the process's, so stages that overlap
+# each count what the others used while they ran.
+# -----------------------------------------------------------------------------
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # OS X reports bytes, Linux KB
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.recordsIn = None
+        self.recordsOut = None
+        self.memDelta = 0  # KB the peak RSS grew by
+
+    def add_records(self, records_in, records_out):
+        if records_in is not None:
+            self.recordsIn = (self.recordsIn or 0) + records_in
+        if records_out is not None:
+            self.recordsOut = (self.recordsOut or 0) + records_out
+
+
+class Stage:
+    """
+    One timed run of a stage, as a context manager.  records_in/records_out can be set inside the with block, once
+    they're known.
+    """
+    def __init__(self, instrumentation, stats, records_in):
+        self.instrumentation = instrumentation
+        self.stats = stats
+        self.records_in = records_in
+        self.records_out = None
+
+    def __enter__(self):
+        self.profiler = self.instrumentation.profiler_for(self.stats.name)
+        self.peak = peak_rss_kb()
+        self.cpu = time.clock()
+        self.wall = time.time()
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler:
+            self.profiler.disable()
+        self.instrumentation.add(self.stats.name, time.time() - self.wall, time.clock() - self.cpu, self.records_in,
+                                 self.records_out, peak_rss_kb() - self.peak)
+        return False
+
+
+class NullStage:
+    """ What stage() returns when instrumentation is off: a new one each time, as callers set records_out on it. """
+    def __init__(self):
+        self.records_in = None
+        self.records_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class ProfileStats:
+    """ Profile stats collected elsewhere (Instrumentation.take_profile's), in a form pstats.Stats can read. """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, profile_stage=None, profile_path=None):
+        self.enabled = enabled
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.profiler = None
+        self.profiles = []   # ProfileStats of profile_stage added from elsewhere, e.g. worker processes
+        self.stats = dict()  # name -> StageStats
+        self.order = []      # stage names, in the order they first ran
+        self._lock = threading.Lock()
+
+    def stage(self, name, records_in=None):
+        """ Returns a context manager that times a run of the named stage. """
+        if not self.enabled:
+            return NullStage()
+        return Stage(self, self.stage_stats(name), records_in)
+
+    def stage_stats(self, name):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StageStats(name)
+                self.order.append(name)
+            return stats
+
+    def add(self, name, wall, cpu, records_in=None, records_out=None, mem_delta=0):
+        """
+        Adds time measured elsewhere (e.g. summed over a loop, or in another process) to the named stage, as one call.
+        """
+        stats = self.stage_stats(name)
+        with self._lock:
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.memDelta += mem_delta
+            stats.add_records(records_in, records_out)
+
+    def profiler_for(self, name):
+        if name != self.profile_stage:
+            return None
+        with self._lock:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            return self.profiler
+
+    def take_profile(self):
+        """
+        The profile stats of profile_stage's runs so far, for add_profile in another process; the profile starts over.
+        None if nothing was profiled.
+        """
+        with self._lock:
+            profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return None
+        profiler.create_stats()
+        return profiler.stats or None
+
+    def add_profile(self, stats):
+        """ Adds what take_profile returned to profile_stage's profile. """
+        if stats:
+            with self._lock:
+                self.profiles.append(ProfileStats(stats))
+
+    def report(self, stream=None):
+        """ Writes the summary table (and the profile of profile_stage, if it ran and there's no profile_path). """
+        if not self.enabled:
+            return
+        stream = stream or sys.stderr
+
+        def count(n):
+            return "-" if n is None else "%d" % n
+
+        stream.write("%-32s %6s %10s %10s %12s %12s %10s\n" %
+                     ("stage", "calls", "wall (s)", "cpu (s)", "records in", "records out", "peak +KB"))
+        for name in self.order:
+            stats = self.stats[name]
+            stream.write("%-32s %6d %10.3f %10.3f %12s %12s %10d\n" %
+                         (name, stats.calls, stats.wall, stats.cpu, count(stats.recordsIn), count(stats.recordsOut),
+                          stats.memDelta))
+
+        profiles = ([self.profiler] if self.profiler is not None else []) + self.profiles
+        if profiles:
+            profile = pstats.Stats(*profiles, stream=stream)
+            if self.profile_path:
+                profile.dump_stats(self.profile_path)
+            else:
+                stream.write("\nprofile of %s\n" % self.profile_stage)
+                profile.sort_stats("cumulative").print_stats(25)
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+import csv
+import errno
+import os
+import cPickle as pickle
+
+from collections import defaultdict
+
+# -----------------------------------------------------------------------------
+# Reference data for feednyc.py: the EFRO map, the active agencies list and the defunct agencies list.
+#
+# Each file is parsed once into indexed structures, which are pickled to a cache directory and reused until the file
+# changes (mtime or size).  Problems found while parsing are kept with the parsed data, so they're reported the same
+# way whether or not it came from the cache.
+# -----------------------------------------------------------------------------
+
+CACHE_VERSION = 2
+
+
+def decode_row(row):
+    # get rid of the unicode nonsense (thanks MSFT!)
+    return map(lambda x: str(x.decode("ascii", "ignore")), row)
+
+
+class EFROData(object):
+    __slots__ = ('efro', 'chAcct', 'idAlias', 'name', 'agencyType')
+
+
+class EFROMap:
+    def __init__(self):
+        self.chAcct2efro = defaultdict(set)  # acct -> set(efros)
+        self.efro2data = dict()              # efro -> data (should be unique)
+        self.entries = dict()                # (acct, alias, agency type) -> efro
+        self.messages = []                   # problems found while parsing
+
+
+class ActiveAgencies:
+    def __init__(self):
+        self.fy2entries = defaultdict(set)   # "FYxx" -> set((name, acct))
+        self.all_ch_accts = set()
+
+
+def parse_efro_map(path):
+    efro_map = EFROMap()
+    with open(path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header rows
+        next(reader, None)
+        next(reader, None)
+
+        for row in reader:
+            row = decode_row(row)
+
+            efro_data = EFROData()
+            efro_data.efro = int(row[0])
+            efro_data.chAcct = row[1]
+            efro_data.idAlias = row[2]
+            efro_data.name = row[3]
+            efro_data.agencyType = row[4]
+
+            # Make sure there aren't duplicate efros
+            if efro_data.efro in efro_map.efro2data:
+                efro_map.messages.append("efro-map duplicate-efros\t%s\t%s" % (efro_data.efro, efro_data.name))
+                continue
+
+            # Also, make sure that if the account and alias are the same, then the agency types differ.
+            key = (efro_data.chAcct, efro_data.idAlias, efro_data.agencyType)
+            if key in efro_map.entries:
+                efro_map.messages.append("efro-map duplicate-entries\t%s\t%-40s%s\t%s\tefros %d %d" %
+                                         (efro_data.chAcct, efro_data.name, efro_data.idAlias,
+                                          efro_data.agencyType, efro_data.efro, efro_map.entries[key]))
+                continue
+
+            efro_map.entries[key] = efro_data.efro
+            efro_map.chAcct2efro[efro_data.chAcct].add(efro_data.efro)
+            efro_map.efro2data[efro_data.efro] = efro_data
+
+    return efro_map
+
+
+def parse_active_agencies(path):
+    active = ActiveAgencies()
+    with open(path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header row
+        next(reader, None)
+
+        for row in reader:
+            row = decode_row(row)
+
+            chAcct = row[1].replace("(", "").replace(")", "")
+            name = row[2]
+            year = row[3]
+
+            active.all_ch_accts.add(chAcct)
+            active.fy2entries[year].add((name, chAcct))
+
+    return active
+
+
+def parse_defunct_agencies(path):
+    defunct_efros = set()
+    with open(path, 'rbU') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # skip the header row
+        next(reader, None)
+
+        for row in reader:
+            defunct_efros.add(int(decode_row(row)[0]))
+
+    return defunct_efros
+
+
+def make_dirs(path):
+    """ os.makedirs, except that it's fine if path is already there (e.g. made by another thread in the meantime). """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def load(parse, path, cache_dir=None):
+    """
+    Returns parse(path), using the copy cached in cache_dir if there is one for the file as it is now.  With no
+    cache_dir, just parses the file.
+    """
+    if not cache_dir:
+        return parse(path)
+
+    stat = os.stat(path)
+    source_key = (stat.st_mtime, stat.st_size)
+    cache_path = os.path.join(cache_dir, "%s.%s.refcache" % (os.path.basename(path), parse.__name__))
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cacheFile:
+            try:
+                version, key, value = pickle.load(cacheFile)
+            except Exception:
+                # written by an older version, with classes that have changed since
+                version = key = value = None
+        if version == CACHE_VERSION and key == source_key:
+            return value
+
+    value = parse(path)
+
+    make_dirs(cache_dir)
+    with open(cache_path + ".tmp", 'wb') as cacheFile:
+        pickle.dump((CACHE_VERSION, source_key, value), cacheFile, pickle.HIGHEST_PROTOCOL)
+    os.rename(cache_path + ".tmp", cache_path)
+
+    return value
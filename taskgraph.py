@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import sys
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# Runs a handful of named tasks with explicit dependencies on a few threads, each task starting as soon as the tasks
+# it depends on are done, and keeps when each one started and finished.  Used by feednyc.py to overlap its startup
+# (reading the reference CSVs, the error history and the FeedNYC pickles).
+#
+# Threads only overlap what releases the GIL: file reads, and work handed to other processes (e.g. a pickle load with
+# LOADER_PROCESSES > 1).  Two pure-Python parses still take turns.
+# -----------------------------------------------------------------------------
+
+
+class Task:
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.value = None
+        self.error = None  # sys.exc_info() if fn raised
+        self.start = None  # seconds since the graph started running
+        self.end = None
+        self.done = False
+        self.after = None  # the task whose finishing let this one start, if it had to wait for one
+
+    def wall(self):
+        return self.end - self.start
+
+
+class TaskGraph:
+    def __init__(self, threads=4):
+        self.threads = max(1, threads)
+        self.tasks = dict()  # name -> Task
+        self.order = []      # tasks, in the order they were added
+        self.wall = None
+        self._cond = threading.Condition()
+        self._origin = None
+
+    def add(self, name, fn, deps=()):
+        """
+        Adds a task: fn is called with the values of deps (names of tasks added before it), in that order, and its
+        return value is the task's value.  With one thread, tasks run in the order they were added.
+        """
+        if name in self.tasks:
+            raise ValueError("task %s added twice" % name)
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError("task %s depends on %s, which hasn't been added" % (name, dep))
+        task = self.tasks[name] = Task(name, fn, tuple(deps))
+        self.order.append(task)
+        return task
+
+    def value(self, name):
+        return self.tasks[name].value
+
+    def _run_task(self, task):
+        task.start = time.time() - self._origin
+        try:
+            task.value = task.fn(*[self.tasks[dep].value for dep in task.deps])
+        except Exception:
+            task.error = sys.exc_info()
+        task.end = time.time() - self._origin
+        with self._cond:
+            task.done = True
+            self._cond.notify()
+
+    def run(self):
+        """
+        Runs every task and returns name -> value.  If a task raises, no more are started, the ones still running
+        finish and the error is re-raised.
+        """
+        self._origin = time.time()
+        pending = list(self.order)
+        running = []
+        failed = None
+
+        with self._cond:
+            while running or (pending and failed is None):
+                finished = None
+                for task in list(running):
+                    if task.done:
+                        running.remove(task)
+                        if task.error and failed is None:
+                            failed = task
+                        if finished is None or task.end > finished.end:
+                            finished = task
+                if failed is None:
+                    for task in list(pending):
+                        if len(running) >= self.threads:
+                            break
+                        if all(self.tasks[dep].done for dep in task.deps):
+                            pending.remove(task)
+                            running.append(task)
+                            task.after = finished
+                            threading.Thread(target=self._run_task, args=(task,), name=task.name).start()
+                if running:
+                    self._cond.wait()
+
+        self.wall = time.time() - self._origin
+        if failed is not None:
+            raise failed.error[0], failed.error[1], failed.error[2]
+        return dict((task.name, task.value) for task in self.order)
+
+    def critical_path(self):
+        """
+        The chain of tasks that decided when the graph finished, first task first: the last task to finish, the task
+        whose finishing let it start (the dependency it waited on longest, or the one that freed up a thread), that
+        one's, and so on.
+        """
+        task = max(self.order, key=lambda t: t.end)
+        path = [task]
+        while task.after is not None:
+            task = task.after
+            path.insert(0, task)
+        return path
+
+    def report(self, stream=None):
+        """ Writes when each task ran, and the critical path against the slowest single task. """
+        stream = stream or sys.stderr
+        stream.write("%-32s %10s %10s %10s  %s\n" % ("task", "start (s)", "end (s)", "wall (s)", "after"))
+        for task in sorted(self.order, key=lambda t: t.start):
+            stream.write("%-32s %10.3f %10.3f %10.3f  %s\n" %
+                         (task.name, task.start, task.end, task.wall(), " ".join(task.deps)))
+
+        path = self.critical_path()
+        slowest = max(self.order, key=lambda t: t.wall())
+        stream.write("critical path: %s (%.3fs of %.3fs on %d thread(s)); slowest task: %s (%.3fs)\n" %
+                     (" -> ".join(task.name for task in path), sum(task.wall() for task in path), self.wall,
+                      self.threads, slowest.name, slowest.wall()))
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+import random
+import unittest
+
+import agency_targeting
+
+# -----------------------------------------------------------------------------
+# Regression tests for agency_targeting.py.  Run with: python -m unittest test_agency_targeting
+# -----------------------------------------------------------------------------
+
+
+def make_regions(specs):
+    """ specs: (region id, ef_demand, neighbor ids, [(target, capacity, bandwidth), ...]) for each region. """
+    regions = dict()
+    for region_id, demand, neighbors, agencies in specs:
+        region = regions[region_id] = agency_targeting.Region(region_id, demand, neighbors)
+        for k, (target, capacity, bandwidth) in enumerate(agencies):
+            region.add_agency(agency_targeting.Agency("%s-%d" % (region_id, k), target, capacity, bandwidth))
+    return regions
+
+
+class MinCostFlowTest(unittest.TestCase):
+    def check_flow(self, network, edges, source, sink, flow, cost):
+        """ Capacities are respected, flow is conserved at every other node, and cost is what the edges carry. """
+        net = dict()
+        for u, v, cap, edge_cost, edge in edges:
+            moved = agency_targeting.MinCostFlow.flow(edge)
+            self.assertTrue(0 <= moved <= cap)
+            net[u] = net.get(u, 0) - moved
+            net[v] = net.get(v, 0) + moved
+        for node, amt in net.items():
+            if node not in (source, sink):
+                self.assertEqual(amt, 0)
+        self.assertEqual(net.get(sink, 0), flow)
+        self.assertEqual(sum(edge_cost * agency_targeting.MinCostFlow.flow(edge)
+                             for u, v, cap, edge_cost, edge in edges), cost)
+
+        # and it's the cheapest such flow: no cycle of negative cost is left in the residual graph (Bellman-Ford)
+        dist = [0] * len(network.graph)
+        for k in xrange(len(network.graph)):
+            changed = False
+            for u, out in enumerate(network.graph):
+                for v, residual, edge_cost, rev in out:
+                    if residual > 0 and dist[u] + edge_cost < dist[v]:
+                        dist[v] = dist[u] + edge_cost
+                        changed = True
+            if not changed:
+                break
+        self.assertFalse(changed)
+
+    def build(self, num_nodes, specs):
+        network = agency_targeting.MinCostFlow(num_nodes)
+        return network, [(u, v, cap, cost, network.add_edge(u, v, cap, cost)) for u, v, cap, cost in specs]
+
+    def test_small_network(self):
+        network, edges = self.build(4, [(0, 1, 4, 1), (0, 2, 2, 2), (1, 2, 2, 1), (1, 3, 3, 3), (2, 3, 5, 1)])
+        self.assertEqual(network.solve(0, 3), (6, 20))
+        self.check_flow(network, edges, 0, 3, 6, 20)
+
+    def test_random_networks(self):
+        rnd = random.Random(1)
+        for trial in xrange(20):
+            num_nodes = rnd.randint(3, 8)
+            specs = [(rnd.randrange(num_nodes), rnd.randrange(num_nodes), rnd.randint(0, 10), rnd.randint(0, 5))
+                     for k in xrange(rnd.randint(2, 20))]
+            specs = [(u, v, cap, cost) for u, v, cap, cost in specs if u != v]
+            network, edges = self.build(num_nodes, specs)
+            flow, cost = network.solve(0, num_nodes - 1)
+            self.check_flow(network, edges, 0, num_nodes - 1, flow, cost)
+            # nothing left to push
+            self.assertEqual(network.solve(0, num_nodes - 1), (0, 0))
+
+
+class MinCostFlowAllocationTest(unittest.TestCase):
+    def totals(self, regions):
+        placed = sum(agency.cur_tgt for region in regions.values() for agency in region.agencies)
+        return placed, sum(region.overage for region in regions.values())
+
+    def check_allocation(self, regions):
+        before = sum(agency.init_tgt for region in regions.values() for agency in region.agencies)
+        transfers = agency_targeting.distrib_min_cost_flow(regions)
+        placed, overage = self.totals(regions)
+        self.assertEqual(placed + overage, before)
+        for region in regions.values():
+            self.assertTrue(region.overage >= 0)
+            for agency in region.agencies:
+                self.assertTrue(agency.init_tgt <= agency.cur_tgt <= agency.capacity or
+                                agency.cur_tgt == agency.capacity < agency.init_tgt)
+        return transfers
+
+    def test_prefers_own_region_then_neighbors(self):
+        regions = make_regions([("A", 100, ["B"], [(30, 20, 5), (0, 4, 1)]),
+                                ("B", 10, ["A"], [(0, 10, 1)]),
+                                ("C", 500, [], [(0, 10, 1)])])
+        transfers = self.check_allocation(regions)
+        self.assertEqual([agency.cur_tgt for agency in regions["A"].agencies], [20, 4])
+        self.assertEqual(regions["B"].agencies[0].cur_tgt, 6)
+        self.assertEqual(regions["C"].agencies[0].cur_tgt, 0)
+        self.assertEqual(transfers, [("A", "B", 6, True)])
+
+    def test_not_enough_room(self):
+        regions = make_regions([("A", 100, ["B"], [(50, 20, 5)]),
+                                ("B", 10, ["A"], [(0, 10, 1)]),
+                                ("C", 500, [], [(8, 10, 1)])])
+        transfers = self.check_allocation(regions)
+        self.assertEqual(regions["A"].overage, 18)
+        self.assertEqual(sorted(transfers), [("A", "B", 10, True), ("A", "C", 2, False)])
+
+    def test_random_regions(self):
+        rnd = random.Random(2)
+        for trial in xrange(20):
+            ids = ["R%d" % k for k in xrange(rnd.randint(2, 6))]
+            specs = [(region_id, rnd.randint(0, 1000), rnd.sample(ids, rnd.randint(0, len(ids) - 1)),
+                      [(rnd.randint(0, 60), rnd.randint(1, 40), rnd.randint(0, 9))
+                       for k in xrange(rnd.randint(1, 4))])
+                     for region_id in ids]
+            regions = make_regions(specs)
+            room = sum(max(capacity - target, 0) for s in specs for target, capacity, bandwidth in s[3])
+            excess = sum(max(target - capacity, 0) for s in specs for target, capacity, bandwidth in s[3])
+
+            transfers = self.check_allocation(regions)
+            self.assertEqual(self.totals(regions)[1], max(excess - room, 0))
+            for source_id, target_id, amt, neighbors in transfers:
+                self.assertTrue(amt > 0 and source_id != target_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,376 @@
+#!/usr/bin/python
+import cPickle as pickle
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+import feednyc
+
+# -----------------------------------------------------------------------------
+# Regression tests for feednyc.py.  Run with: python -m unittest test_feednyc
+# -----------------------------------------------------------------------------
+
+
+def make_series(efro, months):
+    efroSet = dict()
+    for month in months:
+        datum = feednyc.FeedNYCDatum()
+        datum.efro = efro
+        datum.name = "Agency %d" % efro
+        datum.sampleMonth = month
+        datum.elderlyServed = datum.adultsServed = datum.childrenServed = 10
+        datum.mealFactor = 9
+        efroSet[month] = datum
+    return efroSet
+
+
+def make_records(efros, months, seed=1):
+    """ FeedNYC record tuples, with some of what the filters look for: odd meal factors, zeros, gaps and outliers. """
+    rnd = random.Random(seed)
+    records = []
+    for efro in efros:
+        info = ("Agency %d" % efro, "FP", "%d Main St" % efro, "%d" % (efro % 5), "Bronx")
+        for month in months:
+            if rnd.random() < 0.1:
+                continue
+            served = [rnd.randint(0, 12) for k in xrange(3)]
+            if rnd.random() < 0.05:
+                served = [0, 0, 0]
+            elif rnd.random() < 0.05:
+                served = [n * 20 for n in served]
+            records.append((efro,) + info + (month,) + tuple(served) +
+                           (rnd.choice([9] * 8 + [1, 3]), "2014-07-%02d" % (month % 28 + 1), "user%d" % (efro % 3)))
+    return records
+
+
+def make_dataset(records):
+    dataset = feednyc.FeedNYCDataset()
+    dataset.append_rows(records, "Food Pantry")
+    dataset.finalize()
+    return dataset
+
+
+def dataset_rows(dataset):
+    """ A dataset's records, as tuples of their fields in record order. """
+    return [(dataset.efro[i], dataset.sampleMonth[i], dataset.elderlyServed[i], dataset.adultsServed[i],
+             dataset.childrenServed[i], dataset.mealFactor[i], dataset.infoTable[dataset.info[i]],
+             dataset.updateDate[i], dataset.updateUser[i]) for i in xrange(dataset.record_count())]
+
+
+class MonthMatrixTest(unittest.TestCase):
+    def setUp(self):
+        self.matrix = feednyc.MonthMatrix(201301, 201306)
+        self.row = self.matrix.add_row()
+        for month in (201302, 201304):
+            self.matrix.present[self.matrix.cell(self.row, month)] = 1
+
+    def test_window_inside(self):
+        self.assertEqual(self.matrix.missing(self.row, 201301, 201306), [201301, 201303, 201305, 201306])
+
+    def test_window_before(self):
+        self.assertEqual(self.matrix.missing(self.row, 201207, 201209), [201207, 201208, 201209])
+        self.assertEqual(self.matrix.missing(self.row, 201207, 201212), feednyc.months_between(201207, 201212))
+
+    def test_window_after(self):
+        self.assertEqual(self.matrix.missing(self.row, 201308, 201310), [201308, 201309, 201310])
+
+    def test_window_overlapping(self):
+        self.assertEqual(self.matrix.missing(self.row, 201211, 201302), [201211, 201212, 201301])
+        self.assertEqual(self.matrix.missing(self.row, 201304, 201308), [201305, 201306, 201307, 201308])
+        self.assertEqual(self.matrix.missing(self.row, 201212, 201307),
+                         [201212, 201301, 201303, 201305, 201306, 201307])
+
+    def test_spanning_no_months(self):
+        for efroSets in ([], [dict()]):
+            matrix = feednyc.MonthMatrix.spanning(efroSets)
+            self.assertEqual(matrix.width, 0)
+            row = matrix.add_row()
+            self.assertEqual(len(matrix.present), 0)
+            self.assertEqual(matrix.missing(row, 201301, 201303), [201301, 201302, 201303])
+
+    def test_skipped_filter_window_before_data(self):
+        data = {80001: make_series(80001, feednyc.months_between(201301, 201306))}
+        skipped = feednyc.SkippedDataFilter()
+        skipped.set_output_window(201207, 201209)
+        skipped.filter(data)
+        self.assertEqual(skipped.badData[80001], [201207, 201208, 201209])
+
+        pipeline = feednyc.FilterPipeline([feednyc.SkippedDataFilter()])
+        pipeline.filters[0].set_output_window(201207, 201209)
+        pipeline.run(data)
+        self.assertEqual(pipeline.filters[0].badData[80001], [201207, 201208, 201209])
+
+
+class RecordFlagsTest(unittest.TestCase):
+    def test_printing_leaves_input_datums_alone(self):
+        efroSet = make_series(80001, feednyc.months_between(201301, 201306))
+        efroSet[201303].mealFactor = 3
+        efroSet[201304].elderlyServed = efroSet[201304].adultsServed = efroSet[201304].childrenServed = 0
+        for datum in efroSet.values():
+            datum.flag = "untouched"
+
+        pipeline = feednyc.FilterPipeline([feednyc.MealFactorFilter(), feednyc.ZeroFilter()])
+        for f in pipeline.filters:
+            f.set_output_window(201301, 201306)
+        pipeline.run({80001: efroSet})
+
+        for report_rows in ("per-flag", "per-record"):
+            sink = feednyc.StdoutSink(StringIO())
+            self.assertEqual(pipeline.print_report(sink, report_rows), 2)
+            sink.close()
+            self.assertNotIn("untouched", sink.stream.getvalue())
+        self.assertEqual(set(datum.flag for datum in efroSet.values()), set(["untouched"]))
+
+    def test_letters_after_sharded_merge(self):
+        data = make_dataset(make_records(range(80001, 80012), feednyc.months_between(201207, 201406)))
+
+        # some reviewed records, printed with a P or left out
+        history = feednyc.ErrorHistory()
+        for f in run_pipeline(data).filters:
+            for k, (efro, months) in enumerate(sorted(f.badData.items())[:4]):
+                history.add(f.filter_flag, efro, months[0], k % 2 == 0)
+
+        serial = run_pipeline(data, history=history)
+        sharded = run_pipeline(data, 3, history)
+        self.assertTrue(serial.records.letters)
+        self.assertEqual(sharded.records.letters, serial.records.letters)
+        self.assertEqual(sharded.records.bits, serial.records.bits)
+
+        rows = report(sharded, "per-record")
+        self.assertEqual(rows, report(serial, "per-record"))
+        self.assertIn("+", rows)
+        self.assertIn(",P", rows)
+
+
+def run_pipeline(data, processes=1, history=None):
+    pipeline = feednyc.FilterPipeline(feednyc.make_filters(201307, 201406, history))
+    if processes > 1:
+        pipeline.run_sharded(data, processes, shards_per_process=2)
+    else:
+        pipeline.run(data)
+    return pipeline
+
+
+def report(pipeline, report_rows="per-flag"):
+    sink = feednyc.StdoutSink(StringIO())
+    pipeline.print_report(sink, report_rows)
+    sink.close()
+    return sink.stream.getvalue()
+
+
+class ShardedPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.data = make_dataset(make_records(range(80001, 80012), feednyc.months_between(201207, 201406)))
+
+    def check_sharded(self, data):
+        serial = run_pipeline(data)
+        sharded = run_pipeline(data, 3)
+        for f, g in zip(serial.filters, sharded.filters):
+            self.assertEqual(dict(g.badData), dict(f.badData))
+            self.assertTrue(f.badData, f.filter_flag)
+        self.assertEqual(report(sharded), report(serial))
+        self.assertEqual(report(sharded, "per-record"), report(serial, "per-record"))
+
+    def test_dataset(self):
+        self.check_sharded(self.data)
+
+    def test_dict(self):
+        self.check_sharded(dict((efro, dict(series.items())) for efro, series in self.data.items()))
+
+
+class IncrementalStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="feednyc-test-")
+        self.path = os.path.join(self.dir, "state.pkl")
+        self.efros = set(range(80001, 80006))
+        self.records = make_records(sorted(self.efros), feednyc.months_between(201307, 201406))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def summaries(self, state):
+        return sorted(summary.to_tuple() for summary in state.summaries.values())
+
+    def test_save_load_update(self):
+        old = [curTup for curTup in self.records if curTup[6] <= 201312]
+        state = feednyc.IncrementalState()
+        state.update(make_dataset(old), [], self.efros)
+        state.save(self.path)
+        loaded = feednyc.load_incremental_state(self.path)
+        self.assertEqual(self.summaries(loaded), self.summaries(state))
+
+        filters = [feednyc.MealFactorFilter(), feednyc.ZeroFilter()]
+        for f in filters:
+            f.set_output_window(201307, 201406)
+        loaded.update(make_dataset(self.records), filters, self.efros)
+
+        # the summaries are as if every record had been added in one run, and only the new records were checked
+        full = feednyc.IncrementalState()
+        full.update(make_dataset(self.records), [], self.efros)
+        self.assertEqual(self.summaries(loaded), self.summaries(full))
+
+        new = [curTup for curTup in self.records if curTup[6] > 201312]
+        flagged = [set((efro, month) for efro, months in f.badData.items() for month in months) for f in filters]
+        self.assertEqual(flagged[0], set((curTup[0], curTup[6]) for curTup in new if curTup[10] not in (1, 9)))
+        self.assertEqual(flagged[1], set((curTup[0], curTup[6]) for curTup in new if sum(curTup[7:10]) == 0))
+        self.assertTrue(flagged[0] and flagged[1])
+
+    def test_other_version(self):
+        with open(self.path, 'wb') as stateFile:
+            pickle.dump({'version': feednyc.IncrementalState.VERSION + 1, 'summaries': []}, stateFile)
+        self.assertRaises(ValueError, feednyc.load_incremental_state, self.path)
+
+
+class FeedNYCCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="feednyc-test-")
+        self.source = os.path.join(self.dir, "FeedNYC-All-2014.pkl")
+        self.write_source(make_records(range(80001, 80007), feednyc.months_between(201307, 201406)))
+        self.cache = feednyc.FeedNYCCache(os.path.join(self.dir, "cache"))
+        self.efros = set([80002, 80003, 80005])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_source(self, records):
+        with open(self.source, 'wb') as pickleFile:
+            pickle.dump(records, pickleFile, pickle.HIGHEST_PROTOCOL)
+
+    def read_source(self, efros):
+        return feednyc.read_feednyc_pickle((self.source, efros, None, None))
+
+    def test_round_trip(self):
+        self.assertEqual(self.cache.load(self.source, self.efros), None)
+        block = self.read_source(self.efros)
+        self.cache.store(self.source, self.efros, block)
+        self.assertEqual(dataset_rows(self.cache.load(self.source, self.efros)), dataset_rows(block))
+
+    def test_other_efros(self):
+        self.cache.store(self.source, self.efros, self.read_source(self.efros))
+        self.assertEqual(self.cache.load(self.source, self.efros | set([80001])), None)
+
+        # storing another EFRO set replaces the entry
+        self.cache.store(self.source, set([80001]), self.read_source(set([80001])))
+        self.assertEqual(self.cache.load(self.source, self.efros), None)
+        self.assertEqual(os.listdir(self.cache.cache_dir), [os.path.basename(self.cache.path(self.source,
+                                                                                               set([80001])))])
+
+    def test_source_changed(self):
+        self.cache.store(self.source, self.efros, self.read_source(self.efros))
+        mtime = os.path.getmtime(self.source)
+        os.utime(self.source, (mtime + 10, mtime + 10))
+        self.assertEqual(self.cache.load(self.source, self.efros), None)
+
+        self.cache.store(self.source, self.efros, self.read_source(self.efros))
+        # same mtime, different size
+        self.write_source(make_records(range(80001, 80007), feednyc.months_between(201307, 201405)))
+        os.utime(self.source, (mtime + 10, mtime + 10))
+        self.assertEqual(self.cache.load(self.source, self.efros), None)
+
+
+class FeedNYCStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="feednyc-test-")
+        self.source = os.path.join(self.dir, "FeedNYC-All-2014.pkl")
+        self.records = make_records(range(80001, 80009), feednyc.months_between(201307, 201406))
+        with open(self.source, 'wb') as pickleFile:
+            pickle.dump(self.records, pickleFile, pickle.HIGHEST_PROTOCOL)
+        self.path = feednyc.convert_feednyc_store(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        self.assertEqual(self.path, os.path.join(self.dir, "FeedNYC-All-2014.store"))
+        for efros, min_month, max_month in ((None, None, None),
+                                            (set([80002, 80005, 80008, 99999]), None, None),
+                                            (set([80001, 80003]), 201310, 201402)):
+            expected = feednyc.read_feednyc_pickle((self.source, efros, min_month, max_month))
+            block = feednyc.read_feednyc_pickle((self.path, efros, min_month, max_month))
+            self.assertEqual(dataset_rows(block), dataset_rows(expected))
+            self.assertTrue(block.record_count())
+
+    def test_index(self):
+        store = feednyc.FeedNYCStore(self.path)
+        with open(self.path, 'rb') as storeFile:
+            efros, offsets = store.read_index(storeFile)
+            self.assertEqual(efros.tolist(), range(80001, 80009))
+            self.assertEqual(len(offsets), len(efros) + 1)
+            self.assertEqual(offsets[0], len(store.MAGIC) + 1 + 8)
+
+            # each partition is just its efro's records
+            for k, efro in enumerate(efros):
+                storeFile.seek(offsets[k])
+                partition = pickle.loads(storeFile.read(offsets[k + 1] - offsets[k]))
+                block = feednyc.FeedNYCDataset()
+                store.add_partition(block, efro, partition, None, None)
+                self.assertEqual(block.sampleMonth.tolist(),
+                                 [curTup[6] for curTup in self.records if curTup[0] == efro])
+
+    def test_not_a_store(self):
+        self.assertRaises(ValueError, feednyc.FeedNYCStore(self.source).read)
+
+
+class ErrorHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="feednyc-test-")
+        self.path = os.path.join(self.dir, "error-history.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.path, 'wb') as csvfile:
+            csvfile.write(text)
+
+    def read(self):
+        with open(self.path, 'rb') as csvfile:
+            return csvfile.read()
+
+    def test_append_without_trailing_newline(self):
+        # as Excel writes it
+        self.write("ID,Flag,Print\r\n80001-201301,zeros,y")
+        history = feednyc.ErrorHistory()
+        history.load(self.path)
+        history.append(self.path, [("outlier", 80001, 201302, False)])
+        self.assertEqual(self.read(), "ID,Flag,Print\r\n80001-201301,zeros,y\r\n80001-201302,outlier,n\r\n")
+
+        reloaded = feednyc.ErrorHistory()
+        reloaded.load(self.path)
+        self.assertEqual(reloaded.entries, history.entries)
+        self.assertEqual(reloaded.lookup("zeros", 80001, 201301), True)
+        self.assertEqual(reloaded.lookup("outlier", 80001, 201302), False)
+
+    def test_append_keeps_line_terminator(self):
+        self.write("ID,Flag,Print\n80001-201301,zeros,y\n")
+        history = feednyc.ErrorHistory()
+        history.append(self.path, [("outlier", 80001, 201302, True)])
+        self.assertEqual(self.read(), "ID,Flag,Print\n80001-201301,zeros,y\n80001-201302,outlier,y\n")
+
+    def test_load_quoted_newline(self):
+        self.write('ID,Flag,Print\r\n80001-201301,"zeros\r\nsee notes",y\r\n80001-201302,outlier,n\r\n')
+        history = feednyc.ErrorHistory()
+        self.assertEqual(history.load(self.path), os.path.getsize(self.path))
+        self.assertEqual(history.lookup("zeros\nsee notes", 80001, 201301), True)
+        self.assertEqual(history.lookup("outlier", 80001, 201302), False)
+
+    def test_load_appended_rows(self):
+        self.write("ID,Flag,Print\r\n80001-201301,zeros,y\r\n80001-2013")
+        history = feednyc.ErrorHistory()
+        offset = history.load(self.path)
+        self.assertEqual(offset, len("ID,Flag,Print\r\n80001-201301,zeros,y\r\n"))
+        self.assertEqual(history.lookup("outlier", 80001, 201302), None)
+
+        with open(self.path, 'ab') as csvfile:
+            csvfile.write("02,outlier,n\r\n")
+        self.assertEqual(history.load(self.path, offset), os.path.getsize(self.path))
+        self.assertEqual(history.lookup("outlier", 80001, 201302), False)
+        self.assertEqual(history.messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()